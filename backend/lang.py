@@ -1,27 +1,156 @@
 from __future__ import annotations
 
+import argparse
+import asyncio
+import atexit
+import bisect
+import hashlib
+import itertools
 import json
+import math
+import os
 import queue
+import random
+import re
+import signal
+import socket
 import sqlite3
 import threading
-from dataclasses import dataclass, asdict
-from datetime import datetime, timezone
-from flask import Flask, jsonify, request
-from openai import OpenAI
-from pydantic import BaseModel
+import time
+from types import SimpleNamespace
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from flask import Flask, Response, jsonify, request, stream_with_context
+import openai
+from openai import AsyncOpenAI, OpenAI
+from pydantic import BaseModel, ValidationError
+
+try:
+    import numpy as np
+except ImportError:  # similarity search is unavailable without numpy
+    np = None
 
 DB_PATH = "/var/www/site/data/lang.db"
 USAGE_DB_PATH = "/var/www/site/data/llm_usage.db"
 
 app = Flask(__name__)
 client = OpenAI()
+aclient = AsyncOpenAI()
+# Client for the offline Batch API; LANG_BATCH_BASE_URL points it at a stub server.
+batch_client = OpenAI(base_url=os.environ.get("LANG_BATCH_BASE_URL") or None)
 
-CONCURRENCY = 2
-task_queue: queue.Queue[int] = queue.Queue()
+
+def _parse_model_limits(spec: str) -> dict[str, int]:
+    """
+    Parse "model=n,other-model=m" into {"model": n, "other-model": m}.
+    """
+    limits: dict[str, int] = {}
+    for item in spec.split(","):
+        model, _, value = item.partition("=")
+        if model.strip() and value.strip():
+            limits[model.strip()] = int(value)
+    return limits
+
+
+# Max LLM requests in flight per process, and optional tighter per-model caps.
+CONCURRENCY = int(os.environ.get("LANG_CONCURRENCY", "32"))
+# Scheduling classes. Interactive tasks are always claimed before bulk ones,
+# and bulk tasks may fill at most CONCURRENCY - INTERACTIVE_RESERVED slots so
+# a click in the UI never waits behind a full fan-out.
+TASK_PRIORITIES = ("interactive", "bulk")
+INTERACTIVE_RESERVED = min(
+    int(os.environ.get("LANG_INTERACTIVE_RESERVED", "4")), max(CONCURRENCY - 1, 0)
+)
+MODEL_CONCURRENCY = _parse_model_limits(os.environ.get("LANG_MODEL_CONCURRENCY", ""))
+_model_semaphores: dict[str, asyncio.Semaphore] = {}
+
+# Starting (requests/min, tokens/min) per model. Once a response comes back
+# the provider's x-ratelimit-* headers take over; we pace at RATE_HEADROOM
+# of whatever the provider says so we stay just under the limit.
+MODEL_RATE_LIMITS: dict[str, tuple[int, int]] = {
+    "gpt-5-mini-2025-08-07": (500, 500_000),
+}
+DEFAULT_RATE_LIMITS = (500, 200_000)
+RATE_HEADROOM = 0.9
+_rate_limiters: dict[str, "RateLimiter"] = {}
+
+# Tasks enqueued with mode="batch" skip the executor and go through the
+# OpenAI Batch API: cheaper, slower, and off the interactive rate limit.
+# mode="stream" runs on the executor but consumes the response as an event
+# stream, keeping the output so far in tasks.partial.
+TASK_MODES = ("interactive", "batch", "stream")
+STREAM_FLUSH_INTERVAL = 0.25
+BATCH_POLL_INTERVAL = float(os.environ.get("LANG_BATCH_POLL_INTERVAL", "60"))
+BATCH_MAX_TASKS = 5000
+# An llm_batches row stays 'creating' only between being recorded and the
+# provider accepting the batch; past this age its submitter is gone.
+BATCH_CREATE_TIMEOUT = 3600
+
+# Content-addressed cache of parsed LLM outputs, keyed on
+# (model, system prompt, final prompt, output schema).
+LLM_CACHE_TTL = float(os.environ.get("LANG_LLM_CACHE_TTL", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LANG_LLM_CACHE_MAX_ENTRIES", "50000"))
+# Writing embeddings for similarity search. LANG_EMBEDDER picks the
+# implementation (see EMBEDDERS); vectors live in a float32 matrix file next
+# to lang.db unless LANG_EMBEDDINGS_PATH says otherwise.
+EMBEDDER = os.environ.get("LANG_EMBEDDER", "openai")
+EMBEDDING_MODEL = os.environ.get("LANG_EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIM = int(os.environ.get("LANG_EMBEDDING_DIM", "256"))
+EMBEDDING_BATCH = 128
+EMBEDDING_GROW_ROWS = 4096
+# Inputs are cut to this many characters to stay under the model's token limit.
+EMBEDDING_MAX_CHARS = 8000
+EMBED_INTERVAL = 10.0
+_embed_wakeup = threading.Event()
+# A claimed task is leased to one worker; if the lease is not renewed
+# (process died, worker recycled) another worker picks the task up again.
+LEASE_SECONDS = 120
+LEASE_RENEW_INTERVAL = 30
+# Only tasks this process is actually working on get their lease renewed;
+# the executor and the batch loop add ids when they claim and drop them
+# once the outcome is written (or could not be).
+_inflight_tasks: set[int] = set()
+_inflight_lock = threading.Lock()
+OUTCOME_WRITE_ATTEMPTS = 3
+# Finished tasks move from tasks to task_archive (without their full text
+# bodies) once older than TASK_RETENTION seconds or beyond the newest
+# TASK_KEEP_FINISHED; they can be retried until then.
+TASK_RETENTION = float(os.environ.get("LANG_TASK_RETENTION", str(24 * 3600)))
+TASK_KEEP_FINISHED = int(os.environ.get("LANG_TASK_KEEP_FINISHED", "1000"))
+TASK_PREVIEW_CHARS = 200
+POLL_INTERVAL = float(os.environ.get("LANG_POLL_INTERVAL", "2.0"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Tasks are run by `python -m lang worker` processes; the web app only
+# enqueues and reads. LANG_EMBEDDED_WORKERS=1 runs the executor inside each
+# web process instead (a single-process setup), stopped the same graceful
+# way when the process exits.
+EMBEDDED_WORKERS = os.environ.get("LANG_EMBEDDED_WORKERS", "0") == "1"
+# On shutdown, in-flight tasks get this long to finish before their leases
+# are handed back to the queue.
+SHUTDOWN_GRACE = float(os.environ.get("LANG_SHUTDOWN_GRACE", "60"))
+_stopping = threading.Event()
 task_lock = threading.Lock()
-tasks: dict[int, "Task"] = {}
+_task_wakeup = threading.Event()
+# Status transitions land in task_events (written by triggers on tasks).
+# SSE streams poll that table every TASK_EVENT_POLL seconds, so transitions
+# made by another process still arrive; _task_events_changed wakes streams
+# in this process immediately.
+TASK_EVENT_POLL = 1.0
+TASK_EVENT_KEEPALIVE = 15.0
+TASK_EVENT_RETENTION = 24 * 3600
+# Every open SSE stream holds a request thread for as long as it lasts, so
+# serve the app with threaded or gevent workers (gunicorn --threads N or
+# -k gevent), never plain sync workers, and keep SSE_MAX_STREAMS (per
+# process) below the threads a worker has. Streams end after SSE_MAX_AGE
+# seconds; EventSource reconnects and resumes from Last-Event-ID, and a
+# stream whose tab was closed frees its thread by then at the latest.
+SSE_MAX_STREAMS = int(os.environ.get("LANG_SSE_MAX_STREAMS", "16"))
+SSE_MAX_AGE = float(os.environ.get("LANG_SSE_MAX_AGE", "300"))
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+_task_events_changed = threading.Condition()
 _workers_started = False
-_next_task_id = 1
+_schema_ready = False
 
 
 INSTRUCTION_TEMPLATE = """
@@ -72,18 +201,267 @@ class Task:
     finished_at: str | None = None
     error: str | None = None
     run_id: int | None = None
+    # lease (persistent queue)
+    lease_owner: str | None = None
+    lease_expires_at: str | None = None
+    # retries
+    attempts: int = 0
+    errors: str | None = None  # JSON list of {"at", "error"}, most recent last
+    available_at: str | None = None
+    # fan-out batches (POST /api/lang/batch)
+    batch_id: int | None = None
+    # execution mode; batch-mode tasks record their submission and request
+    mode: str = "interactive"
+    llm_batch_id: int | None = None
+    llm_request: str | None = None
+    # False skips the response cache lookup (the fresh result is still cached)
+    use_cache: bool = True
+    # identical queued/running tasks share a key and coalesce into one
+    dedup_key: str | None = None
+    # raw model output received so far (mode="stream")
+    partial: str | None = None
+    # scheduling: lane, and the group (batch / parent writing) shared fairly
+    priority: str = "interactive"
+    fair_key: str | None = None
+
+
+TASK_COLUMNS = tuple(Task.__dataclass_fields__)
+
+
+class TaskSummary:
+    """
+    Compact view of a task for listings: status and bookkeeping plus the
+    first TASK_PREVIEW_CHARS of each text, never the full bodies.
+    """
+
+    __slots__ = (
+        "id",
+        "kind",
+        "status",
+        "mode",
+        "attempts",
+        "parent_writing_id",
+        "batch_id",
+        "run_id",
+        "error",
+        "text_a",
+        "text_b",
+        "created_at",
+        "started_at",
+        "finished_at",
+    )
+
+    def __init__(self, row: sqlite3.Row):
+        for name in self.__slots__:
+            setattr(self, name, row[name])
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# SELECT list producing TaskSummary rows from tasks or task_archive.
+TASK_SUMMARY_SELECT = ", ".join(
+    f"substr({name}, 1, {TASK_PREVIEW_CHARS}) AS {name}"
+    if name in ("text_a", "text_b")
+    else name
+    for name in TaskSummary.__slots__
+)
+
+
+class LLMOutputError(Exception):
+    """The model answered but gave us nothing we could parse."""
+
+
+class LLMBatchError(Exception):
+    """A Batch API job failed, expired or came back without a task's result."""
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int
+    base_delay: float  # seconds before the first retry
+    max_delay: float
+
+    def delay(self, attempt: int) -> float:
+        # Exponential backoff with full jitter.
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(self.base_delay / 2, ceiling)
+
+
+RETRY_POLICIES: dict[str, RetryPolicy] = {
+    "lang": RetryPolicy(max_attempts=5, base_delay=10, max_delay=600),
+    "prompt_child": RetryPolicy(max_attempts=5, base_delay=5, max_delay=300),
+    "gargantua_child": RetryPolicy(max_attempts=5, base_delay=5, max_delay=300),
+}
+DEFAULT_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay=5, max_delay=300)
+
+# Failures worth another attempt: timeouts, dropped connections, 429s, 5xx
+# and outputs that did not parse into the expected schema. Anything else
+# (missing writing, bad input) fails the task straight away.
+RETRYABLE_ERRORS: tuple[type[BaseException], ...] = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.ConflictError,
+    openai.LengthFinishReasonError,
+    ValidationError,
+    json.JSONDecodeError,
+    LLMOutputError,
+    LLMBatchError,
+)
+MAX_ERROR_HISTORY = 10
+
+
+# Idle connections kept per database file; extra ones are closed on release.
+DB_POOL_SIZE = int(os.environ.get("LANG_DB_POOL_SIZE", "16"))
+# Per-connection cache of compiled statements, reused across requests.
+DB_CACHED_STATEMENTS = 256
+# How long a connection waits on a locked database before failing (seconds).
+DB_BUSY_TIMEOUT = 15.0
+# WAL housekeeping: checkpoint every CHECKPOINT_INTERVAL seconds, and
+# truncate the -wal file once it grows past WAL_TRUNCATE_PAGES pages.
+CHECKPOINT_INTERVAL = 60.0
+WAL_TRUNCATE_PAGES = 10_000
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A connection that goes back to its pool on close() instead of closing.
+    Any open transaction is rolled back first, so the next borrower starts
+    clean.
+    """
+
+    _pool: "ConnectionPool | None" = None
+    _checked_out = False
+
+    def close(self) -> None:
+        pool = self._pool
+        if pool is None:
+            super().close()
+            return
+        if not self._checked_out:
+            return
+        self._checked_out = False
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = sqlite3.Row
+        pool.release(self)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int = DB_POOL_SIZE) -> None:
+        self.path = path
+        self._idle: queue.LifoQueue[PooledConnection] = queue.LifoQueue(maxsize=size)
+
+    def _open(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            factory=PooledConnection,
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS,
+        )
+        conn.row_factory = sqlite3.Row
+        # Per-connection settings, applied once for the life of the connection.
+        # WAL lets readers keep going while a writer commits; NORMAL sync is
+        # durable across application crashes in WAL mode.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -16000")
+        conn._pool = self
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        conn._checked_out = True
+        return conn
+
+    def release(self, conn: PooledConnection) -> None:
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn._pool = None
+            conn.close()
+
 
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_for(path: str) -> ConnectionPool:
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
 
 
 def _get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _pool_for(DB_PATH).acquire()
 
 def _get_usage_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(USAGE_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _pool_for(USAGE_DB_PATH).acquire()
+
+
+def _checkpoint(path: str) -> None:
+    conn = _pool_for(path).acquire()
+    try:
+        busy, wal_pages, _ = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if not busy and wal_pages > WAL_TRUNCATE_PAGES:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+
+class DBWriter:
+    """
+    Runs write jobs one at a time on a dedicated thread.
+
+    Task results (runs/writings/notes, usage, cache rows, status updates)
+    go through here, so concurrent tasks never fight each other for the
+    SQLite write lock and request threads only ever wait behind one writer.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args) -> Future:
+        future: Future = Future()
+        self._jobs.put((fn, args, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            fn, args, future = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+
+_db_writer = DBWriter()
+
+
+async def _write(fn, *args):
+    """
+    Run a DB write on the single writer thread and await its result.
+    """
+    return await asyncio.wrap_future(_db_writer.submit(fn, *args))
 
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat(timespec="seconds")
@@ -91,508 +469,2345 @@ def _now_iso() -> str:
 def _today_utc() -> str:
     return datetime.now(timezone.utc).date().isoformat()
 
-def _next_id() -> int:
-    global _next_task_id
-    with task_lock:
-        task_id = _next_task_id
-        _next_task_id += 1
-        return task_id
-
-def _enqueue_task(text_a: str, text_b: str, parent_writing_id: int | None) -> int:
-    task_id = _next_id()
-    created_at = _now_iso()
-    task = Task(
-        id=task_id,
-        kind="lang",
-        text_a=text_a,
-        text_b=text_b,
-        parent_writing_id=parent_writing_id,
-        status="queued",
-        created_at=created_at,
-    )
-    with task_lock:
-        tasks[task_id] = task
-    task_queue.put(task_id)
-    return task_id
+def _iso_after(seconds: float) -> str:
+    when = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return when.isoformat(timespec="seconds")
+
+
+# Indexes expected in lang.db, name -> "table (columns)". /api/health reports
+# any that are missing.
+LANG_INDEXES: dict[str, str] = {
+    # task queue
+    "idx_tasks_status": "tasks (status, id)",
+    "idx_tasks_batch": "tasks (batch_id)",
+    "idx_tasks_llm_batch": "tasks (llm_batch_id)",
+    "idx_tasks_dedup": "tasks (dedup_key, status)",
+    "idx_llm_cache_last_hit": "llm_cache (last_hit_at)",
+    "idx_llm_cache_created": "llm_cache (created_at)",
+    "idx_task_events_task": "task_events (task_id, id)",
+    "idx_task_events_created": "task_events (created_at)",
+    "idx_writing_changes_created": "writing_changes (created_at)",
+    "idx_writing_closure_descendant": "writing_closure (descendant_id, depth)",
+    "idx_tasks_finished": "tasks (status, finished_at)",
+    "idx_task_archive_batch": "task_archive (batch_id)",
+    "idx_tasks_lane": "tasks (status, priority, fair_key, id)",
+    # hot read paths: type lists, children / erase CTE, lookup_writing,
+    # list_lang?parent_writing_id=, list_notes and note cleanup
+    "idx_writings_type": "writings (type, id)",
+    "idx_writings_parent_writing": "writings (parent_writing_id, id)",
+    "idx_writings_parent_run_name": "writings (parent_run_id, name)",
+    "idx_runs_parent_writing": "runs (parent_writing_id, id)",
+    "idx_writing_notes_writing": "writing_notes (writing_id, id)",
+    "idx_writing_notes_child": "writing_notes (child_writing_id)",
+}
+
+
+def _ensure_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]) -> None:
+    """
+    Add any of `columns` (name -> declaration) missing from an existing table.
+    Tables that do not exist are left alone.
+    """
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if not existing:
+        return
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
 
 
-def _enqueue_prompt_task(
-    *,
-    writing_id: int,
-    prompt_id: int | None,
-    prompt_text: str,
-    output_type: str | None,
-) -> int:
-    task_id = _next_id()
-    created_at = _now_iso()
-    task = Task(
-        id=task_id,
-        kind="prompt_child",
-        text_a="",   # not used directly
-        text_b="",   # not used directly
-        parent_writing_id=writing_id,
-        status="queued",
-        created_at=created_at,
-        prompt_id=prompt_id,
-        prompt_text=prompt_text,
-        output_type=output_type,
-    )
-    with task_lock:
-        tasks[task_id] = task
-    task_queue.put(task_id)
-    return task_id
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    return row is not None
 
-def _enqueue_gargantua_task(
-    *,
-    writing_id: int,
-    gargantua_id: int,
-) -> int:
-    task_id = _next_id()
-    created_at = _now_iso()
-    task = Task(
-        id=task_id,
-        kind="gargantua_child",
-        text_a="",
-        text_b="",
-        parent_writing_id=writing_id,
-        status="queued",
-        created_at=created_at,
-        gargantua_id=gargantua_id,
-    )
-    with task_lock:
-        tasks[task_id] = task
-    task_queue.put(task_id)
-    return task_id
 
+def _create_indexes(conn: sqlite3.Connection, names: list[str]) -> None:
+    """
+    Create the named LANG_INDEXES entries, skipping tables that do not exist
+    (those are reported as missing by /api/health).
+    """
+    for name in names:
+        target = LANG_INDEXES[name]
+        table = target.split(" ", 1)[0]
+        if not _table_exists(conn, table):
+            continue
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        if table in ("writings", "runs", "writing_notes"):
+            conn.execute(f"ANALYZE {table}")
 
-def _run_task(task: Task) -> None:
-    if task.kind == "prompt_child":
-        _run_prompt_child_task(task)
-    elif task.kind == "gargantua_child":
-        _run_gargantua_child_task(task)
-    else:
-        _run_lang_task(task)
 
+def _migrate_task_tables(conn: sqlite3.Connection) -> None:
+    # Written with IF NOT EXISTS / _ensure_columns so it also adopts
+    # databases that created these tables before migrations were tracked.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            text_a TEXT NOT NULL DEFAULT '',
+            text_b TEXT NOT NULL DEFAULT '',
+            parent_writing_id INTEGER,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            prompt_id INTEGER,
+            prompt_text TEXT,
+            output_type TEXT,
+            gargantua_id INTEGER,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT,
+            run_id INTEGER,
+            lease_owner TEXT,
+            lease_expires_at TEXT
+        )
+        """
+    )
+    _ensure_columns(
+        conn,
+        "tasks",
+        {
+            "attempts": "INTEGER NOT NULL DEFAULT 0",
+            "errors": "TEXT",
+            "available_at": "TEXT",
+            "batch_id": "INTEGER",
+            "mode": "TEXT NOT NULL DEFAULT 'interactive'",
+            "llm_batch_id": "INTEGER",
+            "llm_request": "TEXT",
+            "use_cache": "INTEGER NOT NULL DEFAULT 1",
+            "dedup_key": "TEXT",
+        },
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provider_batch_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            input_file_id TEXT,
+            output_file_id TEXT,
+            error_file_id TEXT,
+            created_at TEXT NOT NULL,
+            completed_at TEXT,
+            error TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            output TEXT NOT NULL,
+            tokens_in INTEGER NOT NULL DEFAULT 0,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            last_hit_at TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    _create_indexes(
+        conn,
+        [
+            "idx_tasks_status",
+            "idx_tasks_batch",
+            "idx_tasks_llm_batch",
+            "idx_tasks_dedup",
+            "idx_llm_cache_last_hit",
+            "idx_llm_cache_created",
+        ],
+    )
 
-def _run_lang_task(task: Task) -> None:
-    text_input = INSTRUCTION_TEMPLATE.format(
-        text_a=task.text_a,
-        text_b=task.text_b,
-    ).strip()
 
-    model_name = "gpt-5-mini-2025-08-07"
-    response = client.responses.parse(
-        model=model_name,
-        input=[
-            {"role": "system", "content": "You are an expert idea generator."},
-            {"role": "user", "content": text_input},
+def _migrate_hot_indexes(conn: sqlite3.Connection) -> None:
+    _create_indexes(
+        conn,
+        [
+            "idx_writings_type",
+            "idx_writings_parent_writing",
+            "idx_writings_parent_run_name",
+            "idx_runs_parent_writing",
+            "idx_writing_notes_writing",
+            "idx_writing_notes_child",
         ],
-        text_format=IdeaSet,
     )
 
-    idea_set: IdeaSet = response.output_parsed
-    _record_usage(model_name, response)
-
-    conn = _get_db()
-    cur = conn.cursor()
 
-    # 1) Insert run row (prompt_id left NULL)
-    cur.execute(
+def _migrate_task_events(conn: sqlite3.Connection) -> None:
+    conn.execute(
         """
-        INSERT INTO runs (instruction, text_a, text_b, parent_writing_id, prompt, response)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-        (INSTRUCTION_TEMPLATE, task.text_a, task.text_b, task.parent_writing_id, text_input, None),
-    )
-    run_id = cur.lastrowid
-
-    # 2) Create writings for each idea (this is what you already have)
-    enriched_ideas: list[dict] = []
-    for idea in idea_set.ideas:
-        cur.execute(
-            """
-            INSERT INTO writings (
-                name,
-                description,
-                parent_run_id,
-                parent_text_a,
-                parent_text_b,
-                parent_writing_id,
-                notes,
-                type
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                idea.name,
-                idea.desciription,
-                run_id,
-                task.text_a,
-                task.text_b,
-                task.parent_writing_id,
-                "",
-                "words",
-            ),
+        CREATE TABLE IF NOT EXISTS task_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_id INTEGER,
+            error TEXT,
+            batch_id INTEGER,
+            created_at TEXT NOT NULL
         )
-        writing_id = int(cur.lastrowid)
-        idea_dict = idea.model_dump()
-        idea_dict["writing_id"] = writing_id
-        enriched_ideas.append(idea_dict)
-
-    # 3) Store response JSON
-    cur.execute(
         """
-        UPDATE runs
-        SET response = ?
-        WHERE id = ?
-        """,
-        (json.dumps({"ideas": enriched_ideas}), run_id),
     )
-    conn.commit()
-    conn.close()
-
-    task.run_id = run_id
+    # Triggers rather than call-site inserts, so every path that moves a
+    # task (executor, Batch API, retry endpoint, another process) is covered.
+    # A re-claim after an expired lease keeps status 'running' but bumps
+    # attempts, so that counts as a transition too.
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_event_insert
+        AFTER INSERT ON tasks
+        BEGIN
+            INSERT INTO task_events
+                (task_id, kind, status, attempts, run_id, error, batch_id, created_at)
+            VALUES
+                (NEW.id, NEW.kind, NEW.status, NEW.attempts, NEW.run_id, NEW.error,
+                 NEW.batch_id, strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now'));
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_event_update
+        AFTER UPDATE OF status, attempts ON tasks
+        WHEN NEW.status IS NOT OLD.status OR NEW.attempts IS NOT OLD.attempts
+        BEGIN
+            INSERT INTO task_events
+                (task_id, kind, status, attempts, run_id, error, batch_id, created_at)
+            VALUES
+                (NEW.id, NEW.kind, NEW.status, NEW.attempts, NEW.run_id, NEW.error,
+                 NEW.batch_id, strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now'));
+        END
+        """
+    )
+    _create_indexes(conn, ["idx_task_events_task", "idx_task_events_created"])
 
-def _first_line(text: str | None) -> str:
-    if not text:
-        return ""
-    return (text.splitlines()[0] or "").strip()
 
+def _migrate_task_archive(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_archive (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            mode TEXT NOT NULL DEFAULT 'interactive',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            parent_writing_id INTEGER,
+            batch_id INTEGER,
+            run_id INTEGER,
+            error TEXT,
+            text_a TEXT NOT NULL DEFAULT '',
+            text_b TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            archived_at TEXT NOT NULL
+        )
+        """
+    )
+    # Live and archived tasks together, for anything that reports on tasks
+    # after they finish (batch progress, point lookups).
+    columns = ", ".join(TaskSummary.__slots__)
+    conn.execute(
+        f"""
+        CREATE VIEW IF NOT EXISTS task_history AS
+        SELECT {TASK_SUMMARY_SELECT}, 0 AS archived FROM tasks
+        UNION ALL
+        SELECT {columns}, 1 AS archived FROM task_archive
+        """
+    )
+    _create_indexes(conn, ["idx_tasks_finished", "idx_task_archive_batch"])
 
-def _run_prompt_child_task(task: Task) -> None:
-    if task.parent_writing_id is None:
-        raise ValueError("prompt_child task requires parent_writing_id (writing_id)")
 
-    prompt_text = (task.prompt_text or "").strip()
-    if not prompt_text:
-        raise ValueError("prompt_text is required for prompt_child task")
+def _migrate_task_partial(conn: sqlite3.Connection) -> None:
+    _ensure_columns(conn, "tasks", {"partial": "TEXT"})
 
-    conn = _get_db()
-    cur = conn.cursor()
 
-    # 1) Load the input writing
-    parent = conn.execute(
+def _migrate_task_lanes(conn: sqlite3.Connection) -> None:
+    _ensure_columns(
+        conn,
+        "tasks",
+        {"priority": "TEXT NOT NULL DEFAULT 'interactive'", "fair_key": "TEXT"},
+    )
+    # Same keys _task_fair_key assigns to new tasks.
+    conn.execute(
         """
-        SELECT id, name, description, parent_text_a, parent_text_b
-        FROM writings
-        WHERE id = ?
-        """,
-        (task.parent_writing_id,),
-    ).fetchone()
-    if not parent:
-        conn.close()
-        raise ValueError(f"Writing {task.parent_writing_id} not found")
+        UPDATE tasks
+        SET fair_key = CASE
+            WHEN batch_id IS NOT NULL THEN 'batch:' || batch_id
+            WHEN parent_writing_id IS NOT NULL THEN 'writing:' || parent_writing_id
+            ELSE kind
+        END,
+            priority = CASE WHEN batch_id IS NOT NULL THEN 'bulk' ELSE 'interactive' END
+        WHERE fair_key IS NULL
+        """
+    )
+    _create_indexes(conn, ["idx_tasks_lane"])
 
-    writing_id = int(parent["id"])
-    writing_name = parent["name"] or "(untitled)"
-    writing_desc = parent["description"] or ""
-    parent_text_a = parent["parent_text_a"] or ""
-    parent_text_b = parent["parent_text_b"] or ""
 
-    title_a = _first_line(parent_text_a)
-    title_b = _first_line(parent_text_b)
+# table -> (fts table, indexed columns), kept in sync by triggers
+FTS_TABLES = {
+    "writings": ("writings_fts", ("name", "description", "notes")),
+    "writing_notes": ("writing_notes_fts", ("content",)),
+    "runs": ("runs_fts", ("prompt",)),
+}
 
-    # 2) Build the final prompt to the LLM
-    context_parts: list[str] = []
-    if title_a:
-        context_parts.append(f"{title_a}")
-    if title_b:
-        context_parts.append(f"{title_b}")
-    context_parts.append(f"{writing_name}")
-    if writing_desc:
-        context_parts.append(f"\n{writing_desc}")
 
-    context_block = "\n\n".join(context_parts)
-    final_prompt = prompt_text.strip()
-    if context_block:
-        final_prompt = f"{final_prompt.strip()}\n\n---\n\nTEXT:\n\n{context_block}"
+def _migrate_search_index(conn: sqlite3.Connection) -> None:
+    for table, (fts, columns) in FTS_TABLES.items():
+        if not _table_exists(conn, table):
+            continue
+        column_list = ", ".join(columns)
+        new_values = ", ".join(f"new.{name}" for name in columns)
+        old_values = ", ".join(f"old.{name}" for name in columns)
+        # External-content index: the text lives only in the base table.
+        conn.execute(
+            f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {column_list},
+                content='{table}',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list})
+                VALUES ('delete', old.id, {old_values});
+            END
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column_list} ON {table}
+            BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list})
+                VALUES ('delete', old.id, {old_values});
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (new.id, {new_values});
+            END
+            """
+        )
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
 
-    model_name = "gpt-5-mini-2025-08-07"
-    response = client.responses.parse(
-        model=model_name,
-        input=[
-            {"role": "system", "content": "You are a expert. Complete the task as requested."},
-            {"role": "user", "content": final_prompt},
-        ],
-        text_format=GeneratedChild,
+
+def _migrate_writing_embeddings(conn: sqlite3.Connection) -> None:
+    # writing -> row of the embedding matrix file; source_updated_at is the
+    # writing's updated_at when it was embedded, so edits get re-embedded.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS writing_embeddings (
+            writing_id INTEGER PRIMARY KEY,
+            row INTEGER NOT NULL UNIQUE,
+            source_updated_at TEXT,
+            embedded_at TEXT NOT NULL
+        )
+        """
+    )
+    # Which embedder filled the matrix; version is bumped on every write so
+    # readers in other processes know to reload.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            embedder TEXT,
+            dim INTEGER,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """
     )
+    conn.execute("INSERT OR IGNORE INTO embedding_meta (id, version) VALUES (1, 0)")
+    if _table_exists(conn, "writings"):
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_writings_embedding_delete
+            AFTER DELETE ON writings
+            BEGIN
+                DELETE FROM writing_embeddings WHERE writing_id = old.id;
+                UPDATE embedding_meta SET version = version + 1 WHERE id = 1;
+            END
+            """
+        )
 
-    output: GeneratedChild = response.output_parsed
-    _record_usage(model_name, response)
 
-    # 3) Insert a run row with prompt_id
-    cur.execute(
+def _migrate_writing_changes(conn: sqlite3.Connection) -> None:
+    # Log of writing inserts, deletes and type changes, so in-process caches
+    # keyed by type (WritingSampler) can catch up without rescanning.
+    conn.execute(
         """
-        INSERT INTO runs (
-            instruction,
-            text_a,
-            text_b,
-            parent_writing_id,
-            prompt,
-            response,
-            prompt_id
+        CREATE TABLE IF NOT EXISTS writing_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            writing_id INTEGER NOT NULL,
+            old_type TEXT,
+            new_type TEXT,
+            created_at TEXT NOT NULL
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            "prompt_child",       # instruction label
-            context_block,        # text_a = context we fed in
-            "",                   # text_b unused
-            writing_id,           # parent writing
-            final_prompt,         # full prompt text actually sent to LLM
-            None,                 # response will be filled below
-            task.prompt_id,       # NEW: link back to prompts.id
-        ),
+        """
     )
-    run_id = int(cur.lastrowid)
+    if _table_exists(conn, "writings"):
+        for trigger, event, when, old_type, new_type, writing_id in (
+            ("insert", "INSERT", "", "NULL", "NEW.type", "NEW.id"),
+            ("delete", "DELETE", "", "OLD.type", "NULL", "OLD.id"),
+            ("type", "UPDATE OF type", "WHEN NEW.type IS NOT OLD.type", "OLD.type", "NEW.type", "NEW.id"),
+        ):
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_writings_change_{trigger}
+                AFTER {event} ON writings
+                {when}
+                BEGIN
+                    INSERT INTO writing_changes (writing_id, old_type, new_type, created_at)
+                    VALUES ({writing_id}, {old_type}, {new_type},
+                            strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now'));
+                END
+                """
+            )
+    _create_indexes(conn, ["idx_writing_changes_created"])
 
-    # 4) Create the child writing
-    parent_text_a_for_child = f"{writing_name}\n\n{writing_desc}".strip()
-    child_type = (task.output_type or "").strip() or "words"
 
-    cur.execute(
+def _migrate_writing_closure(conn: sqlite3.Connection) -> None:
+    if not _table_exists(conn, "writings"):
+        return
+    # One row per (ancestor, descendant) pair, including each writing with
+    # itself at depth 0, so subtree and ancestor questions are index range
+    # scans instead of recursive walks.
+    conn.execute(
         """
-        INSERT INTO writings (
-            name,
-            description,
-            parent_run_id,
-            parent_text_a,
-            parent_text_b,
-            parent_writing_id,
-            notes,
-            type
+        CREATE TABLE IF NOT EXISTS writing_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+        """
+    )
+    # Triggers, so every path that adds, moves or deletes a writing keeps
+    # the closure in the same transaction.
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_writings_closure_insert
+        AFTER INSERT ON writings
+        BEGIN
+            INSERT OR IGNORE INTO writing_closure (ancestor_id, descendant_id, depth)
+            VALUES (NEW.id, NEW.id, 0);
+            INSERT OR IGNORE INTO writing_closure (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, NEW.id, depth + 1
+            FROM writing_closure
+            WHERE descendant_id = NEW.parent_writing_id;
+        END
+        """
+    )
+    # Deleting a writing cuts every path through it; descendants left
+    # behind (erase removes them too) become roots of their own subtrees.
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_writings_closure_delete
+        AFTER DELETE ON writings
+        BEGIN
+            DELETE FROM writing_closure
+            WHERE descendant_id IN (
+                    SELECT descendant_id FROM writing_closure WHERE ancestor_id = OLD.id
+                )
+              AND ancestor_id IN (
+                    SELECT ancestor_id FROM writing_closure WHERE descendant_id = OLD.id
+                );
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_writings_closure_cycle
+        BEFORE UPDATE OF parent_writing_id ON writings
+        WHEN NEW.parent_writing_id IN (
+            SELECT descendant_id FROM writing_closure WHERE ancestor_id = OLD.id
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            output.title,
-            output.text,
-            run_id,
-            parent_text_a_for_child,  # parent text A = name + description of input writing
-            "",                       # parent text B = empty per your requirement
-            writing_id,               # parent writing id
-            "",
-            child_type,
-        ),
+        BEGIN
+            SELECT RAISE(ABORT, 'parent_writing_id would create a cycle');
+        END
+        """
     )
-    child_writing_id = int(cur.lastrowid)
-
-    # 5) Create a writing_note pointing at this child writing
-    note_content = f"{output.title}\n\n{output.text}".strip()
-    cur.execute(
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_writings_closure_move
+        AFTER UPDATE OF parent_writing_id ON writings
+        WHEN NEW.parent_writing_id IS NOT OLD.parent_writing_id
+        BEGIN
+            DELETE FROM writing_closure
+            WHERE descendant_id IN (
+                    SELECT descendant_id FROM writing_closure WHERE ancestor_id = NEW.id
+                )
+              AND ancestor_id IN (
+                    SELECT ancestor_id FROM writing_closure
+                    WHERE descendant_id = NEW.id AND ancestor_id <> NEW.id
+                );
+            INSERT OR IGNORE INTO writing_closure (ancestor_id, descendant_id, depth)
+            SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+            FROM writing_closure AS above, writing_closure AS below
+            WHERE above.descendant_id = NEW.parent_writing_id
+              AND below.ancestor_id = NEW.id;
+        END
         """
-        INSERT INTO writing_notes (writing_id, content, child_writing_id)
-        VALUES (?, ?, ?)
-        """,
-        (writing_id, note_content, child_writing_id),
     )
-    note_id = int(cur.lastrowid)  # not used further but useful to keep
-
-    # 6) Save the structured response into the run
-    cur.execute(
+    # Backfill; the depth cap keeps a pre-existing parent cycle finite.
+    conn.execute(
         """
-        UPDATE runs
-        SET response = ?
-        WHERE id = ?
+        INSERT OR IGNORE INTO writing_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM writings
+            UNION ALL
+            SELECT closure.ancestor_id, w.id, closure.depth + 1
+            FROM writings AS w
+            JOIN closure ON w.parent_writing_id = closure.descendant_id
+            WHERE closure.depth < ?
+        )
+        SELECT ancestor_id, descendant_id, MIN(depth)
+        FROM closure
+        GROUP BY ancestor_id, descendant_id
         """,
-        (
-            json.dumps(
-                {
-                    "title": output.title,
-                    "text": output.text,
-                    "child_writing_id": child_writing_id,
-                    "note_id": note_id,
-                }
-            ),
-            run_id,
-        ),
+        (EXPORT_MAX_DEPTH,),
     )
-
-    conn.commit()
-    conn.close()
-
-    task.run_id = run_id
+    _create_indexes(conn, ["idx_writing_closure_descendant"])
 
 
-def _run_gargantua_child_task(task: Task) -> None:
-    if task.parent_writing_id is None:
-        raise ValueError("gargantua_child task requires parent_writing_id (writing_id)")
-    if task.gargantua_id is None:
-        raise ValueError("gargantua_child task requires gargantua_id")
+def _migrate_task_event_old_status(conn: sqlite3.Connection) -> None:
+    # The status a task moved from, so clients keeping per-status counts
+    # can move one task between buckets without knowing its prior state.
+    _ensure_columns(conn, "task_events", {"old_status": "TEXT"})
+    if not _table_exists(conn, "tasks"):
+        return
+    conn.execute("DROP TRIGGER IF EXISTS trg_tasks_event_update")
+    conn.execute(
+        """
+        CREATE TRIGGER trg_tasks_event_update
+        AFTER UPDATE OF status, attempts ON tasks
+        WHEN NEW.status IS NOT OLD.status OR NEW.attempts IS NOT OLD.attempts
+        BEGIN
+            INSERT INTO task_events
+                (task_id, kind, status, old_status, attempts, run_id, error, batch_id, created_at)
+            VALUES
+                (NEW.id, NEW.kind, NEW.status, OLD.status, NEW.attempts, NEW.run_id, NEW.error,
+                 NEW.batch_id, strftime('%Y-%m-%dT%H:%M:%S+00:00', 'now'));
+        END
+        """
+    )
 
-    conn = _get_db()
-    cur = conn.cursor()
 
-    # 1) Load the input writing (same as prompt_child)
-    parent = conn.execute(
+def _migrate_writing_embedding_failures(conn: sqlite3.Connection) -> None:
+    # Writings the embedder rejected, at the version it saw; skipped until
+    # they are edited, so one bad input does not stall the ones after it.
+    conn.execute(
         """
-        SELECT id, name, description, parent_text_a, parent_text_b
-        FROM writings
-        WHERE id = ?
-        """,
-        (task.parent_writing_id,),
-    ).fetchone()
-    if not parent:
-        conn.close()
-        raise ValueError(f"Writing {task.parent_writing_id} not found")
-
-    writing_id = int(parent["id"])
-    writing_name = parent["name"] or "(untitled)"
-    writing_desc = parent["description"] or ""
-    parent_text_a = parent["parent_text_a"] or ""
-    parent_text_b = parent["parent_text_b"] or ""
+        CREATE TABLE IF NOT EXISTS writing_embedding_failures (
+            writing_id INTEGER PRIMARY KEY,
+            source_updated_at TEXT,
+            error TEXT,
+            failed_at TEXT NOT NULL
+        )
+        """
+    )
+    if _table_exists(conn, "writings"):
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_writings_embedding_failure_delete
+            AFTER DELETE ON writings
+            BEGIN
+                DELETE FROM writing_embedding_failures WHERE writing_id = old.id;
+            END
+            """
+        )
 
-    title_a = _first_line(parent_text_a)
-    title_b = _first_line(parent_text_b)
 
-    # Build context_block exactly like before
-    context_parts: list[str] = []
-    if title_a:
-        context_parts.append(f"{title_a}")
-    if title_b:
-        context_parts.append(f"{title_b}")
-    context_parts.append(f"{writing_name}")
-    if writing_desc:
-        context_parts.append(f"\n{writing_desc}")
+def _migrate_usage_cache_columns(conn: sqlite3.Connection) -> None:
+    _ensure_columns(conn, "usage_log", {"cached": "INTEGER NOT NULL DEFAULT 0"})
+    for table in ("usage_daily", "usage_all_time"):
+        _ensure_columns(conn, table, {"cached_tokens": "INTEGER NOT NULL DEFAULT 0"})
 
-    context_block = "\n\n".join(context_parts)
 
-    # 2) Load gargantua row
-    garg = conn.execute(
+def _migrate_usage_rollups(conn: sqlite3.Connection) -> None:
+    _ensure_columns(conn, "usage_log", {"task_kind": "TEXT NOT NULL DEFAULT ''"})
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS usage_rollup (
+            period TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            model TEXT NOT NULL,
+            task_kind TEXT NOT NULL DEFAULT '',
+            tokens_in INTEGER NOT NULL DEFAULT 0,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            cached_tokens INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, period_start, model, task_kind)
+        )
         """
-        SELECT id, name, text, type
-        FROM gargantua
-        WHERE id = ?
-        """,
-        (task.gargantua_id,),
-    ).fetchone()
-    if not garg:
-        conn.close()
-        raise ValueError(f"gargantua {task.gargantua_id} not found")
-
-    garg_text = garg["text"] or ""
-    garg_type = (garg["type"] or "").strip() or "words"
-
-    # 3) Build final prompt using your template
-    final_prompt = GARGANTUA_PROMPT_TEMPLATE.format(
-        gargantua=garg_text,
-        text_input=context_block,
     )
-
-    model_name = "gpt-5-mini-2025-08-07"
-    response = client.responses.parse(
-        model=model_name,
-        input=[
-            {
-                "role": "system",
-                "content": "You are an expert. Complete the task as requested.",
-            },
-            {"role": "user", "content": final_prompt},
-        ],
-        text_format=GeneratedChild,
+    # One row, bumped on every flush; drives /api/usage ETag/Last-Modified.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS usage_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO usage_meta (id, version, updated_at) VALUES (1, 0, ?)",
+        (_now_iso(),),
     )
+    if not _table_exists(conn, "usage_daily"):
+        return
+    # History before task kinds were recorded lands under task_kind ''.
+    # Weeks start on Monday, matching USAGE_PERIODS.
+    for period, start in (
+        ("day", "usage_date"),
+        ("week", "date(usage_date, 'weekday 0', '-6 days')"),
+        ("month", "strftime('%Y-%m-01', usage_date)"),
+    ):
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO usage_rollup
+                (period, period_start, model, task_kind,
+                 tokens_in, tokens_out, total_tokens, cached_tokens, requests)
+            SELECT ?, {start}, d.model, '',
+                   SUM(d.tokens_in), SUM(d.tokens_out), SUM(d.total_tokens),
+                   SUM(COALESCE(d.cached_tokens, 0)), SUM(COALESCE(l.requests, 0))
+            FROM usage_daily AS d
+            LEFT JOIN (
+                SELECT usage_date AS day, model AS log_model, COUNT(*) AS requests
+                FROM usage_log
+                GROUP BY usage_date, model
+            ) AS l ON l.day = d.usage_date AND l.log_model = d.model
+            GROUP BY {start}, d.model
+            """,
+            (period,),
+        )
 
-    output: GeneratedChild = response.output_parsed
-    _record_usage(model_name, response)
 
-    # 4) Insert run row (recording context and gargantua text)
-    cur.execute(
+# (version, name, migrate) per database, applied in order and recorded in
+# that database's schema_migrations table. Never renumber or edit a
+# released migration; add a new one.
+LANG_MIGRATIONS = [
+    (1, "task queue, batches and response cache", _migrate_task_tables),
+    (2, "indexes for hot query predicates", _migrate_hot_indexes),
+    (3, "task status event log", _migrate_task_events),
+    (4, "archive for finished tasks", _migrate_task_archive),
+    (5, "partial output for streamed tasks", _migrate_task_partial),
+    (6, "priority lanes and fair-share keys", _migrate_task_lanes),
+    (7, "full-text search over writings, notes and runs", _migrate_search_index),
+    (8, "writing embeddings", _migrate_writing_embeddings),
+    (9, "writing change log", _migrate_writing_changes),
+    (10, "writing lineage closure table", _migrate_writing_closure),
+    (11, "previous status on task events", _migrate_task_event_old_status),
+    (12, "writing embedding failures", _migrate_writing_embedding_failures),
+]
+USAGE_MIGRATIONS = [
+    (1, "cache-hit accounting columns", _migrate_usage_cache_columns),
+    (2, "task kinds and period rollups", _migrate_usage_rollups),
+]
+
+
+def _applied_migrations(conn: sqlite3.Connection) -> set[int]:
+    if not _table_exists(conn, "schema_migrations"):
+        return set()
+    return {row["version"] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def _run_migrations(conn: sqlite3.Connection, migrations: list) -> None:
+    """
+    Apply pending migrations, each in its own write transaction. The applied
+    set is re-read under the write lock, so concurrent processes starting
+    at once apply each migration exactly once.
+    """
+    conn.execute(
         """
-        INSERT INTO runs (
-            instruction,
-            text_a,
-            text_b,
-            parent_writing_id,
-            prompt,
-            response,
-            prompt_id
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            "gargantua_child",   # instruction
-            context_block,       # text_a = context
-            garg_text,           # text_b = gargantua definition
-            writing_id,
-            final_prompt,        # full prompt sent to LLM
-            None,                # response JSON filled below
-            None,                # no prompt_id (not from prompts table)
-        ),
+        """
     )
-    run_id = int(cur.lastrowid)
+    conn.commit()
+    for version, name, migrate in migrations:
+        if version in _applied_migrations(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version not in _applied_migrations(conn):
+                migrate(conn)
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                    (version, name, _now_iso()),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def _ensure_schema() -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    conn = _get_db()
+    try:
+        _run_migrations(conn, LANG_MIGRATIONS)
+    finally:
+        conn.close()
+    usage_conn = _get_usage_db()
+    try:
+        _run_migrations(usage_conn, USAGE_MIGRATIONS)
+    finally:
+        usage_conn.close()
+    _schema_ready = True
 
-    # 5) Create the child writing; type from gargantua.type
-    parent_text_a_for_child = f"{writing_name}\n\n{writing_desc}".strip()
-    child_type = garg_type
 
-    cur.execute(
-        """
-        INSERT INTO writings (
-            name,
-            description,
-            parent_run_id,
-            parent_text_a,
-            parent_text_b,
-            parent_writing_id,
-            notes,
-            type
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+def _task_from_row(row: sqlite3.Row) -> Task:
+    return Task(**{key: row[key] for key in TASK_COLUMNS})
+
+
+def _prune_task_events() -> None:
+    cutoff = _iso_after(-TASK_EVENT_RETENTION)
+    conn = _get_db()
+    conn.execute("DELETE FROM task_events WHERE created_at < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+
+
+def _prune_writing_changes() -> None:
+    # a sampler that falls behind the pruned log just reloads
+    cutoff = _iso_after(-TASK_EVENT_RETENTION)
+    conn = _get_db()
+    conn.execute("DELETE FROM writing_changes WHERE created_at < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+
+
+def _archive_tasks(limit: int = 5000) -> int:
+    """
+    Move finished tasks past TASK_RETENTION, or beyond the newest
+    TASK_KEEP_FINISHED, into task_archive. Returns how many moved.
+    """
+    final = ", ".join("?" for _ in FINAL_TASK_STATUSES)
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    rows = cur.execute(
+        f"""
+        SELECT id
+        FROM tasks
+        WHERE status IN ({final})
+          AND (
+            COALESCE(finished_at, created_at) < ?
+            OR id < COALESCE((
+                SELECT id
+                FROM tasks
+                WHERE status IN ({final})
+                ORDER BY id DESC
+                LIMIT 1 OFFSET ?
+            ), 0)
+          )
+        ORDER BY id
+        LIMIT ?
         """,
         (
-            output.title,
-            output.text,
-            run_id,
-            parent_text_a_for_child,
-            "",             # parent_text_b empty as before
-            writing_id,
-            "",
-            child_type,     # <-- from gargantua.type
+            *FINAL_TASK_STATUSES,
+            _iso_after(-TASK_RETENTION),
+            *FINAL_TASK_STATUSES,
+            TASK_KEEP_FINISHED - 1,
+            limit,
         ),
-    )
-    child_writing_id = int(cur.lastrowid)
-
-    # 6) writing_note pointing at this child
-    note_content = f"{output.title}\n\n{output.text}".strip()
+    ).fetchall()
+    ids = json.dumps([row["id"] for row in rows])
+    columns = ", ".join(TaskSummary.__slots__)
     cur.execute(
-        """
-        INSERT INTO writing_notes (writing_id, content, child_writing_id)
-        VALUES (?, ?, ?)
+        f"""
+        INSERT OR REPLACE INTO task_archive ({columns}, archived_at)
+        SELECT {TASK_SUMMARY_SELECT}, ?
+        FROM tasks
+        WHERE id IN (SELECT value FROM json_each(?))
         """,
-        (writing_id, note_content, child_writing_id),
+        (_now_iso(), ids),
     )
-    note_id = int(cur.lastrowid)
+    cur.execute("DELETE FROM tasks WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def _notify_task_events() -> None:
+    with _task_events_changed:
+        _task_events_changed.notify_all()
+
+
+def _insert_task(kind: str, **fields) -> int:
+    return _insert_tasks(kind, [fields])[0]
 
-    # 7) Save structured response JSON into run
-    cur.execute(
-        """
-        UPDATE runs
-        SET response = ?
-        WHERE id = ?
-        """,
-        (
-            json.dumps(
-                {
-                    "title": output.title,
-                    "text": output.text,
-                    "child_writing_id": child_writing_id,
-                    "note_id": note_id,
-                    "gargantua_id": task.gargantua_id,
-                }
-            ),
-            run_id,
-        ),
-    )
 
+def _insert_tasks(kind: str, items: list[dict]) -> list[int]:
+    """
+    Insert queued tasks of one kind in a single transaction.
+    """
+    conn = _get_db()
+    cur = conn.cursor()
+    # Take the write lock up front so the duplicate check and the insert
+    # are atomic across processes.
+    cur.execute("BEGIN IMMEDIATE")
+    task_ids, _ = _insert_task_rows(cur, kind, items)
     conn.commit()
     conn.close()
+    _task_wakeup.set()
+    _notify_task_events()
+    return task_ids
 
-    task.run_id = run_id
 
+# Fields that make two tasks of a kind the same piece of work.
+DEDUP_FIELDS: dict[str, tuple[str, ...]] = {
+    "lang": ("text_a", "text_b", "parent_writing_id"),
+    "prompt_child": ("parent_writing_id", "prompt_id", "prompt_text", "output_type"),
+    "gargantua_child": ("parent_writing_id", "gargantua_id"),
+}
+# Statuses in which a task still counts as in flight for deduplication.
+INFLIGHT_STATUSES = ("queued", "running", "submitted")
+# A task in a mode ranked at least as high can stand in for a request in
+# another mode: a stream serves an interactive caller, either serves batch.
+MODE_RANK = {"batch": 0, "interactive": 1, "stream": 2}
+FINAL_TASK_STATUSES = ("done", "error", "dead")
 
-def _extract_usage(response) -> tuple[int, int, int] | None:
-    usage = getattr(response, "usage", None)
-    if not usage:
+
+def _task_dedup_key(kind: str, fields: dict) -> str:
+    values = [kind] + [fields.get(name) for name in DEDUP_FIELDS.get(kind, ())]
+    return hashlib.sha256(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+def _task_fair_key(kind: str, fields: dict, batch_id: int | None) -> str:
+    """
+    Tasks sharing a key are one tenant for fair scheduling: a fan-out batch,
+    else everything spawned from one parent writing, else the kind.
+    """
+    if batch_id is not None:
+        return f"batch:{batch_id}"
+    if fields.get("parent_writing_id") is not None:
+        return f"writing:{fields['parent_writing_id']}"
+    return kind
+
+
+def _insert_task_rows(
+    cur: sqlite3.Cursor,
+    kind: str,
+    items: list[dict],
+    batch_id: int | None = None,
+) -> tuple[list[int], int]:
+    """
+    Insert task rows on an open transaction. An item identical to a task
+    that is already in flight reuses that task's id instead, as long as the
+    task can serve it. A task that is still queued is upgraded to what the
+    new item asks for: the interactive lane, a faster mode, no cache.
+    A task already running or submitted only serves items whose mode ranks
+    no higher and that do not opt out of a cache it uses.
+    Returns (task_ids in item order, number of rows actually inserted).
+    """
+    created_at = _now_iso()
+    inflight = ", ".join("?" for _ in INFLIGHT_STATUSES)
+    task_ids: list[int] = []
+    inserted = 0
+    for fields in items:
+        fields = dict(fields)
+        fields.setdefault("text_a", "")
+        fields.setdefault("text_b", "")
+        fields["dedup_key"] = _task_dedup_key(kind, fields)
+        mode = fields.get("mode", "interactive")
+        use_cache = bool(fields.get("use_cache", True))
+        candidates = cur.execute(
+            f"""
+            SELECT id, status, mode, use_cache
+            FROM tasks
+            WHERE dedup_key = ? AND status IN ({inflight})
+            ORDER BY id
+            """,
+            (fields["dedup_key"], *INFLIGHT_STATUSES),
+        ).fetchall()
+        existing = next(
+            (
+                row
+                for row in candidates
+                if row["status"] == "queued"
+                or (
+                    MODE_RANK[row["mode"]] >= MODE_RANK[mode]
+                    and (use_cache or not row["use_cache"])
+                )
+            ),
+            None,
+        )
+        if existing:
+            task_ids.append(int(existing["id"]))
+            if existing["status"] == "queued":
+                cur.execute(
+                    """
+                    UPDATE tasks
+                    SET mode = ?,
+                        use_cache = use_cache AND ?,
+                        priority = CASE WHEN ? = 'interactive' THEN 'interactive' ELSE priority END
+                    WHERE id = ?
+                    """,
+                    (
+                        max(existing["mode"], mode, key=MODE_RANK.__getitem__),
+                        use_cache,
+                        fields.get("priority", "interactive"),
+                        existing["id"],
+                    ),
+                )
+            elif fields.get("priority", "interactive") == "interactive":
+                cur.execute(
+                    "UPDATE tasks SET priority = 'interactive' WHERE id = ?",
+                    (existing["id"],),
+                )
+            continue
+
+        fields.update(kind=kind, status="queued", created_at=created_at)
+        fields["fair_key"] = _task_fair_key(kind, fields, batch_id)
+        if batch_id is not None:
+            fields["batch_id"] = batch_id
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        cur.execute(
+            f"INSERT INTO tasks ({columns}) VALUES ({placeholders})",
+            tuple(fields.values()),
+        )
+        task_ids.append(int(cur.lastrowid))
+        inserted += 1
+    return task_ids, inserted
+
+
+def _enqueue_task(
+    text_a: str,
+    text_b: str,
+    parent_writing_id: int | None,
+    mode: str = "interactive",
+    use_cache: bool = True,
+    priority: str = "interactive",
+) -> int:
+    return _insert_task(
+        "lang",
+        text_a=text_a,
+        text_b=text_b,
+        parent_writing_id=parent_writing_id,
+        mode=mode,
+        use_cache=use_cache,
+        priority=priority,
+    )
+
+
+def _enqueue_lang_batch(pairs: list[dict]) -> tuple[int, list[int], int]:
+    """
+    Enqueue many lang tasks under one task_batches row, in one transaction.
+    Returns (batch_id, task_ids, created). Pairs that coalesce into tasks
+    already in flight keep those tasks' ids and do not count towards the
+    batch size, which is `created`.
+    """
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute(
+        "INSERT INTO task_batches (kind, size, created_at) VALUES (?, ?, ?)",
+        ("lang", len(pairs), _now_iso()),
+    )
+    batch_id = int(cur.lastrowid)
+    task_ids, inserted = _insert_task_rows(cur, "lang", pairs, batch_id=batch_id)
+    cur.execute("UPDATE task_batches SET size = ? WHERE id = ?", (inserted, batch_id))
+    conn.commit()
+    conn.close()
+    _task_wakeup.set()
+    _notify_task_events()
+    return batch_id, task_ids, inserted
+
+
+def _enqueue_prompt_task(
+    *,
+    writing_id: int,
+    prompt_id: int | None,
+    prompt_text: str,
+    output_type: str | None,
+    mode: str = "interactive",
+    use_cache: bool = True,
+    priority: str = "interactive",
+) -> int:
+    return _insert_task(
+        "prompt_child",
+        parent_writing_id=writing_id,
+        prompt_id=prompt_id,
+        prompt_text=prompt_text,
+        output_type=output_type,
+        mode=mode,
+        use_cache=use_cache,
+        priority=priority,
+    )
+
+def _enqueue_gargantua_task(
+    *,
+    writing_id: int,
+    gargantua_id: int,
+    mode: str = "interactive",
+    use_cache: bool = True,
+    priority: str = "interactive",
+) -> int:
+    return _insert_task(
+        "gargantua_child",
+        parent_writing_id=writing_id,
+        gargantua_id=gargantua_id,
+        mode=mode,
+        use_cache=use_cache,
+        priority=priority,
+    )
+
+
+def _bury_expired_tasks(
+    conn: sqlite3.Connection, now: str, llm_batch_id: int | None = None
+) -> int:
+    """
+    Park as 'dead' the running tasks whose lease expired after they used
+    up their kind's max_attempts: the worker crashed or hung on them every
+    time, so claiming them again would only repeat that. Looks at tasks
+    outside any Batch API batch, or at those of llm_batch_id. Returns how many.
+    """
+    max_attempts = " ".join(
+        f"WHEN {kind!r} THEN {policy.max_attempts}" for kind, policy in RETRY_POLICIES.items()
+    )
+    cur = conn.execute(
+        f"""
+        UPDATE tasks
+        SET status = 'dead',
+            error = 'lease expired on attempt ' || attempts,
+            errors = json_insert(
+                COALESCE(errors, '[]'), '$[#]',
+                json_object('at', ?, 'attempt', attempts, 'error', 'lease expired')
+            ),
+            finished_at = ?,
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        WHERE status = 'running'
+          AND lease_expires_at < ?
+          AND llm_batch_id IS ?
+          AND attempts >= CASE kind {max_attempts} ELSE {DEFAULT_RETRY_POLICY.max_attempts} END
+        """,
+        (now, now, now, llm_batch_id),
+    )
+    return cur.rowcount
+
+
+def _claim_next_task(allow_bulk: bool = True) -> Task | None:
+    """
+    Atomically lease the next runnable task to this worker.
+
+    Runnable means queued and past any retry backoff, or running under a
+    lease that was not renewed in time (the owning worker is gone).
+    Interactive tasks go first. Within a lane the pick is the oldest task
+    of the group (fair_key) with the fewest tasks running right now, so
+    batches and parents share the workers instead of draining in FIFO order.
+    Expired leases with no attempts left are buried instead of re-claimed.
+    """
+    now = _now_iso()
+    conn = _get_db()
+    buried = _bury_expired_tasks(conn, now)
+    row = conn.execute(
+        """
+        UPDATE tasks
+        SET status = 'running',
+            started_at = ?,
+            lease_owner = ?,
+            lease_expires_at = ?,
+            attempts = attempts + 1
+        WHERE id = (
+            SELECT t.id
+            FROM tasks AS t
+            LEFT JOIN (
+                SELECT fair_key, COUNT(*) AS running
+                FROM tasks
+                WHERE status = 'running'
+                GROUP BY fair_key
+            ) AS load ON load.fair_key IS t.fair_key
+            WHERE t.mode IN ('interactive', 'stream')
+              AND (? OR t.priority = 'interactive')
+              AND (
+                (t.status = 'queued' AND (t.available_at IS NULL OR t.available_at <= ?))
+                OR (t.status = 'running' AND t.lease_expires_at < ?)
+              )
+            ORDER BY t.priority = 'bulk', COALESCE(load.running, 0), t.id
+            LIMIT 1
+        )
+        RETURNING *
+        """,
+        (now, WORKER_ID, _iso_after(LEASE_SECONDS), allow_bulk, now, now),
+    ).fetchone()
+    conn.commit()
+    conn.close()
+    if buried or row:
+        _notify_task_events()
+    if not row:
+        return None
+    return _task_from_row(row)
+
+
+def _complete_task(task: Task, status: str, error: str | None = None) -> None:
+    conn = _get_db()
+    conn.execute(
+        """
+        UPDATE tasks
+        SET status = ?,
+            error = ?,
+            run_id = ?,
+            finished_at = ?,
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        WHERE id = ? AND lease_owner = ?
+        """,
+        (status, error, task.run_id, _now_iso(), task.id, WORKER_ID),
+    )
+    conn.commit()
+    conn.close()
+    _notify_task_events()
+
+
+def _fail_task(task: Task, exc: BaseException) -> None:
+    """
+    Record a failed attempt. Retryable failures go back to the queue after
+    a backoff until the kind's max_attempts is used up, then the task is
+    parked as 'dead'; other failures are final ('error').
+    """
+    error = f"{type(exc).__name__}: {exc}"
+    history = json.loads(task.errors or "[]")
+    history.append({"at": _now_iso(), "attempt": task.attempts, "error": error})
+    history = history[-MAX_ERROR_HISTORY:]
+
+    policy = RETRY_POLICIES.get(task.kind, DEFAULT_RETRY_POLICY)
+    if not isinstance(exc, RETRYABLE_ERRORS):
+        status, available_at = "error", None
+    elif task.attempts >= policy.max_attempts:
+        status, available_at = "dead", None
+    else:
+        status, available_at = "queued", _iso_after(policy.delay(task.attempts))
+
+    conn = _get_db()
+    conn.execute(
+        """
+        UPDATE tasks
+        SET status = ?,
+            error = ?,
+            errors = ?,
+            available_at = ?,
+            finished_at = ?,
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        WHERE id = ? AND lease_owner = ?
+        """,
+        (
+            status,
+            error,
+            json.dumps(history),
+            available_at,
+            None if status == "queued" else _now_iso(),
+            task.id,
+            WORKER_ID,
+        ),
+    )
+    conn.commit()
+    conn.close()
+    _notify_task_events()
+    if status == "queued":
+        _task_wakeup.set()
+
+
+def _requeue_task(task_id: int) -> bool:
+    """
+    Put a dead or errored task back in the queue with a fresh attempt budget.
+    """
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        UPDATE tasks
+        SET status = 'queued',
+            attempts = 0,
+            available_at = NULL,
+            finished_at = NULL
+        WHERE id = ? AND status IN ('dead', 'error')
+        """,
+        (task_id,),
+    )
+    conn.commit()
+    requeued = cur.rowcount
+    conn.close()
+    if requeued:
+        _task_wakeup.set()
+        _notify_task_events()
+    return bool(requeued)
+
+
+def _track_tasks(task_ids) -> None:
+    with _inflight_lock:
+        _inflight_tasks.update(task_ids)
+
+
+def _untrack_tasks(task_ids) -> None:
+    with _inflight_lock:
+        _inflight_tasks.difference_update(task_ids)
+
+
+def _renew_leases() -> None:
+    with _inflight_lock:
+        task_ids = json.dumps(sorted(_inflight_tasks))
+    conn = _get_db()
+    conn.execute(
+        """
+        UPDATE tasks
+        SET lease_expires_at = ?
+        WHERE status = 'running'
+          AND lease_owner = ?
+          AND id IN (SELECT value FROM json_each(?))
+        """,
+        (_iso_after(LEASE_SECONDS), WORKER_ID, task_ids),
+    )
+    conn.commit()
+    conn.close()
+
+
+@dataclass
+class LLMCall:
+    """
+    Everything a task needs from the model: the request to send and the
+    context its save step uses to write the result.
+    """
+    model: str
+    system: str
+    prompt: str
+    text_format: type[BaseModel]
+    context: dict
+
+
+async def _run_task(task: Task) -> None:
+    prepare, save = TASK_HANDLERS.get(task.kind, TASK_HANDLERS["lang"])
+    call = await asyncio.to_thread(prepare, task)
+
+    cached = await asyncio.to_thread(_cache_lookup, call) if task.use_cache else None
+    if cached is not None:
+        output, response = cached
+        _record_usage(call.model, response, cached=True, task_kind=task.kind)
+        await _write(save, task, call, output)
+        return
+
+    limiter = await _rate_limiter(call.model)
+    estimated = limiter.estimate(call)
+    async with _model_slot(call.model):
+        await limiter.acquire(estimated)
+        try:
+            if task.mode == "stream":
+                response = await _stream_response(task, call)
+            else:
+                raw = await aclient.responses.with_raw_response.parse(
+                    model=call.model,
+                    input=_call_input(call),
+                    text_format=call.text_format,
+                )
+        except openai.RateLimitError as exc:
+            limiter.pause(exc.response.headers)
+            raise
+        if task.mode != "stream":
+            # The stream helper does not surface response headers; streamed
+            # calls rely on the local buckets until the next header sync.
+            limiter.update_from_headers(raw.headers)
+            response = raw.parse()
+
+    limiter.observe(call, estimated, _extract_usage(response))
+    output = response.output_parsed
+    if output is None:
+        raise LLMOutputError(f"{call.model} returned no parsed {call.text_format.__name__}")
+    _record_usage(call.model, response, task_kind=task.kind)
+    await _write(_cache_store, call, output, response)
+    await _write(save, task, call, output)
+
+
+async def _stream_response(task: Task, call: LLMCall):
+    """
+    Run `call` as a streamed response, saving the output received so far
+    to tasks.partial at most every STREAM_FLUSH_INTERVAL seconds.
+    """
+    parts: list[str] = []
+    last_flush = 0.0
+    async with aclient.responses.stream(
+        model=call.model,
+        input=_call_input(call),
+        text_format=call.text_format,
+    ) as stream:
+        async for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            parts.append(event.delta)
+            if time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                await _write(_save_partial, task.id, "".join(parts))
+                last_flush = time.monotonic()
+        response = await stream.get_final_response()
+    await _write(_save_partial, task.id, "".join(parts))
+    return response
+
+
+def _save_partial(task_id: int, partial: str) -> None:
+    conn = _get_db()
+    conn.execute("UPDATE tasks SET partial = ? WHERE id = ?", (partial, task_id))
+    conn.commit()
+    conn.close()
+    _notify_task_events()
+
+
+_PARTIAL_STRING_FIELD = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)', re.S)
+
+
+def _partial_json_fields(raw: str | None) -> dict[str, str]:
+    """
+    Best-effort string fields from a JSON object that is still being
+    generated, e.g. '{"title": "Foo", "text": "Once up' -> title and text.
+    """
+    fields: dict[str, str] = {}
+    for name, value in _PARTIAL_STRING_FIELD.findall(raw or ""):
+        # drop an escape sequence cut off mid-way
+        value = re.sub(r"\\u[0-9a-fA-F]{0,3}$", "", value)
+        try:
+            fields[name] = json.loads(f'"{value}"')
+        except ValueError:
+            fields[name] = value
+    return fields
+
+
+def _prepare_lang_task(task: Task) -> LLMCall:
+    text_input = INSTRUCTION_TEMPLATE.format(
+        text_a=task.text_a,
+        text_b=task.text_b,
+    ).strip()
+
+    return LLMCall(
+        model="gpt-5-mini-2025-08-07",
+        system="You are an expert idea generator.",
+        prompt=text_input,
+        text_format=IdeaSet,
+        context={},
+    )
+
+
+def _save_lang_task(task: Task, call: LLMCall, idea_set: IdeaSet) -> None:
+    conn = _get_db()
+    cur = conn.cursor()
+
+    # 1) Insert run row (prompt_id left NULL)
+    cur.execute(
+        """
+        INSERT INTO runs (instruction, text_a, text_b, parent_writing_id, prompt, response)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (INSTRUCTION_TEMPLATE, task.text_a, task.text_b, task.parent_writing_id, call.prompt, None),
+    )
+    run_id = cur.lastrowid
+
+    # 2) Create writings for each idea (this is what you already have)
+    enriched_ideas: list[dict] = []
+    for idea in idea_set.ideas:
+        cur.execute(
+            """
+            INSERT INTO writings (
+                name,
+                description,
+                parent_run_id,
+                parent_text_a,
+                parent_text_b,
+                parent_writing_id,
+                notes,
+                type
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                idea.name,
+                idea.desciription,
+                run_id,
+                task.text_a,
+                task.text_b,
+                task.parent_writing_id,
+                "",
+                "words",
+            ),
+        )
+        writing_id = int(cur.lastrowid)
+        idea_dict = idea.model_dump()
+        idea_dict["writing_id"] = writing_id
+        enriched_ideas.append(idea_dict)
+
+    # 3) Store response JSON
+    cur.execute(
+        """
+        UPDATE runs
+        SET response = ?
+        WHERE id = ?
+        """,
+        (json.dumps({"ideas": enriched_ideas}), run_id),
+    )
+    conn.commit()
+    conn.close()
+
+    task.run_id = run_id
+
+def _first_line(text: str | None) -> str:
+    if not text:
+        return ""
+    return (text.splitlines()[0] or "").strip()
+
+
+def _load_writing_context(conn: sqlite3.Connection, writing_id: int) -> dict:
+    """
+    Load the input writing for a child task and build the context block
+    fed to the model (titles of its parent texts, then name/description).
+    """
+    parent = conn.execute(
+        """
+        SELECT id, name, description, parent_text_a, parent_text_b
+        FROM writings
+        WHERE id = ?
+        """,
+        (writing_id,),
+    ).fetchone()
+    if not parent:
+        raise ValueError(f"Writing {writing_id} not found")
+
+    writing_name = parent["name"] or "(untitled)"
+    writing_desc = parent["description"] or ""
+    parent_text_a = parent["parent_text_a"] or ""
+    parent_text_b = parent["parent_text_b"] or ""
+
+    title_a = _first_line(parent_text_a)
+    title_b = _first_line(parent_text_b)
+
+    context_parts: list[str] = []
+    if title_a:
+        context_parts.append(f"{title_a}")
+    if title_b:
+        context_parts.append(f"{title_b}")
+    context_parts.append(f"{writing_name}")
+    if writing_desc:
+        context_parts.append(f"\n{writing_desc}")
+
+    return {
+        "writing_id": int(parent["id"]),
+        "writing_name": writing_name,
+        "writing_desc": writing_desc,
+        "context_block": "\n\n".join(context_parts),
+    }
+
+
+def _prepare_prompt_child_task(task: Task) -> LLMCall:
+    if task.parent_writing_id is None:
+        raise ValueError("prompt_child task requires parent_writing_id (writing_id)")
+
+    prompt_text = (task.prompt_text or "").strip()
+    if not prompt_text:
+        raise ValueError("prompt_text is required for prompt_child task")
+
+    # 1) Load the input writing
+    conn = _get_db()
+    try:
+        context = _load_writing_context(conn, task.parent_writing_id)
+    finally:
+        conn.close()
+
+    # 2) Build the final prompt to the LLM
+    context_block = context["context_block"]
+    final_prompt = prompt_text.strip()
+    if context_block:
+        final_prompt = f"{final_prompt.strip()}\n\n---\n\nTEXT:\n\n{context_block}"
+
+    return LLMCall(
+        model="gpt-5-mini-2025-08-07",
+        system="You are a expert. Complete the task as requested.",
+        prompt=final_prompt,
+        text_format=GeneratedChild,
+        context=context,
+    )
+
+
+def _save_prompt_child_task(task: Task, call: LLMCall, output: GeneratedChild) -> None:
+    writing_id = call.context["writing_id"]
+    writing_name = call.context["writing_name"]
+    writing_desc = call.context["writing_desc"]
+    context_block = call.context["context_block"]
+
+    conn = _get_db()
+    cur = conn.cursor()
+
+    # 3) Insert a run row with prompt_id
+    cur.execute(
+        """
+        INSERT INTO runs (
+            instruction,
+            text_a,
+            text_b,
+            parent_writing_id,
+            prompt,
+            response,
+            prompt_id
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            "prompt_child",       # instruction label
+            context_block,        # text_a = context we fed in
+            "",                   # text_b unused
+            writing_id,           # parent writing
+            call.prompt,          # full prompt text actually sent to LLM
+            None,                 # response will be filled below
+            task.prompt_id,       # NEW: link back to prompts.id
+        ),
+    )
+    run_id = int(cur.lastrowid)
+
+    # 4) Create the child writing
+    parent_text_a_for_child = f"{writing_name}\n\n{writing_desc}".strip()
+    child_type = (task.output_type or "").strip() or "words"
+
+    cur.execute(
+        """
+        INSERT INTO writings (
+            name,
+            description,
+            parent_run_id,
+            parent_text_a,
+            parent_text_b,
+            parent_writing_id,
+            notes,
+            type
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            output.title,
+            output.text,
+            run_id,
+            parent_text_a_for_child,  # parent text A = name + description of input writing
+            "",                       # parent text B = empty per your requirement
+            writing_id,               # parent writing id
+            "",
+            child_type,
+        ),
+    )
+    child_writing_id = int(cur.lastrowid)
+
+    # 5) Create a writing_note pointing at this child writing
+    note_content = f"{output.title}\n\n{output.text}".strip()
+    cur.execute(
+        """
+        INSERT INTO writing_notes (writing_id, content, child_writing_id)
+        VALUES (?, ?, ?)
+        """,
+        (writing_id, note_content, child_writing_id),
+    )
+    note_id = int(cur.lastrowid)  # not used further but useful to keep
+
+    # 6) Save the structured response into the run
+    cur.execute(
+        """
+        UPDATE runs
+        SET response = ?
+        WHERE id = ?
+        """,
+        (
+            json.dumps(
+                {
+                    "title": output.title,
+                    "text": output.text,
+                    "child_writing_id": child_writing_id,
+                    "note_id": note_id,
+                }
+            ),
+            run_id,
+        ),
+    )
+
+    conn.commit()
+    conn.close()
+
+    task.run_id = run_id
+
+
+def _prepare_gargantua_child_task(task: Task) -> LLMCall:
+    if task.parent_writing_id is None:
+        raise ValueError("gargantua_child task requires parent_writing_id (writing_id)")
+    if task.gargantua_id is None:
+        raise ValueError("gargantua_child task requires gargantua_id")
+
+    conn = _get_db()
+    try:
+        # 1) Load the input writing (same as prompt_child)
+        context = _load_writing_context(conn, task.parent_writing_id)
+
+        # 2) Load gargantua row
+        garg = conn.execute(
+            """
+            SELECT id, name, text, type
+            FROM gargantua
+            WHERE id = ?
+            """,
+            (task.gargantua_id,),
+        ).fetchone()
+    finally:
+        conn.close()
+    if not garg:
+        raise ValueError(f"gargantua {task.gargantua_id} not found")
+
+    context["garg_text"] = garg["text"] or ""
+    context["garg_type"] = (garg["type"] or "").strip() or "words"
+
+    # 3) Build final prompt using your template
+    final_prompt = GARGANTUA_PROMPT_TEMPLATE.format(
+        gargantua=context["garg_text"],
+        text_input=context["context_block"],
+    )
+
+    return LLMCall(
+        model="gpt-5-mini-2025-08-07",
+        system="You are an expert. Complete the task as requested.",
+        prompt=final_prompt,
+        text_format=GeneratedChild,
+        context=context,
+    )
+
+
+def _save_gargantua_child_task(task: Task, call: LLMCall, output: GeneratedChild) -> None:
+    writing_id = call.context["writing_id"]
+    writing_name = call.context["writing_name"]
+    writing_desc = call.context["writing_desc"]
+    context_block = call.context["context_block"]
+    garg_text = call.context["garg_text"]
+
+    conn = _get_db()
+    cur = conn.cursor()
+
+    # 4) Insert run row (recording context and gargantua text)
+    cur.execute(
+        """
+        INSERT INTO runs (
+            instruction,
+            text_a,
+            text_b,
+            parent_writing_id,
+            prompt,
+            response,
+            prompt_id
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            "gargantua_child",   # instruction
+            context_block,       # text_a = context
+            garg_text,           # text_b = gargantua definition
+            writing_id,
+            call.prompt,         # full prompt sent to LLM
+            None,                # response JSON filled below
+            None,                # no prompt_id (not from prompts table)
+        ),
+    )
+    run_id = int(cur.lastrowid)
+
+    # 5) Create the child writing; type from gargantua.type
+    parent_text_a_for_child = f"{writing_name}\n\n{writing_desc}".strip()
+    child_type = call.context["garg_type"]
+
+    cur.execute(
+        """
+        INSERT INTO writings (
+            name,
+            description,
+            parent_run_id,
+            parent_text_a,
+            parent_text_b,
+            parent_writing_id,
+            notes,
+            type
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            output.title,
+            output.text,
+            run_id,
+            parent_text_a_for_child,
+            "",             # parent_text_b empty as before
+            writing_id,
+            "",
+            child_type,     # <-- from gargantua.type
+        ),
+    )
+    child_writing_id = int(cur.lastrowid)
+
+    # 6) writing_note pointing at this child
+    note_content = f"{output.title}\n\n{output.text}".strip()
+    cur.execute(
+        """
+        INSERT INTO writing_notes (writing_id, content, child_writing_id)
+        VALUES (?, ?, ?)
+        """,
+        (writing_id, note_content, child_writing_id),
+    )
+    note_id = int(cur.lastrowid)
+
+    # 7) Save structured response JSON into run
+    cur.execute(
+        """
+        UPDATE runs
+        SET response = ?
+        WHERE id = ?
+        """,
+        (
+            json.dumps(
+                {
+                    "title": output.title,
+                    "text": output.text,
+                    "child_writing_id": child_writing_id,
+                    "note_id": note_id,
+                    "gargantua_id": task.gargantua_id,
+                }
+            ),
+            run_id,
+        ),
+    )
+
+    conn.commit()
+    conn.close()
+
+    task.run_id = run_id
+
+
+def _cache_key(call: LLMCall) -> str:
+    schema = call.text_format.model_json_schema()
+    payload = json.dumps([call.model, call.system, call.prompt, schema], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_lookup(call: LLMCall) -> tuple[BaseModel, SimpleNamespace] | None:
+    """
+    Return (parsed output, response-like object carrying the original usage)
+    for a fresh cache entry, or None on a miss. The hit is recorded on the
+    writer thread without waiting for it.
+    """
+    key = _cache_key(call)
+    conn = _get_db()
+    row = conn.execute(
+        """
+        SELECT output, tokens_in, tokens_out, total_tokens
+        FROM llm_cache
+        WHERE key = ? AND created_at >= ?
+        """,
+        (key, _iso_after(-LLM_CACHE_TTL)),
+    ).fetchone()
+    conn.close()
+    if not row:
+        return None
+    _db_writer.submit(_cache_touch, key, _now_iso())
+
+    try:
+        output = call.text_format.model_validate_json(row["output"])
+    except ValidationError:
+        return None
+    usage = SimpleNamespace(
+        input_tokens=row["tokens_in"],
+        output_tokens=row["tokens_out"],
+        total_tokens=row["total_tokens"],
+    )
+    return output, SimpleNamespace(usage=usage)
+
+
+def _cache_store(call: LLMCall, output: BaseModel, response) -> None:
+    tokens_in, tokens_out, total_tokens = _extract_usage(response) or (0, 0, 0)
+    now = _now_iso()
+    conn = _get_db()
+    conn.execute(
+        """
+        INSERT INTO llm_cache (
+            key, model, output, tokens_in, tokens_out, total_tokens, created_at, last_hit_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+          output = excluded.output,
+          tokens_in = excluded.tokens_in,
+          tokens_out = excluded.tokens_out,
+          total_tokens = excluded.total_tokens,
+          created_at = excluded.created_at,
+          last_hit_at = excluded.last_hit_at
+        """,
+        (
+            _cache_key(call),
+            call.model,
+            output.model_dump_json(),
+            tokens_in,
+            tokens_out,
+            total_tokens,
+            now,
+            now,
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _cache_touch(key: str, hit_at: str) -> None:
+    conn = _get_db()
+    conn.execute(
+        "UPDATE llm_cache SET last_hit_at = ?, hits = hits + 1 WHERE key = ?",
+        (hit_at, key),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _evict_llm_cache() -> None:
+    """
+    Drop expired entries, then the least recently used beyond
+    LLM_CACHE_MAX_ENTRIES. Runs from the checkpoint loop rather than on
+    every store, so the cache may overshoot its cap until the next pass.
+    """
+    conn = _get_db()
+    conn.execute(
+        "DELETE FROM llm_cache WHERE created_at < ?",
+        (_iso_after(-LLM_CACHE_TTL),),
+    )
+    conn.execute(
+        """
+        DELETE FROM llm_cache
+        WHERE key IN (
+            SELECT key
+            FROM llm_cache
+            ORDER BY last_hit_at DESC
+            LIMIT -1 OFFSET ?
+        )
+        """,
+        (LLM_CACHE_MAX_ENTRIES,),
+    )
+    conn.commit()
+    conn.close()
+
+
+# kind -> (prepare, save); prepare reads inputs and builds the LLM call,
+# save writes runs/writings/notes from the parsed output.
+TASK_HANDLERS = {
+    "lang": (_prepare_lang_task, _save_lang_task),
+    "prompt_child": (_prepare_prompt_child_task, _save_prompt_child_task),
+    "gargantua_child": (_prepare_gargantua_child_task, _save_gargantua_child_task),
+}
+
+
+TEXT_FORMATS: dict[str, type[BaseModel]] = {
+    "IdeaSet": IdeaSet,
+    "GeneratedChild": GeneratedChild,
+}
+
+BATCH_PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+def _call_input(call: LLMCall) -> list[dict]:
+    return [
+        {"role": "system", "content": call.system},
+        {"role": "user", "content": call.prompt},
+    ]
+
+
+def _serialize_call(call: LLMCall) -> str:
+    return json.dumps(
+        {
+            "model": call.model,
+            "system": call.system,
+            "prompt": call.prompt,
+            "text_format": call.text_format.__name__,
+            "context": call.context,
+        }
+    )
+
+
+def _deserialize_call(raw: str) -> LLMCall:
+    data = json.loads(raw)
+    data["text_format"] = TEXT_FORMATS[data["text_format"]]
+    return LLMCall(**data)
+
+
+def _strict_json_schema(schema: dict) -> dict:
+    """
+    Tighten a pydantic JSON schema for structured outputs: every object is
+    closed and lists all of its properties as required.
+    """
+    schema.pop("default", None)
+    if schema.get("type") == "object":
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema.get("properties", {}))
+    for key in ("properties", "$defs"):
+        for sub in schema.get(key, {}).values():
+            _strict_json_schema(sub)
+    if isinstance(schema.get("items"), dict):
+        _strict_json_schema(schema["items"])
+    for sub in schema.get("anyOf", []):
+        _strict_json_schema(sub)
+    return schema
+
+
+def _text_format_param(text_format: type[BaseModel]) -> dict:
+    return {
+        "format": {
+            "type": "json_schema",
+            "name": text_format.__name__,
+            "schema": _strict_json_schema(text_format.model_json_schema()),
+            "strict": True,
+        }
+    }
+
+
+def _response_output_text(body: dict) -> str:
+    parts: list[str] = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text") or "")
+    return "".join(parts)
+
+
+def _claim_batch_tasks(limit: int) -> list[Task]:
+    """
+    Lease queued batch-mode tasks for submission (plus any whose submission
+    was interrupted before they were handed to the provider, unless that
+    used up their attempts).
+    """
+    now = _now_iso()
+    conn = _get_db()
+    buried = _bury_expired_tasks(conn, now)
+    rows = conn.execute(
+        """
+        UPDATE tasks
+        SET status = 'running',
+            started_at = ?,
+            lease_owner = ?,
+            lease_expires_at = ?,
+            attempts = attempts + 1
+        WHERE id IN (
+            SELECT id
+            FROM tasks
+            WHERE mode = 'batch'
+              AND (
+                (status = 'queued' AND (available_at IS NULL OR available_at <= ?))
+                OR (status = 'running' AND lease_expires_at < ? AND llm_batch_id IS NULL)
+              )
+            ORDER BY id
+            LIMIT ?
+        )
+        RETURNING *
+        """,
+        (now, WORKER_ID, _iso_after(LEASE_SECONDS), now, now, limit),
+    ).fetchall()
+    conn.commit()
+    conn.close()
+    if buried or rows:
+        _notify_task_events()
+    return [_task_from_row(row) for row in rows]
+
+
+def _submit_llm_batch() -> int | None:
+    """
+    Send every pending batch-mode task to the Batch API as one JSONL file.
+    Returns the llm_batches id, or None if there was nothing to submit.
+    """
+    claimed = _claim_batch_tasks(BATCH_MAX_TASKS)
+    _track_tasks(task.id for task in claimed)
+    try:
+        return _submit_claimed_tasks(claimed)
+    finally:
+        _untrack_tasks(task.id for task in claimed)
+
+
+def _submit_claimed_tasks(claimed: list[Task]) -> int | None:
+    prepared: list[Task] = []
+    lines: list[str] = []
+    for task in claimed:
+        prepare, _ = TASK_HANDLERS.get(task.kind, TASK_HANDLERS["lang"])
+        try:
+            call = prepare(task)
+            cached = _cache_lookup(call) if task.use_cache else None
+            if cached is not None:
+                output, response = cached
+                _record_usage(call.model, response, cached=True, task_kind=task.kind)
+                _, save = TASK_HANDLERS.get(task.kind, TASK_HANDLERS["lang"])
+                save(task, call, output)
+                _complete_task(task, "done")
+                continue
+        except Exception as exc:
+            _fail_task(task, exc)
+            continue
+        task.llm_request = _serialize_call(call)
+        prepared.append(task)
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": f"task-{task.id}",
+                    "method": "POST",
+                    "url": "/v1/responses",
+                    "body": {
+                        "model": call.model,
+                        "input": _call_input(call),
+                        "text": _text_format_param(call.text_format),
+                    },
+                }
+            )
+        )
+    if not prepared:
+        return None
+
+    # Tie the tasks to an llm_batches row before anything is sent, so they
+    # can never be claimed for a second submission once the provider may
+    # have the batch.
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO llm_batches (provider_batch_id, status, size, created_at)
+        VALUES ('', 'creating', ?, ?)
+        """,
+        (len(prepared), _now_iso()),
+    )
+    llm_batch_id = int(cur.lastrowid)
+    cur.executemany(
+        """
+        UPDATE tasks
+        SET llm_batch_id = ?,
+            llm_request = ?
+        WHERE id = ? AND lease_owner = ?
+        """,
+        [(llm_batch_id, task.llm_request, task.id, WORKER_ID) for task in prepared],
+    )
+    conn.commit()
+    conn.close()
+
+    try:
+        input_file = batch_client.files.create(
+            file=("tasks.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = batch_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h",
+            metadata={"llm_batch_id": str(llm_batch_id)},
+        )
+    except Exception as exc:
+        _abandon_llm_batch(llm_batch_id, f"{type(exc).__name__}: {exc}")
+        for task in prepared:
+            _fail_task(task, exc)
+        return None
+
+    _record_llm_batch(llm_batch_id, batch)
+    return llm_batch_id
+
+
+def _record_llm_batch(llm_batch_id: int, batch) -> None:
+    """
+    Store the provider's batch id and mark its tasks submitted. Retried,
+    since the batch is already paid for; if it still fails, the row stays
+    'creating' and _recover_llm_batches finds the batch by its metadata.
+    """
+    for attempt in range(OUTCOME_WRITE_ATTEMPTS):
+        conn = _get_db()
+        try:
+            conn.execute(
+                """
+                UPDATE llm_batches
+                SET provider_batch_id = ?, status = ?, input_file_id = ?
+                WHERE id = ?
+                """,
+                (batch.id, batch.status, batch.input_file_id, llm_batch_id),
+            )
+            conn.execute(
+                """
+                UPDATE tasks
+                SET status = 'submitted',
+                    lease_owner = NULL,
+                    lease_expires_at = NULL
+                WHERE llm_batch_id = ? AND status = 'running'
+                """,
+                (llm_batch_id,),
+            )
+            conn.commit()
+            return
+        except sqlite3.Error:
+            conn.rollback()
+            if attempt == OUTCOME_WRITE_ATTEMPTS - 1:
+                app.logger.exception(
+                    "could not record provider batch %s for llm batch %s", batch.id, llm_batch_id
+                )
+                return
+            time.sleep(2**attempt)
+        finally:
+            conn.close()
+
+
+def _abandon_llm_batch(llm_batch_id: int, error: str) -> None:
+    """
+    The provider never got this batch: detach its tasks so they can be
+    submitted again.
+    """
+    conn = _get_db()
+    conn.execute(
+        "UPDATE tasks SET llm_batch_id = NULL WHERE llm_batch_id = ? AND status = 'running'",
+        (llm_batch_id,),
+    )
+    conn.execute(
+        "UPDATE llm_batches SET status = 'abandoned', error = ?, completed_at = ? WHERE id = ?",
+        (error, _now_iso(), llm_batch_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _recover_llm_batches() -> None:
+    """
+    Settle llm_batches rows left 'creating' by a submitter that died or
+    could not record the result: adopt the provider batch carrying the
+    row's id in its metadata, or else put the tasks back in the queue.
+    """
+    conn = _get_db()
+    rows = conn.execute(
+        """
+        SELECT id
+        FROM llm_batches
+        WHERE status = 'creating' AND created_at < ?
+        """,
+        (_iso_after(-BATCH_CREATE_TIMEOUT),),
+    ).fetchall()
+    conn.close()
+    for row in rows:
+        found = next(
+            (
+                batch
+                for batch in itertools.islice(batch_client.batches.list(limit=100), 1000)
+                if (batch.metadata or {}).get("llm_batch_id") == str(row["id"])
+            ),
+            None,
+        )
+        if found is not None:
+            _record_llm_batch(row["id"], found)
+            continue
+        conn = _get_db()
+        conn.execute(
+            """
+            UPDATE tasks
+            SET status = 'queued',
+                llm_batch_id = NULL,
+                attempts = MAX(attempts - 1, 0),
+                started_at = NULL,
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE llm_batch_id = ? AND status = 'running'
+            """,
+            (row["id"],),
+        )
+        conn.execute(
+            "UPDATE llm_batches SET status = 'abandoned', error = ?, completed_at = ? WHERE id = ?",
+            ("never reached the provider", _now_iso(), row["id"]),
+        )
+        conn.commit()
+        conn.close()
+
+
+def _claim_submitted_tasks(llm_batch_id: int) -> list[Task]:
+    """
+    Lease a finished batch's tasks for collection: those still waiting on
+    it, and those whose collector's lease expired. Taking over an expired
+    lease costs an attempt, so a task that keeps killing its collector
+    ends up 'dead' like any other.
+    """
+    now = _now_iso()
+    conn = _get_db()
+    buried = _bury_expired_tasks(conn, now, llm_batch_id)
+    rows = conn.execute(
+        """
+        UPDATE tasks
+        SET status = 'running',
+            lease_owner = ?,
+            lease_expires_at = ?,
+            attempts = attempts + (status = 'running')
+        WHERE llm_batch_id = ?
+          AND (status = 'submitted' OR (status = 'running' AND lease_expires_at < ?))
+        RETURNING *
+        """,
+        (WORKER_ID, _iso_after(LEASE_SECONDS), llm_batch_id, now),
+    ).fetchall()
+    conn.commit()
+    conn.close()
+    if buried:
+        _notify_task_events()
+    return [_task_from_row(row) for row in rows]
+
+
+def _save_batch_result(task: Task, item: dict | None, batch_status: str) -> None:
+    """
+    Turn one Batch API output line into the same rows _run_task would write.
+    """
+    if item is None:
+        raise LLMBatchError(f"batch {batch_status} without a result for task {task.id}")
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        detail = item.get("error") or response.get("body")
+        raise LLMBatchError(json.dumps(detail)[:500])
+
+    body = response.get("body") or {}
+    call = _deserialize_call(task.llm_request)
+    output = call.text_format.model_validate_json(_response_output_text(body))
+    usage = body.get("usage") or {}
+    response = SimpleNamespace(usage=SimpleNamespace(**usage))
+    _record_usage(call.model, response, task_kind=task.kind)
+    _cache_store(call, output, response)
+
+    _, save = TASK_HANDLERS.get(task.kind, TASK_HANDLERS["lang"])
+    save(task, call, output)
+
+
+def _collect_llm_batch(llm_batch_id: int, batch) -> None:
+    claimed = _claim_submitted_tasks(llm_batch_id)
+    _track_tasks(task.id for task in claimed)
+    try:
+        if claimed:
+            results: dict[str, dict] = {}
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in batch_client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        item = json.loads(line)
+                        results[item.get("custom_id")] = item
+                    except (json.JSONDecodeError, AttributeError):
+                        # its task fails below as having no result
+                        app.logger.warning("bad line in batch %s output: %.200s", llm_batch_id, line)
+
+            for task in claimed:
+                try:
+                    _save_batch_result(task, results.get(f"task-{task.id}"), batch.status)
+                    _complete_task(task, "done")
+                except Exception as exc:
+                    _fail_task(task, exc)
+    finally:
+        _untrack_tasks(task.id for task in claimed)
+
+    # Tasks another worker is still collecting keep the batch open; if that
+    # worker dies, the next poll takes them over once their lease expires.
+    conn = _get_db()
+    conn.execute(
+        """
+        UPDATE llm_batches
+        SET status = 'collected', completed_at = ?
+        WHERE id = ?
+          AND NOT EXISTS (
+            SELECT 1
+            FROM tasks
+            WHERE llm_batch_id = ? AND status IN ('running', 'submitted')
+          )
+        """,
+        (_now_iso(), llm_batch_id, llm_batch_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _poll_llm_batches() -> None:
+    # Batches marked collected before all their tasks were are polled again.
+    conn = _get_db()
+    rows = conn.execute(
+        """
+        SELECT id, provider_batch_id
+        FROM llm_batches AS b
+        WHERE status NOT IN ('collected', 'creating', 'abandoned')
+           OR (
+            status = 'collected'
+            AND EXISTS (
+                SELECT 1
+                FROM tasks
+                WHERE llm_batch_id = b.id AND status IN ('running', 'submitted')
+            )
+          )
+        ORDER BY id
+        """
+    ).fetchall()
+    conn.close()
+
+    for row in rows:
+        try:
+            _poll_llm_batch(row["id"], row["provider_batch_id"])
+        except Exception:
+            app.logger.exception("polling llm batch %s failed", row["id"])
+
+
+def _poll_llm_batch(llm_batch_id: int, provider_batch_id: str) -> None:
+    batch = batch_client.batches.retrieve(provider_batch_id)
+    errors = getattr(batch, "errors", None)
+    conn = _get_db()
+    conn.execute(
+        """
+        UPDATE llm_batches
+        SET status = ?, output_file_id = ?, error_file_id = ?, error = ?
+        WHERE id = ? AND status <> 'collected'
+        """,
+        (
+            batch.status,
+            batch.output_file_id,
+            batch.error_file_id,
+            json.dumps(errors.model_dump()) if errors else None,
+            llm_batch_id,
+        ),
+    )
+    conn.commit()
+    conn.close()
+    if batch.status not in BATCH_PENDING_STATUSES:
+        _collect_llm_batch(llm_batch_id, batch)
+
+
+def _batch_loop() -> None:
+    while True:
+        for step in (_recover_llm_batches, _submit_llm_batch, _poll_llm_batches):
+            try:
+                step()
+            except Exception:
+                app.logger.exception("batch loop: %s failed", step.__name__)
+        time.sleep(BATCH_POLL_INTERVAL)
+
+
+def _extract_usage(response) -> tuple[int, int, int] | None:
+    usage = getattr(response, "usage", None)
+    if not usage:
         return None
     tokens_in = getattr(usage, "input_tokens", None)
     tokens_out = getattr(usage, "output_tokens", None)
@@ -601,82 +2816,890 @@ def _extract_usage(response) -> tuple[int, int, int] | None:
         return None
     return int(tokens_in), int(tokens_out), int(total_tokens)
 
-def _record_usage(model_name: str, response) -> None:
-    usage = _extract_usage(response)
-    if not usage:
-        return
-    tokens_in, tokens_out, total_tokens = usage
-    usage_date = _today_utc()
-    conn = _get_usage_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO usage_log (usage_date, model, tokens_in, tokens_out, total_tokens)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (usage_date, model_name, tokens_in, tokens_out, total_tokens),
-    )
-    cur.execute(
-        """
-        INSERT INTO usage_daily (usage_date, model, tokens_in, tokens_out, total_tokens)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(usage_date, model) DO UPDATE SET
-          tokens_in = tokens_in + excluded.tokens_in,
-          tokens_out = tokens_out + excluded.tokens_out,
-          total_tokens = total_tokens + excluded.total_tokens
-        """,
-        (usage_date, model_name, tokens_in, tokens_out, total_tokens),
-    )
-    cur.execute(
+USAGE_FLUSH_INTERVAL = float(os.environ.get("LANG_USAGE_FLUSH_INTERVAL", "5"))
+USAGE_FLUSH_SIZE = 200
+# usage_rollup periods and the first day of the period a date falls in
+USAGE_PERIODS = {
+    "day": lambda day: day,
+    "week": lambda day: day - timedelta(days=day.weekday()),
+    "month": lambda day: day.replace(day=1),
+}
+
+
+class UsageAggregator:
+    """
+    Buffers token usage in memory and writes it to llm_usage.db in one
+    transaction every USAGE_FLUSH_INTERVAL seconds or USAGE_FLUSH_SIZE
+    events, whichever comes first (and at exit). Until then the unflushed
+    totals are available from pending(), so reports stay live.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # held for the whole write, so readers can pair DB rows with
+        # pending() without seeing a batch twice or not at all
+        self.flush_lock = threading.Lock()
+        self._events: list[tuple] = []
+        # (usage_date, model, task_kind) -> [in, out, total, cached, requests]
+        self._totals: dict[tuple[str, str, str], list[int]] = {}
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        # bumped on every record, for report ETags
+        self.recorded = 0
+        self.last_recorded_at: datetime | None = None
+
+    def record(
+        self, model: str, task_kind: str, usage: tuple[int, int, int], cached: bool
+    ) -> None:
+        tokens_in, tokens_out, total_tokens = usage
+        # cache hits count as cached_tokens (tokens saved), not billed tokens
+        billed = (0, 0, 0) if cached else usage
+        cached_tokens = total_tokens if cached else 0
+        usage_date = _today_utc()
+        with self._lock:
+            self._events.append(
+                (usage_date, model, task_kind, tokens_in, tokens_out, total_tokens, int(cached))
+            )
+            totals = self._totals.setdefault((usage_date, model, task_kind), [0] * 5)
+            for index, value in enumerate((*billed, cached_tokens, 1)):
+                totals[index] += value
+            self.recorded += 1
+            self.last_recorded_at = datetime.now(timezone.utc)
+            full = len(self._events) >= USAGE_FLUSH_SIZE
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def pending(self) -> dict[tuple[str, str, str], list[int]]:
+        """
+        Unflushed totals: {(usage_date, model, task_kind):
+        [tokens_in, tokens_out, total_tokens, cached_tokens, requests]}.
+        """
+        with self._lock:
+            return {key: list(values) for key, values in self._totals.items()}
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self._lock:
+                events = list(self._events)
+            totals = self.pending()
+            if not events:
+                return
+            daily: dict[tuple[str, str], list[int]] = {}
+            all_time: dict[str, list[int]] = {}
+            rollup: dict[tuple[str, str, str, str], list[int]] = {}
+            for (usage_date, model, task_kind), values in totals.items():
+                day = datetime.strptime(usage_date, "%Y-%m-%d").date()
+                targets = [daily.setdefault((usage_date, model), [0] * 4)]
+                targets.append(all_time.setdefault(model, [0] * 4))
+                for index, value in enumerate(values[:4]):
+                    for target in targets:
+                        target[index] += value
+                for period, start_of in USAGE_PERIODS.items():
+                    key = (period, start_of(day).isoformat(), model, task_kind)
+                    target = rollup.setdefault(key, [0] * 5)
+                    for index, value in enumerate(values):
+                        target[index] += value
+
+            conn = _get_usage_db()
+            try:
+                cur = conn.cursor()
+                cur.execute("BEGIN IMMEDIATE")
+                cur.executemany(
+                    """
+                    INSERT INTO usage_log
+                        (usage_date, model, task_kind, tokens_in, tokens_out, total_tokens, cached)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    events,
+                )
+                cur.executemany(
+                    """
+                    INSERT INTO usage_daily (usage_date, model, tokens_in, tokens_out, total_tokens, cached_tokens)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(usage_date, model) DO UPDATE SET
+                      tokens_in = tokens_in + excluded.tokens_in,
+                      tokens_out = tokens_out + excluded.tokens_out,
+                      total_tokens = total_tokens + excluded.total_tokens,
+                      cached_tokens = cached_tokens + excluded.cached_tokens
+                    """,
+                    [(*key, *values) for key, values in daily.items()],
+                )
+                cur.executemany(
+                    """
+                    INSERT INTO usage_all_time (model, tokens_in, tokens_out, total_tokens, cached_tokens)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(model) DO UPDATE SET
+                      tokens_in = tokens_in + excluded.tokens_in,
+                      tokens_out = tokens_out + excluded.tokens_out,
+                      total_tokens = total_tokens + excluded.total_tokens,
+                      cached_tokens = cached_tokens + excluded.cached_tokens
+                    """,
+                    [(key, *values) for key, values in all_time.items()],
+                )
+                cur.executemany(
+                    """
+                    INSERT INTO usage_rollup
+                        (period, period_start, model, task_kind,
+                         tokens_in, tokens_out, total_tokens, cached_tokens, requests)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(period, period_start, model, task_kind) DO UPDATE SET
+                      tokens_in = tokens_in + excluded.tokens_in,
+                      tokens_out = tokens_out + excluded.tokens_out,
+                      total_tokens = total_tokens + excluded.total_tokens,
+                      cached_tokens = cached_tokens + excluded.cached_tokens,
+                      requests = requests + excluded.requests
+                    """,
+                    [(*key, *values) for key, values in rollup.items()],
+                )
+                cur.execute(
+                    "UPDATE usage_meta SET version = version + 1, updated_at = ? WHERE id = 1",
+                    (_now_iso(),),
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            # Only now drop what was written; events recorded meanwhile stay
+            # buffered, and on failure everything stays for the next try.
+            with self._lock:
+                del self._events[: len(events)]
+                remaining = {}
+                for key, values in self._totals.items():
+                    done = totals.get(key, [0] * 5)
+                    left = [value - old for value, old in zip(values, done)]
+                    if any(left):
+                        remaining[key] = left
+                self._totals = remaining
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(USAGE_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # the batch stays buffered for the next try
+                app.logger.exception("flushing usage failed")
+
+
+_usage = UsageAggregator()
+atexit.register(_usage.flush)
+
+
+def _record_usage(model_name: str, response, cached: bool = False, task_kind: str = "") -> None:
+    """
+    Account one response's token usage (buffered; see UsageAggregator).
+    Cache hits are logged with cached=1.
+    """
+    usage = _extract_usage(response)
+    if usage:
+        _usage.record(model_name, task_kind, usage, cached)
+
+
+def _model_slot(model: str) -> asyncio.Semaphore:
+    semaphore = _model_semaphores.get(model)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MODEL_CONCURRENCY.get(model, CONCURRENCY))
+        _model_semaphores[model] = semaphore
+    return semaphore
+
+
+def _parse_reset(value: str | None) -> float:
+    """
+    Parse a reset duration header ("20ms", "1s", "6m0s", "1h2m3.5s") into seconds.
+    """
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(number) * units[unit]
+    return seconds
+
+
+def _header_int(headers, name: str) -> int | None:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    """
+    Requests/minute and tokens/minute token buckets for one model.
+
+    Callers acquire an estimated token cost before dispatch and settle the
+    difference once the real usage is known. The buckets are re-synced to the
+    provider's remaining-quota headers after each response, and a 429 pauses
+    dispatch until the provider's reset time.
+    """
+
+    def __init__(self, rpm: int, tpm: int, output_tokens: float) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm * RATE_HEADROOM
+        self.tokens = tpm * RATE_HEADROOM
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # Usage history used to predict the cost of the next call.
+        self.output_tokens = output_tokens
+        self.chars_per_token = 4.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm * RATE_HEADROOM, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm * RATE_HEADROOM, self.tokens + elapsed * self.tpm / 60)
+
+    def estimate(self, call: "LLMCall") -> int:
+        chars = len(call.system) + len(call.prompt)
+        return int(chars / self.chars_per_token + self.output_tokens)
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, int(self.tpm * RATE_HEADROOM))
+        # One waiter at a time, so dispatch order is first come first served.
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self.paused_until - time.monotonic()
+                if self.requests < 1:
+                    wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+                if self.tokens < tokens:
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def observe(self, call: "LLMCall", estimated: int, usage: tuple[int, int, int] | None) -> None:
+        if not usage:
+            return
+        tokens_in, tokens_out, total_tokens = usage
+        self.tokens += estimated - total_tokens
+        chars = len(call.system) + len(call.prompt)
+        if tokens_in:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * (chars / tokens_in)
+        self.output_tokens = 0.8 * self.output_tokens + 0.2 * tokens_out
+
+    def update_from_headers(self, headers) -> None:
+        limit_requests = _header_int(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _header_int(headers, "x-ratelimit-limit-tokens")
+        if limit_requests:
+            self.rpm = limit_requests
+        if limit_tokens:
+            self.tpm = limit_tokens
+        self._refill()
+        remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.requests = min(self.requests, remaining_requests - self.rpm * (1 - RATE_HEADROOM))
+        if remaining_tokens is not None:
+            self.tokens = min(self.tokens, remaining_tokens - self.tpm * (1 - RATE_HEADROOM))
+
+    def pause(self, headers) -> None:
+        retry_after = headers.get("retry-after-ms")
+        if retry_after is not None:
+            delay = _parse_reset(retry_after) / 1000
+        else:
+            delay = max(
+                _parse_reset(headers.get("retry-after")),
+                _parse_reset(headers.get("x-ratelimit-reset-requests")),
+                _parse_reset(headers.get("x-ratelimit-reset-tokens")),
+            )
+        self.paused_until = max(self.paused_until, time.monotonic() + max(delay, 1.0))
+        self.update_from_headers(headers)
+
+
+def _recent_output_tokens(model: str) -> float:
+    """
+    Average output tokens over the model's recent usage_log rows.
+    """
+    try:
+        conn = _get_usage_db()
+        row = conn.execute(
+            """
+            SELECT AVG(tokens_out) AS avg_out
+            FROM (
+                SELECT tokens_out
+                FROM usage_log
+                WHERE model = ?
+                ORDER BY id DESC
+                LIMIT 200
+            )
+            """,
+            (model,),
+        ).fetchone()
+        conn.close()
+    except sqlite3.Error:
+        return 1000.0
+    return float(row["avg_out"] or 1000.0)
+
+
+async def _rate_limiter(model: str) -> RateLimiter:
+    limiter = _rate_limiters.get(model)
+    if limiter is None:
+        rpm, tpm = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMITS)
+        output_tokens = await asyncio.to_thread(_recent_output_tokens, model)
+        limiter = _rate_limiters.setdefault(model, RateLimiter(rpm, tpm, output_tokens))
+    return limiter
+
+
+class HashingEmbedder:
+    """
+    Offline embedder: signed feature hashing of words and word pairs.
+    Deterministic and dependency-free; used in tests and when no embedding
+    API is available. Finds lexical neighbours, not paraphrases.
+    """
+
+    def __init__(self, dim: int) -> None:
+        self.name = f"hashing:{dim}"
+        self.dim = dim
+
+    def embed(self, texts: list[str]):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for index, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                value = int.from_bytes(
+                    hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little"
+                )
+                matrix[index, value % self.dim] += 1.0 if value >> 63 else -1.0
+        return matrix
+
+
+class OpenAIEmbedder:
+    def __init__(self, model: str, dim: int) -> None:
+        self.name = f"openai:{model}:{dim}"
+        self.model = model
+        self.dim = dim
+
+    def embed(self, texts: list[str]):
+        response = client.embeddings.create(model=self.model, input=texts, dimensions=self.dim)
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+EMBEDDERS = {
+    "openai": lambda: OpenAIEmbedder(EMBEDDING_MODEL, EMBEDDING_DIM),
+    "hashing": lambda: HashingEmbedder(EMBEDDING_DIM),
+}
+if EMBEDDER not in EMBEDDERS:
+    # a typo would otherwise index everything with the wrong embedder
+    raise ValueError(f"LANG_EMBEDDER must be one of {', '.join(EMBEDDERS)}, not {EMBEDDER!r}")
+_embedder_instance = None
+
+
+def _embedder():
+    global _embedder_instance
+    if _embedder_instance is None:
+        _embedder_instance = EMBEDDERS[EMBEDDER]()
+    return _embedder_instance
+
+
+def _embedding_text(name: str | None, description: str | None) -> str:
+    # the embeddings API rejects empty input, and input over its token limit
+    text = f"{name or ''}\n{description or ''}".strip() or "(untitled)"
+    return text[:EMBEDDING_MAX_CHARS]
+
+
+def _embed_texts(texts: list[str]):
+    """
+    Embed and L2-normalise, so a dot product is cosine similarity.
+    """
+    vectors = _embedder().embed(texts)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _embeddings_path() -> str:
+    return os.environ.get("LANG_EMBEDDINGS_PATH") or os.path.join(
+        os.path.dirname(DB_PATH), "writing_embeddings.f32"
+    )
+
+
+def _embedding_matrix(mode: str, rows: int = 0):
+    """
+    Memory-map the embedding file as a (rows, EMBEDDING_DIM) float32 matrix.
+    In "r+" mode the file is grown (in EMBEDDING_GROW_ROWS steps) to hold
+    at least `rows`. None if there is nothing to map.
+    """
+    path = _embeddings_path()
+    row_bytes = 4 * EMBEDDING_DIM
+    have = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+    if mode == "r+" and rows > have:
+        have = max(rows, have + EMBEDDING_GROW_ROWS)
+        with open(path, "ab") as handle:
+            handle.truncate(have * row_bytes)
+    if have == 0:
+        return None
+    return np.memmap(path, dtype=np.float32, mode=mode, shape=(have, EMBEDDING_DIM))
+
+
+def _store_embeddings(items: list[tuple[int, str]], vectors) -> None:
+    """
+    Write vectors for (writing_id, source_updated_at) items and map them to
+    matrix rows. Rows are allocated and written under the write lock, and
+    the mapping commits after the vectors are on disk, so readers and other
+    workers never see a row claimed twice or mapped before it is written.
+    """
+    conn = _get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        assigned = dict(cur.execute("SELECT writing_id, row FROM writing_embeddings").fetchall())
+        used = set(assigned.values())
+        free = (row for row in range(len(used) + len(items)) if row not in used)
+        rows = [assigned.get(writing_id) for writing_id, _ in items]
+        rows = [row if row is not None else next(free) for row in rows]
+        matrix = _embedding_matrix("r+", max(rows) + 1)
+        matrix[rows] = vectors
+        matrix.flush()
+        now = _now_iso()
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO writing_embeddings
+                (writing_id, row, source_updated_at, embedded_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(writing_id, row, updated_at, now) for (writing_id, updated_at), row in zip(items, rows)],
+        )
+        cur.executemany(
+            "DELETE FROM writing_embedding_failures WHERE writing_id = ?",
+            [(writing_id,) for writing_id, _ in items],
+        )
+        cur.execute("UPDATE embedding_meta SET version = version + 1 WHERE id = 1")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _record_embedding_failure(writing_id: int, updated_at: str | None, exc: BaseException) -> None:
+    conn = _get_db()
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO writing_embedding_failures
+            (writing_id, source_updated_at, error, failed_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        (writing_id, updated_at, f"{type(exc).__name__}: {exc}"[:500], _now_iso()),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _reset_embeddings_if_changed(name: str) -> None:
+    """
+    Vectors from different embedders are not comparable: when the
+    configured one changes, drop the index and start over.
+
+    The matrix file is replaced by a new empty one rather than truncated:
+    other processes may have the old one mapped, and touching a truncated
+    mapping kills them with SIGBUS. They keep reading the old file until
+    the version bump makes them map the new one.
+    """
+    conn = _get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        meta = cur.execute("SELECT embedder, dim FROM embedding_meta WHERE id = 1").fetchone()
+        if meta["embedder"] != name or meta["dim"] != EMBEDDING_DIM:
+            path = _embeddings_path()
+            open(f"{path}.new", "wb").close()
+            os.replace(f"{path}.new", path)
+            cur.execute("DELETE FROM writing_embeddings")
+            cur.execute("DELETE FROM writing_embedding_failures")
+            cur.execute(
+                "UPDATE embedding_meta SET embedder = ?, dim = ?, version = version + 1 WHERE id = 1",
+                (name, EMBEDDING_DIM),
+            )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _embed_rows(rows: list[sqlite3.Row]) -> None:
+    """
+    Embed and store `rows`. If the batch is rejected for something other
+    than a transient error, split it to find the writings at fault and
+    record those as failures, so they stop holding up the rest.
+    """
+    try:
+        vectors = _embed_texts([_embedding_text(row["name"], row["description"]) for row in rows])
+    except RETRYABLE_ERRORS:
+        raise
+    except Exception as exc:
+        if len(rows) == 1:
+            _db_writer.submit(
+                _record_embedding_failure, rows[0]["id"], rows[0]["updated_at"], exc
+            ).result()
+            return
+        middle = len(rows) // 2
+        _embed_rows(rows[:middle])
+        _embed_rows(rows[middle:])
+        return
+    items = [(row["id"], row["updated_at"]) for row in rows]
+    _db_writer.submit(_store_embeddings, items, vectors).result()
+
+
+def _embed_pending(limit: int = EMBEDDING_BATCH) -> int:
+    """
+    Embed up to `limit` writings that are new or edited since they were
+    last embedded (or last failed to embed). Returns how many were tried.
+    """
+    conn = _get_db()
+    rows = conn.execute(
+        """
+        SELECT w.id, w.name, w.description, w.updated_at
+        FROM writings AS w
+        LEFT JOIN writing_embeddings AS e ON e.writing_id = w.id
+        LEFT JOIN writing_embedding_failures AS f
+          ON f.writing_id = w.id AND f.source_updated_at IS w.updated_at
+        WHERE (e.writing_id IS NULL OR e.source_updated_at IS NOT w.updated_at)
+          AND f.writing_id IS NULL
+        ORDER BY w.id
+        LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+    conn.close()
+    if rows:
+        _embed_rows(rows)
+    return len(rows)
+
+
+def _embedding_loop() -> None:
+    try:
+        _reset_embeddings_if_changed(_embedder().name)
+    except Exception:
+        app.logger.exception("resetting the embedding index failed")
+    while True:
+        try:
+            while _embed_pending() > 0:
+                pass
+        except Exception:
+            # transient (rate limit, network, busy database): retry next round
+            app.logger.exception("embedding writings failed")
+        _embed_wakeup.wait(EMBED_INTERVAL)
+        _embed_wakeup.clear()
+
+
+class EmbeddingSnapshot:
+    """
+    One consistent view of the embedding matrix: the memory-mapped vectors,
+    the writing id held by each row (0 = free) and the reverse map. Never
+    modified after construction; EmbeddingIndex swaps in a new one.
+    """
+
+    __slots__ = ("version", "matrix", "row_ids", "rows")
+
+    def __init__(self, version, matrix, row_ids, rows: dict[int, int]) -> None:
+        self.version = version
+        self.matrix = matrix
+        self.row_ids = row_ids
+        self.rows = rows
+
+    def vector(self, writing_id: int):
+        row = self.rows.get(writing_id)
+        return None if row is None else np.array(self.matrix[row])
+
+    def search(self, query, k: int, exclude: int | None = None) -> list[tuple[int, float]]:
+        """
+        Top-k (writing_id, cosine similarity) for a normalised query vector.
+        """
+        matrix, row_ids = self.matrix, self.row_ids
+        if matrix is None or not len(row_ids):
+            return []
+        scores = matrix @ query
+        scores[row_ids == 0] = -np.inf
+        if exclude is not None and exclude in self.rows:
+            scores[self.rows[exclude]] = -np.inf
+        k = min(k, int(np.count_nonzero(np.isfinite(scores))))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row_ids[row]), float(scores[row])) for row in top]
+
+
+class EmbeddingIndex:
+    """
+    Read side of the embedding matrix: holds the current EmbeddingSnapshot,
+    rebuilt when embedding_meta's version moves.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.snapshot = EmbeddingSnapshot(None, None, np.zeros(0, dtype=np.int64), {})
+
+    def refresh(self) -> EmbeddingSnapshot:
+        conn = _get_db()
+        version = conn.execute("SELECT version FROM embedding_meta WHERE id = 1").fetchone()[0]
+        if version == self.snapshot.version:
+            conn.close()
+            return self.snapshot
+        with self._lock:
+            if version == self.snapshot.version:
+                conn.close()
+                return self.snapshot
+            # one read transaction, so the version matches the mapping
+            conn.execute("BEGIN")
+            version = conn.execute("SELECT version FROM embedding_meta WHERE id = 1").fetchone()[0]
+            mapping = conn.execute("SELECT writing_id, row FROM writing_embeddings").fetchall()
+            conn.rollback()
+            conn.close()
+            matrix = _embedding_matrix("r")
+            row_ids = np.zeros(0 if matrix is None else len(matrix), dtype=np.int64)
+            rows = {}
+            for writing_id, row in mapping:
+                if row < len(row_ids):
+                    row_ids[row] = writing_id
+                    rows[writing_id] = row
+            self.snapshot = EmbeddingSnapshot(version, matrix, row_ids, rows)
+            return self.snapshot
+
+
+_embedding_index = EmbeddingIndex() if np is not None else None
+
+
+async def _write_outcome(fn, *args) -> None:
+    """
+    Write a task's outcome, retrying briefly on database errors (a busy
+    writer can outlast the busy timeout).
+    """
+    for attempt in range(OUTCOME_WRITE_ATTEMPTS):
+        try:
+            await _write(fn, *args)
+            return
+        except sqlite3.Error:
+            if attempt == OUTCOME_WRITE_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2**attempt)
+
+
+async def _execute_task(task: Task) -> None:
+    try:
+        try:
+            await _run_task(task)
+        except Exception as exc:
+            await _write_outcome(_fail_task, task, exc)
+        else:
+            await _write_outcome(_complete_task, task, "done")
+            _embed_wakeup.set()
+    except Exception:
+        # The outcome could not be recorded. Dropping the task from
+        # _inflight_tasks lets its lease expire, so it is claimed again.
+        app.logger.exception("could not record the outcome of task %s", task.id)
+    finally:
+        _untrack_tasks([task.id])
+
+
+async def _executor_loop() -> None:
+    """
+    Keep up to CONCURRENCY tasks in flight: claim a task whenever a slot is
+    free, otherwise sleep until an enqueue wakes us or POLL_INTERVAL passes.
+    """
+    # DB reads/writes around each LLM call run on this pool.
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=CONCURRENCY + 4))
+    slots = asyncio.Semaphore(CONCURRENCY)
+    running: set[asyncio.Task] = set()
+    bulk: set[asyncio.Task] = set()
+
+    def _release(done: asyncio.Task) -> None:
+        running.discard(done)
+        bulk.discard(done)
+        slots.release()
+
+    while not _stopping.is_set():
+        try:
+            await asyncio.wait_for(slots.acquire(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            continue
+        if _stopping.is_set():
+            slots.release()
+            break
+        allow_bulk = len(bulk) < CONCURRENCY - INTERACTIVE_RESERVED
+        try:
+            task = await asyncio.to_thread(_claim_next_task, allow_bulk)
+        except sqlite3.Error:
+            task = None
+        if task is None:
+            slots.release()
+            if await asyncio.to_thread(_task_wakeup.wait, POLL_INTERVAL):
+                _task_wakeup.clear()
+            continue
+
+        _track_tasks([task.id])
+        job = asyncio.create_task(_execute_task(task))
+        running.add(job)
+        if task.priority == "bulk":
+            bulk.add(job)
+        job.add_done_callback(_release)
+
+    if running:
+        _, unfinished = await asyncio.wait(running, timeout=SHUTDOWN_GRACE)
+        for job in unfinished:
+            job.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+def _executor_thread() -> None:
+    asyncio.run(_executor_loop())
+
+def _lease_loop() -> None:
+    while True:
+        time.sleep(LEASE_RENEW_INTERVAL)
+        try:
+            _renew_leases()
+        except sqlite3.Error:
+            pass
+
+def _checkpoint_loop() -> None:
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)
+        try:
+            _prune_task_events()
+            _prune_writing_changes()
+            while _archive_tasks() > 0:
+                pass
+            _db_writer.submit(_evict_llm_cache).result()
+        except sqlite3.Error:
+            pass
+        for path in (DB_PATH, USAGE_DB_PATH):
+            try:
+                _checkpoint(path)
+            except sqlite3.Error:
+                pass
+
+def _release_leases() -> None:
+    """
+    Hand this worker's unfinished tasks back: interrupted interactive tasks
+    are queued again without using up an attempt, Batch API tasks return
+    to 'submitted' for whichever worker collects their batch.
+    """
+    conn = _get_db()
+    conn.execute(
         """
-        INSERT INTO usage_all_time (model, tokens_in, tokens_out, total_tokens)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(model) DO UPDATE SET
-          tokens_in = tokens_in + excluded.tokens_in,
-          tokens_out = tokens_out + excluded.tokens_out,
-          total_tokens = total_tokens + excluded.total_tokens
+        UPDATE tasks
+        SET status = CASE WHEN llm_batch_id IS NULL THEN 'queued' ELSE 'submitted' END,
+            attempts = MAX(attempts - 1, 0),
+            started_at = NULL,
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        WHERE status = 'running' AND lease_owner = ?
         """,
-        (model_name, tokens_in, tokens_out, total_tokens),
+        (WORKER_ID,),
     )
     conn.commit()
     conn.close()
 
-def _worker_loop() -> None:
-    while True:
-        task_id = task_queue.get()
-        try:
-            with task_lock:
-                task = tasks.get(task_id)
-                if not task:
-                    continue
-                task.status = "running"
-                task.started_at = _now_iso()
 
-            try:
-                _run_task(task)
-                with task_lock:
-                    task.status = "done"
-                    task.finished_at = _now_iso()
-            except Exception as exc:
-                with task_lock:
-                    task.status = "error"
-                    task.error = str(exc)
-                    task.finished_at = _now_iso()
-        finally:
-            task_queue.task_done()
+def _stop_workers(*_) -> None:
+    _stopping.set()
+    _task_wakeup.set()
+
+
+def _start_background_threads() -> None:
+    threading.Thread(target=_lease_loop, daemon=True).start()
+    threading.Thread(target=_batch_loop, daemon=True).start()
+    threading.Thread(target=_checkpoint_loop, daemon=True).start()
+    if np is not None:
+        threading.Thread(target=_embedding_loop, daemon=True).start()
+
 
 def _ensure_workers() -> None:
     global _workers_started
-    if _workers_started:
-        return
-    _workers_started = True
-    for _ in range(CONCURRENCY):
-        thread = threading.Thread(target=_worker_loop, daemon=True)
-        thread.start()
+    with task_lock:
+        if _workers_started:
+            return
+        _ensure_schema()
+        _workers_started = True
+    thread = threading.Thread(target=_executor_thread, daemon=True)
+    thread.start()
+    atexit.register(_stop_embedded_workers, thread)
+    _start_background_threads()
+
+
+def _stop_embedded_workers(executor: threading.Thread) -> None:
+    """
+    On exit of a web process running the executor: what run_worker does on
+    SIGTERM, so a restart neither burns an attempt on every in-flight task
+    nor leaves them to wait out their leases.
+    """
+    _stop_workers()
+    executor.join(SHUTDOWN_GRACE + POLL_INTERVAL)
+    _db_writer.submit(_release_leases).result()
 
 @app.before_request
 def _ensure_workers_for_request():
-    _ensure_workers()
+    _ensure_schema()
+    if EMBEDDED_WORKERS:
+        _ensure_workers()
+
+
+def run_worker(concurrency: int) -> None:
+    """
+    Run the task executor in the foreground, without the web app. Several
+    of these can serve one queue, all on the host that has lang.db: SQLite
+    in WAL mode needs shared memory, so the file must not be shared over a
+    network filesystem. SIGTERM/SIGINT stop claiming, let in-flight tasks
+    finish for up to SHUTDOWN_GRACE seconds, then requeue whatever is left.
+    """
+    global CONCURRENCY, INTERACTIVE_RESERVED, _workers_started
+    CONCURRENCY = max(concurrency, 1)
+    INTERACTIVE_RESERVED = min(INTERACTIVE_RESERVED, CONCURRENCY - 1)
+    _workers_started = True
+    _ensure_schema()
+    signal.signal(signal.SIGTERM, _stop_workers)
+    signal.signal(signal.SIGINT, _stop_workers)
+    _start_background_threads()
+    try:
+        asyncio.run(_executor_loop())
+    finally:
+        # Queued behind any result writes still pending for finished tasks.
+        _db_writer.submit(_release_leases).result()
+        _usage.flush()
+
+
+def _task_mode(data: dict) -> str | None:
+    """
+    Read the optional execution mode from a request body; None if invalid.
+    """
+    mode = (data.get("mode") or "interactive").strip()
+    return mode if mode in TASK_MODES else None
+
+
+def _task_priority(data: dict, default: str = "interactive") -> str | None:
+    """
+    Read the optional scheduling priority from a request body; None if invalid.
+    """
+    priority = (data.get("priority") or default).strip()
+    return priority if priority in TASK_PRIORITIES else None
 
 
 @app.post("/api/lang")
@@ -690,13 +3713,181 @@ def run_lang():
             parent_writing_id = int(parent_writing_id)
         except (TypeError, ValueError):
             return jsonify({"error": "parent_writing_id must be an integer"}), 400
+    mode = _task_mode(data)
+    if mode is None:
+        return jsonify({"error": f"mode must be one of {', '.join(TASK_MODES)}"}), 400
+    priority = _task_priority(data)
+    if priority is None:
+        return jsonify({"error": f"priority must be one of {', '.join(TASK_PRIORITIES)}"}), 400
 
     if not (text_a or text_b):
         return jsonify({"error": "text_a or text_b required"}), 400
-    task_id = _enqueue_task(text_a=text_a, text_b=text_b, parent_writing_id=parent_writing_id)
+    task_id = _enqueue_task(
+        text_a=text_a,
+        text_b=text_b,
+        parent_writing_id=parent_writing_id,
+        mode=mode,
+        use_cache=not data.get("no_cache"),
+        priority=priority,
+    )
     return jsonify({"task_id": task_id, "status": "queued"}), 202
 
 
+MAX_BATCH_SIZE = 5000
+
+
+def _as_text_list(value) -> list[str]:
+    """
+    A string or list of strings as a list of stripped strings. Raises
+    TypeError for anything else.
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not all(
+        item is None or isinstance(item, str) for item in value
+    ):
+        raise TypeError("expected a string or a list of strings")
+    return [(item or "").strip() for item in value]
+
+
+@app.post("/api/lang/batch")
+def run_lang_batch():
+    """
+    Queue many /api/lang jobs in one call.
+
+    Body is either {"text_a": [...], "text_b": [...]} for the cross product
+    of the two lists (either side may be a single string), or
+    {"pairs": [{"text_a", "text_b", "parent_writing_id"?}, ...]}.
+    A top-level parent_writing_id applies to every pair that has none.
+    Batches default to the bulk priority lane.
+
+    The response has task_ids in job order, jobs (how many were asked
+    for) and created (how many new tasks were queued: the batch size).
+    Jobs identical to a task already in flight share its id, so created
+    can be smaller than jobs.
+    """
+    data = request.get_json(silent=True) or {}
+    default_parent = data.get("parent_writing_id")
+    mode = _task_mode(data)
+    if mode is None:
+        return jsonify({"error": f"mode must be one of {', '.join(TASK_MODES)}"}), 400
+    priority = _task_priority(data, "bulk")
+    if priority is None:
+        return jsonify({"error": f"priority must be one of {', '.join(TASK_PRIORITIES)}"}), 400
+
+    if data.get("pairs") is not None:
+        raw_pairs = data.get("pairs")
+        if not isinstance(raw_pairs, list):
+            return jsonify({"error": "pairs must be a list"}), 400
+    else:
+        try:
+            texts_a = _as_text_list(data.get("text_a"))
+            texts_b = _as_text_list(data.get("text_b"))
+        except TypeError:
+            return jsonify({"error": "text_a and text_b must be strings or lists of strings"}), 400
+        raw_pairs = [
+            {"text_a": text_a, "text_b": text_b}
+            for text_a in (texts_a or [""])
+            for text_b in (texts_b or [""])
+        ]
+
+    if len(raw_pairs) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"batch is limited to {MAX_BATCH_SIZE} jobs"}), 400
+
+    pairs: list[dict] = []
+    for index, pair in enumerate(raw_pairs):
+        if not isinstance(pair, dict):
+            return jsonify({"error": f"pairs[{index}] must be an object"}), 400
+        if not all(
+            pair.get(name) is None or isinstance(pair[name], str) for name in ("text_a", "text_b")
+        ):
+            return jsonify({"error": f"pairs[{index}]: text_a and text_b must be strings"}), 400
+        text_a = (pair.get("text_a") or "").strip()
+        text_b = (pair.get("text_b") or "").strip()
+        if not (text_a or text_b):
+            return jsonify({"error": f"pairs[{index}]: text_a or text_b required"}), 400
+        parent_writing_id = pair.get("parent_writing_id", default_parent)
+        if parent_writing_id is not None:
+            try:
+                parent_writing_id = int(parent_writing_id)
+            except (TypeError, ValueError):
+                return jsonify({"error": "parent_writing_id must be an integer"}), 400
+        pairs.append(
+            {
+                "text_a": text_a,
+                "text_b": text_b,
+                "parent_writing_id": parent_writing_id,
+                "mode": mode,
+                "use_cache": not pair.get("no_cache", data.get("no_cache")),
+                "priority": priority,
+            }
+        )
+
+    if not pairs:
+        return jsonify({"error": "no jobs in batch"}), 400
+
+    batch_id, task_ids, created = _enqueue_lang_batch(pairs)
+    return (
+        jsonify(
+            {
+                "batch_id": batch_id,
+                "task_ids": task_ids,
+                "jobs": len(task_ids),
+                "created": created,
+                "status": "queued",
+            }
+        ),
+        202,
+    )
+
+
+@app.get("/api/lang/batch/<int:batch_id>")
+def lang_batch_state(batch_id: int):
+    conn = _get_db()
+    batch = conn.execute(
+        "SELECT id, kind, size, created_at FROM task_batches WHERE id = ?",
+        (batch_id,),
+    ).fetchone()
+    if not batch:
+        conn.close()
+        return jsonify({"error": "not found"}), 404
+    rows = conn.execute(
+        """
+        SELECT status, COUNT(*) AS count
+        FROM task_history
+        WHERE batch_id = ?
+        GROUP BY status
+        """,
+        (batch_id,),
+    ).fetchall()
+    run_rows = conn.execute(
+        """
+        SELECT run_id
+        FROM task_history
+        WHERE batch_id = ? AND run_id IS NOT NULL
+        ORDER BY id
+        """,
+        (batch_id,),
+    ).fetchall()
+    conn.close()
+
+    counts = {row["status"]: row["count"] for row in rows}
+    finished = sum(counts.get(status, 0) for status in FINAL_TASK_STATUSES)
+    total = batch["size"]
+    return jsonify(
+        {
+            **dict(batch),
+            "counts": counts,
+            "finished": finished,
+            "progress": finished / total if total else 1.0,
+            "complete": finished >= total,
+            "run_ids": [row["run_id"] for row in run_rows],
+        }
+    )
+
+
 @app.get("/api/lang")
 def list_lang():
     parent_writing_id = request.args.get("parent_writing_id", type=int)
@@ -842,77 +4033,659 @@ def delete_creation(creation_id: int):
     return jsonify({"deleted": creation_id})
 
 
+QUEUE_SUMMARY_DEFAULT = 100
+QUEUE_SUMMARY_MAX = 1000
+
+
 @app.get("/api/queue")
 def queue_state():
-    with task_lock:
-        items = [asdict(task) for task in tasks.values()]
-
-    queued = sum(1 for item in items if item["status"] == "queued")
-    running = sum(1 for item in items if item["status"] == "running")
+    """
+    Per-status counts plus the newest `limit` tasks as TaskSummary records,
+    so the response size does not grow with the queue. full=1 returns the
+    same tasks as full rows (texts, request, error history) instead; it is
+    capped by `limit` all the same. summary=1 is accepted for older clients.
+    """
+    full = request.args.get("full") in ("1", "true")
+    limit = request.args.get("limit", type=int) or QUEUE_SUMMARY_DEFAULT
+    limit = max(1, min(limit, QUEUE_SUMMARY_MAX))
+    columns = ", ".join(TASK_COLUMNS) if full else TASK_SUMMARY_SELECT
+    conn = _get_db()
+    last_event_id = _last_task_event_id(conn)
+    counts = {
+        row["status"]: row["count"]
+        for row in conn.execute(
+            "SELECT status, COUNT(*) AS count FROM tasks GROUP BY status"
+        )
+    }
+    archived = conn.execute("SELECT COUNT(*) FROM task_archive").fetchone()[0]
+    rows = conn.execute(
+        f"""
+        SELECT {columns}
+        FROM tasks
+        ORDER BY id DESC
+        LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+    conn.close()
 
+    if full:
+        tasks = [dict(row) for row in rows]
+        for task in tasks:
+            task["errors"] = json.loads(task["errors"] or "[]")
+    else:
+        tasks = [TaskSummary(row).to_dict() for row in rows]
     return jsonify(
         {
             "concurrency": CONCURRENCY,
-            "queued": queued,
-            "running": running,
-            "total": len(items),
-            "tasks": sorted(items, key=lambda item: item["id"], reverse=True),
+            "counts": counts,
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "dead": counts.get("dead", 0),
+            "total": sum(counts.values()),
+            "archived": archived,
+            "tasks": tasks,
+            "last_event_id": last_event_id,
         }
     )
 
-@app.get("/api/usage")
-def usage_state():
-    conn = _get_usage_db()
-    daily = conn.execute(
-        """
-        SELECT usage_date, model, tokens_in, tokens_out, total_tokens
-        FROM usage_daily
-        ORDER BY usage_date DESC, model ASC
+
+def _last_task_event_id(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(id) FROM task_events").fetchone()
+    return int(row[0] or 0)
+
+
+def _event_cursor(default: int) -> int:
+    """
+    Where a stream resumes: the browser's Last-Event-ID on reconnect, else
+    ?after=, else `default`.
+    """
+    raw = request.headers.get("Last-Event-ID") or request.args.get("after")
+    try:
+        return int(raw) if raw is not None else default
+    except ValueError:
+        return default
+
+
+def _sse(event: str, data: dict, event_id: int | None = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _task_event_stream(after_id: int, task_id: int | None = None):
+    """
+    Yield task_events rows after `after_id` as SSE messages, waiting for new
+    ones in between. A per-task stream ends once the task is final; any
+    stream ends after SSE_MAX_AGE, for the client to reconnect.
+    """
+    where = "id > ?" + (" AND task_id = ?" if task_id is not None else "")
+    last_id = after_id
+    last_sent = time.monotonic()
+    deadline = last_sent + SSE_MAX_AGE
+    yield "retry: 3000\n\n"
+    while time.monotonic() < deadline:
+        params = (last_id, task_id) if task_id is not None else (last_id,)
+        conn = _get_db()
+        rows = conn.execute(
+            f"""
+            SELECT id, task_id, kind, status, old_status, attempts, run_id, error, batch_id,
+                   created_at
+            FROM task_events
+            WHERE {where}
+            ORDER BY id
+            LIMIT 500
+            """,
+            params,
+        ).fetchall()
+        conn.close()
+
+        for row in rows:
+            last_id = row["id"]
+            yield _sse("task", dict(row), event_id=row["id"])
+            if task_id is not None and row["status"] in FINAL_TASK_STATUSES:
+                return
+        if rows:
+            last_sent = time.monotonic()
+            continue
+        if time.monotonic() - last_sent >= TASK_EVENT_KEEPALIVE:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        with _task_events_changed:
+            _task_events_changed.wait(TASK_EVENT_POLL)
+
+
+def _sse_response(stream) -> Response:
+    """
+    Serve an SSE generator, holding one of the SSE_MAX_STREAMS slots until
+    the response is closed; 503 when none is free.
+    """
+    if not _sse_slots.acquire(blocking=False):
+        response = jsonify({"error": "too many open streams"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+    response = Response(
+        stream_with_context(stream),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(_sse_slots.release)
+    return response
+
+
+@app.get("/api/queue/stream")
+def queue_stream():
+    conn = _get_db()
+    after_id = _event_cursor(_last_task_event_id(conn))
+    conn.close()
+    return _sse_response(_task_event_stream(after_id))
+
+
+@app.get("/api/tasks/<int:task_id>/events")
+def task_events(task_id: int):
+    conn = _get_db()
+    last_id = _last_task_event_id(conn)
+    row = conn.execute(
         """
+        SELECT id, kind, status, attempts, run_id, error, batch_id
+        FROM tasks
+        WHERE id = ?
+        """,
+        (task_id,),
+    ).fetchone()
+    conn.close()
+    if not row:
+        return jsonify({"error": "task not found"}), 404
+
+    after_id = _event_cursor(last_id)
+
+    def stream():
+        # Current state first, so a client that subscribes late still learns
+        # the outcome of a task that already finished.
+        state = dict(row)
+        state["task_id"] = state.pop("id")
+        yield _sse("state", state)
+        if state["status"] in FINAL_TASK_STATUSES:
+            return
+        yield from _task_event_stream(after_id, task_id=task_id)
+
+    return _sse_response(stream())
+
+
+STREAM_PARTIAL_POLL = 0.25
+
+
+@app.get("/api/tasks/<int:task_id>/stream")
+def task_output_stream(task_id: int):
+    """
+    Output of a task as it is generated: a `partial` event whenever more
+    has arrived (the string fields parsed so far, e.g. title and text), then
+    a final `state` event with status, run_id and error.
+    """
+    query = "SELECT status, run_id, error, partial FROM tasks WHERE id = ?"
+    conn = _get_db()
+    row = conn.execute(query, (task_id,)).fetchone()
+    conn.close()
+    if not row:
+        return jsonify({"error": "task not found or already archived"}), 404
+
+    def stream():
+        current = row
+        sent = None
+        deadline = time.monotonic() + SSE_MAX_AGE
+        while time.monotonic() < deadline:
+            if current["partial"] and current["partial"] != sent:
+                sent = current["partial"]
+                yield _sse(
+                    "partial",
+                    {"task_id": task_id, "fields": _partial_json_fields(sent)},
+                )
+            if current["status"] in FINAL_TASK_STATUSES:
+                yield _sse(
+                    "state",
+                    {
+                        "task_id": task_id,
+                        "status": current["status"],
+                        "run_id": current["run_id"],
+                        "error": current["error"],
+                    },
+                )
+                return
+            with _task_events_changed:
+                _task_events_changed.wait(STREAM_PARTIAL_POLL)
+            conn = _get_db()
+            current = conn.execute(query, (task_id,)).fetchone()
+            conn.close()
+            if current is None:
+                return
+
+    return _sse_response(stream())
+
+
+TASK_LOOKUP_MAX = 500
+
+
+@app.get("/api/tasks")
+def get_task_summaries():
+    """
+    TaskSummary fields (plus archived) for up to TASK_LOOKUP_MAX tasks,
+    ids=1,2,3: how list views fill in tasks they learn about from events.
+    Ids found nowhere are listed under missing.
+    """
+    try:
+        ids = sorted({int(raw) for raw in (request.args.get("ids") or "").split(",") if raw.strip()})
+    except ValueError:
+        return jsonify({"error": "ids must be comma-separated integers"}), 400
+    if not ids or len(ids) > TASK_LOOKUP_MAX:
+        return jsonify({"error": f"ids must list 1 to {TASK_LOOKUP_MAX} tasks"}), 400
+
+    conn = _get_db()
+    rows = conn.execute(
+        f"""
+        SELECT {TASK_SUMMARY_SELECT}, 0 AS archived
+        FROM tasks
+        WHERE id IN (SELECT value FROM json_each(?))
+        UNION ALL
+        SELECT {TASK_SUMMARY_SELECT}, 1 AS archived
+        FROM task_archive
+        WHERE id IN (SELECT value FROM json_each(?))
+          AND NOT EXISTS (SELECT 1 FROM tasks AS t WHERE t.id = task_archive.id)
+        ORDER BY id
+        """,
+        (json.dumps(ids), json.dumps(ids)),
     ).fetchall()
-    all_time = conn.execute(
+    conn.close()
+
+    items = [{**TaskSummary(row).to_dict(), "archived": bool(row["archived"])} for row in rows]
+    found = {item["id"] for item in items}
+    return jsonify({"tasks": items, "missing": [task_id for task_id in ids if task_id not in found]})
+
+
+@app.get("/api/tasks/<int:task_id>")
+def get_task(task_id: int):
+    """
+    One task: the full row, or with summary=1 the TaskSummary fields (text
+    previews, no request or partial output) as list views use. Archived
+    tasks only have the summary fields.
+    """
+    conn = _get_db()
+    if request.args.get("summary") in ("1", "true"):
+        row = conn.execute(
+            f"SELECT {TASK_SUMMARY_SELECT} FROM tasks WHERE id = ?", (task_id,)
+        ).fetchone()
+        if row:
+            conn.close()
+            return jsonify({**TaskSummary(row).to_dict(), "archived": False})
+    else:
+        columns = ", ".join(TASK_COLUMNS)
+        row = conn.execute(f"SELECT {columns} FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if row:
+            conn.close()
+            item = dict(row)
+            item["errors"] = json.loads(item["errors"] or "[]")
+            item["archived"] = False
+            return jsonify(item)
+
+    row = conn.execute(
+        f"""
+        SELECT {", ".join(TaskSummary.__slots__)}, archived_at
+        FROM task_archive
+        WHERE id = ?
+        """,
+        (task_id,),
+    ).fetchone()
+    conn.close()
+    if not row:
+        return jsonify({"error": "not found"}), 404
+    item = dict(row)
+    item["archived"] = True
+    return jsonify(item)
+
+
+@app.post("/api/tasks/<int:task_id>/retry")
+def retry_task(task_id: int):
+    if not _requeue_task(task_id):
+        return jsonify({"error": "task not found or not in a failed state"}), 404
+    return jsonify({"task_id": task_id, "status": "queued"}), 202
+
+
+@app.get("/api/llm-batches")
+def list_llm_batches():
+    conn = _get_db()
+    rows = conn.execute(
         """
-        SELECT model, tokens_in, tokens_out, total_tokens
-        FROM usage_all_time
-        ORDER BY model ASC
+        SELECT id, provider_batch_id, status, size, input_file_id, output_file_id,
+               error_file_id, created_at, completed_at, error
+        FROM llm_batches
+        ORDER BY id DESC
+        LIMIT 100
         """
     ).fetchall()
     conn.close()
+    return jsonify([dict(row) for row in rows])
+
+
+def _migration_state(conn: sqlite3.Connection, migrations: list) -> dict:
+    applied = _applied_migrations(conn)
+    return {
+        "version": max(applied, default=0),
+        "latest": max(version for version, _, _ in migrations),
+        "pending": [
+            {"version": version, "name": name}
+            for version, name, _ in migrations
+            if version not in applied
+        ],
+    }
+
+
+@app.get("/api/health")
+def health():
+    conn = _get_db()
+    lang_state = _migration_state(conn, LANG_MIGRATIONS)
+    present = {
+        row["name"]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    conn.close()
+    usage_conn = _get_usage_db()
+    usage_state = _migration_state(usage_conn, USAGE_MIGRATIONS)
+    usage_conn.close()
+
+    missing = [
+        {"name": name, "on": target}
+        for name, target in LANG_INDEXES.items()
+        if name not in present
+    ]
+    ok = not missing and not lang_state["pending"] and not usage_state["pending"]
     return jsonify(
         {
-            "daily": [dict(row) for row in daily],
-            "all_time": [dict(row) for row in all_time],
+            "ok": ok,
+            "migrations": {"lang": lang_state, "usage": usage_state},
+            "missing_indexes": missing,
         }
     )
 
+USAGE_TOTAL_FIELDS = ("tokens_in", "tokens_out", "total_tokens", "cached_tokens", "requests")
+# group -> (response key, name of the period column in its rows)
+USAGE_GROUPS = {
+    "day": ("daily", "usage_date"),
+    "week": ("weekly", "week_start"),
+    "month": ("monthly", "month"),
+}
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _usage_report(
+    rows: list[sqlite3.Row],
+    pending: dict,
+    group: str,
+    start: str | None,
+    end: str | None,
+    model: str | None,
+    by_kind: bool,
+) -> tuple[list[dict], list[dict]]:
+    """
+    Sum day/week/month rollup rows plus unflushed totals into period rows
+    and overall totals, keyed by model (and task_kind when by_kind).
+    """
+    period_key = USAGE_GROUPS[group][1]
+    key_fields = (period_key, "model") + (("task_kind",) if by_kind else ())
+    periods: dict[tuple, dict] = {}
+    totals: dict[tuple, dict] = {}
+
+    def add(period_start: str, row_model: str, task_kind: str, values) -> None:
+        key = (period_start, row_model) + ((task_kind,) if by_kind else ())
+        for bucket, bucket_key in ((periods, key), (totals, key[1:])):
+            row = bucket.get(bucket_key)
+            if row is None:
+                names = key_fields if bucket is periods else key_fields[1:]
+                row = dict(zip(names, bucket_key), **{name: 0 for name in USAGE_TOTAL_FIELDS})
+                bucket[bucket_key] = row
+            for name, value in zip(USAGE_TOTAL_FIELDS, values):
+                row[name] += value or 0
+
+    start_of = USAGE_PERIODS[group]
+    for row in rows:
+        # day rows are folded into the group's periods; a group's own rows map to themselves
+        add(
+            start_of(date.fromisoformat(row["period_start"])).isoformat(),
+            row["model"],
+            row["task_kind"],
+            [row[name] for name in USAGE_TOTAL_FIELDS],
+        )
+    for (usage_date, row_model, task_kind), values in pending.items():
+        if (start and usage_date < start) or (end and usage_date > end):
+            continue
+        if model and row_model != model:
+            continue
+        day = datetime.strptime(usage_date, "%Y-%m-%d").date()
+        add(start_of(day).isoformat(), row_model, task_kind, values)
+
+    def order(row: dict) -> tuple:
+        return tuple(row[name] for name in key_fields[1:])
+
+    period_rows = sorted(periods.values(), key=order)
+    period_rows.sort(key=lambda row: row[period_key], reverse=True)
+    return period_rows, sorted(totals.values(), key=order)
+
+
+def _usage_rollup_rows(
+    conn: sqlite3.Connection,
+    period: str,
+    start: str | None,
+    end: str | None,
+    model: str | None,
+) -> list[sqlite3.Row]:
+    filters = ["period = ?"]
+    params: list = [period]
+    if start:
+        filters.append("period_start >= ?")
+        params.append(start)
+    if end:
+        filters.append("period_start <= ?")
+        params.append(end)
+    if model:
+        filters.append("model = ?")
+        params.append(model)
+    return conn.execute(
+        f"""
+        SELECT period_start, model, task_kind, {", ".join(USAGE_TOTAL_FIELDS)}
+        FROM usage_rollup
+        WHERE {" AND ".join(filters)}
+        """,
+        params,
+    ).fetchall()
+
+
+@app.get("/api/usage")
+def usage_state():
+    """
+    Token usage by period and model. Optional: from/to (YYYY-MM-DD,
+    inclusive), model, group=day|week|month (default day) and by=kind for a
+    per-task-kind breakdown. Served from the incrementally maintained
+    usage_rollup table; unchanged reports answer 304 via ETag/Last-Modified.
+
+    With from/to, weeks and months are summed from the days in range, so
+    the first and last of them only count the days inside it; the response
+    echoes the bounds as range.
+    """
+    start = request.args.get("from") or None
+    end = request.args.get("to") or None
+    model = request.args.get("model") or None
+    group = request.args.get("group") or "day"
+    by_kind = request.args.get("by") == "kind"
+    if group not in USAGE_GROUPS:
+        return jsonify({"error": f"group must be one of {', '.join(USAGE_GROUPS)}"}), 400
+    for value in (start, end):
+        if value is None:
+            continue
+        try:
+            date.fromisoformat(value if _DATE_RE.match(value) else "")
+        except ValueError:
+            return jsonify({"error": "from/to must be valid YYYY-MM-DD dates"}), 400
+    if start and end and start > end:
+        return jsonify({"error": "from must not be after to"}), 400
+
+    # Unbounded reports come from the group's own rows and, for totals,
+    # month rows (a few dozen); anything bounded by date is summed from the
+    # day rows in range.
+    bounded = bool(start or end)
+    period = "day" if bounded else group
+    total_period = "day" if bounded else "month"
+    conn = _get_usage_db()
+    # One read transaction under flush_lock: usage_meta, the rollup rows and
+    # this process's pending() snapshot all describe the same moment.
+    with _usage.flush_lock:
+        conn.execute("BEGIN")
+        try:
+            meta = conn.execute("SELECT version, updated_at FROM usage_meta WHERE id = 1").fetchone()
+            pending = _usage.pending()
+            # Validators from flushed state (shared through the DB, so every
+            # process agrees) plus what this process still buffers and the query.
+            tag = hashlib.sha256(
+                json.dumps(
+                    [
+                        meta["version"],
+                        sorted([*key, *values] for key, values in pending.items()),
+                        request.query_string.decode(),
+                    ]
+                ).encode()
+            ).hexdigest()[:32]
+            last_modified = datetime.fromisoformat(meta["updated_at"])
+            if pending and _usage.last_recorded_at and _usage.last_recorded_at > last_modified:
+                last_modified = _usage.last_recorded_at
+
+            def _validated(response: Response) -> Response:
+                response.set_etag(tag)
+                response.last_modified = last_modified
+                response.cache_control.no_cache = True
+                return response.make_conditional(request)
+
+            not_modified = _validated(Response())
+            if not_modified.status_code == 304:
+                return not_modified
+            rows = _usage_rollup_rows(conn, period, start, end, model)
+            if total_period == period:
+                total_rows = rows
+            else:
+                total_rows = _usage_rollup_rows(conn, total_period, start, end, model)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    period_rows, _ = _usage_report(rows, pending, group, start, end, model, by_kind)
+    _, all_time = _usage_report(total_rows, pending, total_period, start, end, model, by_kind)
+    key = USAGE_GROUPS[group][0]
+    payload = {"group": group, key: period_rows, "all_time": all_time}
+    if bounded:
+        payload["range"] = {"from": start, "to": end}
+    return _validated(jsonify(payload))
+
+
+WRITING_FIELDS = (
+    "id",
+    "name",
+    "description",
+    "parent_run_id",
+    "parent_text_a",
+    "parent_text_b",
+    "parent_writing_id",
+    "notes",
+    "type",
+    "created_at",
+    "updated_at",
+)
+WRITINGS_PAGE_DEFAULT = 100
+WRITINGS_PAGE_MAX = 1000
+
+
+def _writing_fields(raw: str | None) -> list[str] | None:
+    """
+    Parse a fields= projection. Returns None if it names an unknown field.
+    """
+    if not raw:
+        return list(WRITING_FIELDS)
+    fields = [name.strip() for name in raw.split(",") if name.strip()]
+    if not fields or any(name not in WRITING_FIELDS for name in fields):
+        return None
+    if "id" not in fields:
+        fields.insert(0, "id")
+    return fields
+
+
 @app.get("/api/writings")
 def list_writings():
-    type_filter = (request.args.get("type") or "").strip() or None
+    """
+    List writings, newest first.
 
-    conn = _get_db()
-    if type_filter:
-        rows = conn.execute(
-            """
-            SELECT id, name, description, parent_run_id, parent_text_a, parent_text_b,
-                   parent_writing_id, notes, type, created_at, updated_at
-            FROM writings
-            WHERE type = ?
-            ORDER BY id DESC
-            """,
-            (type_filter,),
-        ).fetchall()
-    else:
-        rows = conn.execute(
-            """
-            SELECT id, name, description, parent_run_id, parent_text_a, parent_text_b,
-                   parent_writing_id, notes, type, created_at, updated_at
-            FROM writings
-            ORDER BY id DESC
-            """
-        ).fetchall()
+    Query params:
+      type: only writings of this type
+      fields: comma-separated columns to return (id is always included)
+      limit, after_id: keyset pagination; returns {"items", "next_after_id"}
+        and continues from the writing before after_id
+      include_total: with pagination, also return the total matching count
+
+    Without limit/after_id/include_total the response is a plain list, as before.
+    """
+    type_filter = (request.args.get("type") or "").strip() or None
+    fields = _writing_fields(request.args.get("fields"))
+    if fields is None:
+        return jsonify({"error": f"fields must be a subset of {', '.join(WRITING_FIELDS)}"}), 400
+    after_id = request.args.get("after_id", type=int)
+    limit = request.args.get("limit", type=int)
+    include_total = request.args.get("include_total") in ("1", "true")
+    paginated = limit is not None or after_id is not None or include_total
+    if paginated:
+        limit = max(1, min(limit or WRITINGS_PAGE_DEFAULT, WRITINGS_PAGE_MAX))
+
+    where: list[str] = []
+    params: list = []
+    if type_filter:
+        where.append("type = ?")
+        params.append(type_filter)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+
+    page_where = list(where)
+    page_params = list(params)
+    if after_id is not None:
+        page_where.append("id < ?")
+        page_params.append(after_id)
+    page_where_sql = f"WHERE {' AND '.join(page_where)}" if page_where else ""
+    limit_sql = ""
+    if paginated:
+        limit_sql = "LIMIT ?"
+        page_params.append(limit)
 
+    conn = _get_db()
+    rows = conn.execute(
+        f"""
+        SELECT {", ".join(fields)}
+        FROM writings
+        {page_where_sql}
+        ORDER BY id DESC
+        {limit_sql}
+        """,
+        page_params,
+    ).fetchall()
+    total = None
+    if include_total:
+        total = conn.execute(
+            f"SELECT COUNT(*) FROM writings {where_sql}",
+            params,
+        ).fetchone()[0]
     conn.close()
-    return jsonify([dict(row) for row in rows])
+
+    items = [dict(row) for row in rows]
+    if not paginated:
+        return jsonify(items)
+
+    payload = {
+        "items": items,
+        "next_after_id": items[-1]["id"] if len(items) == limit else None,
+    }
+    if include_total:
+        payload["total"] = total
+    return jsonify(payload)
 
 
 
@@ -942,6 +4715,159 @@ def lookup_writing():
         return jsonify({}), 404
     return jsonify(dict(row))
 
+
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_SCOPES = ("writings", "notes", "runs")
+SEARCH_MARK = ("<mark>", "</mark>")
+# One ranked SELECT per scope; every hit points back to a writing.
+SEARCH_QUERIES = {
+    "writings": """
+        SELECT 'writing' AS kind, w.id AS id, w.id AS writing_id, w.name AS name, w.type AS type,
+               snippet(writings_fts, -1, ?, ?, '…', 16) AS snippet,
+               bm25(writings_fts, 10.0, 2.0, 1.0) AS rank
+        FROM writings_fts
+        JOIN writings AS w ON w.id = writings_fts.rowid
+        WHERE writings_fts MATCH ? {type_filter}
+    """,
+    "notes": """
+        SELECT 'note' AS kind, n.id AS id, n.writing_id AS writing_id, w.name AS name, w.type AS type,
+               snippet(writing_notes_fts, 0, ?, ?, '…', 16) AS snippet,
+               bm25(writing_notes_fts) AS rank
+        FROM writing_notes_fts
+        JOIN writing_notes AS n ON n.id = writing_notes_fts.rowid
+        LEFT JOIN writings AS w ON w.id = n.writing_id
+        WHERE writing_notes_fts MATCH ? {type_filter}
+    """,
+    "runs": """
+        SELECT 'run' AS kind, r.id AS id, r.parent_writing_id AS writing_id, w.name AS name, w.type AS type,
+               snippet(runs_fts, 0, ?, ?, '…', 16) AS snippet,
+               bm25(runs_fts) AS rank
+        FROM runs_fts
+        JOIN runs AS r ON r.id = runs_fts.rowid
+        LEFT JOIN writings AS w ON w.id = r.parent_writing_id
+        WHERE runs_fts MATCH ? {type_filter}
+    """,
+}
+
+
+def _fts_query(text: str) -> str | None:
+    """
+    Turn free text into an FTS5 query: every word must match, the last one
+    as a prefix (search-as-you-type). Quoting each word keeps user input
+    from being read as FTS syntax.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+@app.get("/api/search")
+def search():
+    """
+    Ranked full-text search. q (required), type (writing type), scope
+    (comma-separated subset of writings,notes,runs; default all), limit,
+    offset. Snippets mark matches with <mark>…</mark>.
+    """
+    match = _fts_query(request.args.get("q") or "")
+    if match is None:
+        return jsonify({"error": "q required"}), 400
+    writing_type = (request.args.get("type") or "").strip() or None
+    scopes = [
+        scope.strip()
+        for scope in (request.args.get("scope") or ",".join(SEARCH_SCOPES)).split(",")
+        if scope.strip()
+    ]
+    if not scopes or any(scope not in SEARCH_SCOPES for scope in scopes):
+        return jsonify({"error": f"scope must be a subset of {', '.join(SEARCH_SCOPES)}"}), 400
+    limit = request.args.get("limit", type=int) or SEARCH_PAGE_DEFAULT
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(request.args.get("offset", type=int) or 0, 0)
+
+    parts: list[str] = []
+    params: list = []
+    for scope in scopes:
+        parts.append(
+            SEARCH_QUERIES[scope].format(type_filter="AND w.type = ?" if writing_type else "")
+        )
+        params.extend([*SEARCH_MARK, match])
+        if writing_type:
+            params.append(writing_type)
+
+    conn = _get_db()
+    rows = conn.execute(
+        f"""
+        {" UNION ALL ".join(parts)}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit + 1, offset),
+    ).fetchall()
+    conn.close()
+
+    items = [dict(row) for row in rows[:limit]]
+    return jsonify(
+        {
+            "q": request.args.get("q"),
+            "items": items,
+            "next_offset": offset + limit if len(rows) > limit else None,
+        }
+    )
+
+
+@app.get("/api/writings/<int:writing_id>/similar")
+def similar_writings(writing_id: int):
+    """
+    Nearest writings by embedding (cosine similarity). k (default 10, max
+    100), type (restrict results to one writing type). Writings not yet
+    embedded are embedded on the fly for the query; other writings appear
+    once the embedding loop has reached them.
+    """
+    if np is None:
+        return jsonify({"error": "similarity search needs numpy"}), 503
+    k = max(1, min(request.args.get("k", type=int) or 10, 100))
+    writing_type = (request.args.get("type") or "").strip() or None
+
+    conn = _get_db()
+    writing = conn.execute(
+        "SELECT id, name, description FROM writings WHERE id = ?", (writing_id,)
+    ).fetchone()
+    conn.close()
+    if not writing:
+        return jsonify({"error": "not found"}), 404
+
+    snapshot = _embedding_index.refresh()
+    query = snapshot.vector(writing_id)
+    if query is None:
+        try:
+            query = _embed_texts([_embedding_text(writing["name"], writing["description"])])[0]
+        except openai.OpenAIError as exc:
+            return jsonify({"error": f"embedding failed: {exc}"}), 502
+
+    # a type filter is applied after ranking, so over-fetch for it
+    hits = snapshot.search(query, k * 5 if writing_type else k, exclude=writing_id)
+    items = []
+    if hits:
+        conn = _get_db()
+        placeholders = ",".join("?" for _ in hits)
+        found = {
+            r["id"]: r
+            for r in conn.execute(
+                f"SELECT id, name, type FROM writings WHERE id IN ({placeholders})",
+                [writing for writing, _ in hits],
+            )
+        }
+        conn.close()
+        for hit_id, score in hits:
+            hit = found.get(hit_id)
+            if hit is None or (writing_type and hit["type"] != writing_type):
+                continue
+            items.append({"id": hit_id, "name": hit["name"], "type": hit["type"], "score": round(score, 4)})
+            if len(items) == k:
+                break
+    return jsonify({"writing_id": writing_id, "embedder": _embedder().name, "items": items})
+
 @app.post("/api/writings")
 def create_writing():
     data = request.get_json(silent=True) or {}
@@ -1220,6 +5146,194 @@ def get_writing(writing_id: int):
     return jsonify(dict(row))
 
 
+TREE_DEPTH_DEFAULT = 1
+TREE_PAGE_DEFAULT = 500
+TREE_PAGE_MAX = 5000
+TREE_INCLUDES = ("notes", "runs")
+
+
+def _subtree_sql(root_filter: str, fields) -> str:
+    """
+    A `WITH RECURSIVE tree(<fields>, depth, root_id)` clause walking down
+    from the writings matching `root_filter`, in depth-first pre-order:
+    each node, then its subtree, siblings by id. Parameters are those of
+    root_filter followed by the depth limit; append the final SELECT.
+
+    The recursive CTE pops its queue deepest-first, so SQLite only holds
+    the pending siblings along the current path, and a cursor over it can
+    be read lazily: memory stays bounded however large the subtree is.
+    """
+    columns = ", ".join(fields)
+    child_columns = ", ".join(f"w.{name}" for name in fields)
+    # Compound-select ORDER BY takes result positions: depth, then id.
+    order = f"{len(fields) + 1} DESC, {list(fields).index('id') + 1}"
+    return f"""
+        WITH RECURSIVE tree({columns}, depth, root_id) AS (
+            SELECT {columns}, 0, id
+            FROM writings
+            WHERE {root_filter}
+            UNION ALL
+            SELECT {child_columns}, tree.depth + 1, tree.root_id
+            FROM writings AS w
+            JOIN tree ON w.parent_writing_id = tree.id
+            WHERE tree.depth < ?
+            ORDER BY {order}
+        )
+    """
+
+
+def _attach_tree_includes(conn: sqlite3.Connection, items: list[dict], include: list[str]) -> None:
+    """
+    Give every node its notes and/or runs (same shape as /notes and
+    /api/lang?parent_writing_id=), one query each for the whole page.
+    """
+    ids = json.dumps([item["id"] for item in items])
+    by_id = {item["id"]: item for item in items}
+    if "notes" in include:
+        for item in items:
+            item["writing_notes"] = []
+        for row in conn.execute(
+            """
+            SELECT
+                n.id,
+                n.writing_id,
+                n.content,
+                n.child_writing_id,
+                n.created_at,
+                n.updated_at,
+                w.type AS child_type
+            FROM writing_notes AS n
+            LEFT JOIN writings AS w
+              ON w.id = n.child_writing_id
+            WHERE n.writing_id IN (SELECT value FROM json_each(?))
+            ORDER BY n.id DESC
+            """,
+            (ids,),
+        ):
+            by_id[row["writing_id"]]["writing_notes"].append(dict(row))
+    if "runs" in include:
+        for item in items:
+            item["runs"] = []
+        for row in conn.execute(
+            """
+            SELECT id, instruction, text_a, text_b, parent_writing_id, response, created_at
+            FROM runs
+            WHERE parent_writing_id IN (SELECT value FROM json_each(?))
+            ORDER BY id DESC
+            """,
+            (ids,),
+        ):
+            run = dict(row)
+            try:
+                run["response"] = json.loads(run["response"] or "")
+            except json.JSONDecodeError:
+                run["response"] = run["response"] or ""
+            by_id[run["parent_writing_id"]]["runs"].append(run)
+
+
+@app.get("/api/writings/<int:writing_id>/tree")
+def writing_tree(writing_id: int):
+    """
+    The writing and its descendants in one query, depth-first (each node,
+    then its subtree, siblings by id), as a flat list: every node carries
+    parent_writing_id, depth and child_count, so a client can nest it and
+    knows where there is more below the depth limit.
+
+    Query params:
+      depth: levels below the writing (default 1, 0 = just the writing)
+      fields: comma-separated columns (id and parent_writing_id always)
+      include: notes (as writing_notes) and/or runs to attach to each node
+      limit, offset: page through large subtrees; returns next_offset
+    """
+    fields = _writing_fields(request.args.get("fields"))
+    if fields is None:
+        return jsonify({"error": f"fields must be a subset of {', '.join(WRITING_FIELDS)}"}), 400
+    if "parent_writing_id" not in fields:
+        fields.append("parent_writing_id")
+    include = [name.strip() for name in (request.args.get("include") or "").split(",") if name.strip()]
+    if any(name not in TREE_INCLUDES for name in include):
+        return jsonify({"error": f"include must be a subset of {', '.join(TREE_INCLUDES)}"}), 400
+    depth = request.args.get("depth", type=int)
+    depth = TREE_DEPTH_DEFAULT if depth is None else max(0, min(depth, EXPORT_MAX_DEPTH))
+    limit = request.args.get("limit", type=int) or TREE_PAGE_DEFAULT
+    limit = max(1, min(limit, TREE_PAGE_MAX))
+    offset = max(request.args.get("offset", type=int) or 0, 0)
+
+    columns = ", ".join(f"tree.{name}" for name in fields)
+    conn = _get_db()
+    rows = conn.execute(
+        f"""
+        {_subtree_sql("id = ?", fields)}
+        SELECT
+            {columns},
+            tree.depth,
+            (SELECT COUNT(*) FROM writings AS c WHERE c.parent_writing_id = tree.id) AS child_count
+        FROM tree
+        LIMIT ? OFFSET ?
+        """,
+        (writing_id, depth, limit + 1, offset),
+    ).fetchall()
+    if not rows and offset == 0:
+        conn.close()
+        return jsonify({"error": "not found"}), 404
+
+    items = [dict(row) for row in rows[:limit]]
+    if include and items:
+        _attach_tree_includes(conn, items, include)
+    conn.close()
+    return jsonify(
+        {
+            "writing_id": writing_id,
+            "depth": depth,
+            "items": items,
+            "next_offset": offset + limit if len(rows) > limit else None,
+        }
+    )
+
+
+@app.get("/api/writings/<int:writing_id>/ancestors")
+def writing_ancestors(writing_id: int):
+    """
+    The chain of parents above a writing, root first, from the closure
+    table. Each item has depth = steps above the writing. Also returns
+    root_id (the top of the chain, or the writing itself) and
+    descendant_count. fields as for /tree.
+    """
+    fields = _writing_fields(request.args.get("fields"))
+    if fields is None:
+        return jsonify({"error": f"fields must be a subset of {', '.join(WRITING_FIELDS)}"}), 400
+    if "parent_writing_id" not in fields:
+        fields.append("parent_writing_id")
+
+    columns = ", ".join(f"w.{name}" for name in fields)
+    conn = _get_db()
+    rows = conn.execute(
+        f"""
+        SELECT {columns}, c.depth
+        FROM writing_closure AS c
+        JOIN writings AS w ON w.id = c.ancestor_id
+        WHERE c.descendant_id = ?
+        ORDER BY c.depth DESC
+        """,
+        (writing_id,),
+    ).fetchall()
+    if not rows:
+        conn.close()
+        return jsonify({"error": "not found"}), 404
+    descendants = conn.execute(
+        "SELECT COUNT(*) - 1 FROM writing_closure WHERE ancestor_id = ?", (writing_id,)
+    ).fetchone()[0]
+    conn.close()
+    return jsonify(
+        {
+            "writing_id": writing_id,
+            "root_id": rows[0]["id"],
+            "descendant_count": descendants,
+            "items": [dict(row) for row in rows if row["depth"] > 0],
+        }
+    )
+
+
 @app.get("/api/writing-types")
 def list_writing_types():
     conn = _get_db()
@@ -1245,17 +5359,12 @@ def erase_writing(writing_id: int):
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
-    # 1) Build the tree of all descendant writings
+    # 1) The writing and all its descendants, from the closure table
     cur.execute(
         """
-        WITH RECURSIVE tree(id) AS (
-            SELECT id FROM writings WHERE id = ?
-            UNION ALL
-            SELECT w.id
-            FROM writings w
-            JOIN tree t ON w.parent_writing_id = t.id
-        )
-        SELECT id FROM tree
+        SELECT descendant_id AS id
+        FROM writing_closure
+        WHERE ancestor_id = ?
         """,
         (writing_id,),
     )
@@ -1354,6 +5463,12 @@ def run_prompt_for_writing(writing_id: int):
 
     prompt_text = (data.get("prompt_text") or "").strip()
     output_type = (data.get("output_type") or "").strip() or None
+    mode = _task_mode(data)
+    if mode is None:
+        return jsonify({"error": f"mode must be one of {', '.join(TASK_MODES)}"}), 400
+    priority = _task_priority(data)
+    if priority is None:
+        return jsonify({"error": f"priority must be one of {', '.join(TASK_PRIORITIES)}"}), 400
 
     if not prompt_text:
         return jsonify({"error": "prompt_text is required"}), 400
@@ -1373,6 +5488,9 @@ def run_prompt_for_writing(writing_id: int):
         prompt_id=prompt_id,
         prompt_text=prompt_text,
         output_type=output_type,
+        mode=mode,
+        use_cache=not data.get("no_cache"),
+        priority=priority,
     )
 
     return jsonify({"task_id": task_id, "status": "queued"}), 202
@@ -1509,6 +5627,12 @@ def run_gargantua_for_writing(writing_id: int):
         gargantua_id = int(gargantua_id)
     except (TypeError, ValueError):
         return jsonify({"error": "gargantua_id must be an integer"}), 400
+    mode = _task_mode(data)
+    if mode is None:
+        return jsonify({"error": f"mode must be one of {', '.join(TASK_MODES)}"}), 400
+    priority = _task_priority(data)
+    if priority is None:
+        return jsonify({"error": f"priority must be one of {', '.join(TASK_PRIORITIES)}"}), 400
 
     conn = _get_db()
 
@@ -1535,6 +5659,9 @@ def run_gargantua_for_writing(writing_id: int):
     task_id = _enqueue_gargantua_task(
         writing_id=writing_id,
         gargantua_id=gargantua_id,
+        mode=mode,
+        use_cache=not data.get("no_cache"),
+        priority=priority,
     )
 
     return jsonify({"task_id": task_id, "status": "queued"}), 202
@@ -1558,188 +5685,319 @@ def list_writing_type_stats():
     return jsonify([{"type": row["type"], "count": row["count"]} for row in rows])
 
 
-@app.get("/api/writings/random-balanced")
-def random_writings_balanced():
+class WritingSampler:
     """
-    Return a balanced random selection of writings across groups:
-    - creations
-    - lang
-    - largest other type (Type W)
-    - all remaining types combined
-
-    Query params:
-      total: int (required) – total number of writings to return
+    Writing ids by type, kept sorted and in memory so a random pick is
+    O(k) instead of an ORDER BY RANDOM() scan. Catches up from the
+    writing_changes log before each use; reloads if it fell behind a prune.
     """
-    total = request.args.get("total", type=int)
-    if total is None or total <= 0:
-        return jsonify({"error": "total must be a positive integer"}), 400
 
-    conn = _get_db()
-    conn.row_factory = sqlite3.Row
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.ids_by_type: dict[str, list[int]] = {}
+        self.seq: int | None = None
 
-    # Get counts per type
-    rows = conn.execute(
-        """
-        SELECT type, COUNT(*) AS count
-        FROM writings
-        WHERE type IS NOT NULL AND type <> ''
-        GROUP BY type
-        """
-    ).fetchall()
+    def _reload(self, conn: sqlite3.Connection, seq: int) -> None:
+        ids_by_type: dict[str, list[int]] = {}
+        for writing_id, type_ in conn.execute(
+            """
+            SELECT id, type
+            FROM writings
+            WHERE type IS NOT NULL AND type <> ''
+            ORDER BY type, id
+            """
+        ):
+            ids_by_type.setdefault(type_, []).append(writing_id)
+        self.ids_by_type = ids_by_type
+        self.seq = seq
+
+    def _apply(self, writing_id: int, old_type: str | None, new_type: str | None) -> None:
+        ids = self.ids_by_type.get(old_type) if old_type else None
+        if ids:
+            index = bisect.bisect_left(ids, writing_id)
+            if index < len(ids) and ids[index] == writing_id:
+                ids.pop(index)
+            if not ids:
+                del self.ids_by_type[old_type]
+        if new_type:
+            ids = self.ids_by_type.setdefault(new_type, [])
+            index = bisect.bisect_left(ids, writing_id)
+            if index == len(ids) or ids[index] != writing_id:
+                ids.insert(index, writing_id)
+
+    def refresh(self, conn: sqlite3.Connection) -> None:
+        """Call with self.lock held."""
+        # a snapshot, so the log read below matches the reload if one happens
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'writing_changes'"
+            ).fetchone()
+            latest = row[0] if row else 0
+            if self.seq is None or latest < self.seq:
+                self._reload(conn, latest)
+            elif latest > self.seq:
+                changes = conn.execute(
+                    """
+                    SELECT seq, writing_id, old_type, new_type
+                    FROM writing_changes
+                    WHERE seq > ?
+                    ORDER BY seq
+                    """,
+                    (self.seq,),
+                ).fetchall()
+                if not changes or changes[0][0] != self.seq + 1:
+                    self._reload(conn, latest)
+                else:
+                    for _, writing_id, old_type, new_type in changes:
+                        self._apply(writing_id, old_type, new_type)
+                    self.seq = latest
+        finally:
+            conn.rollback()
 
-    counts_by_type = {row["type"]: row["count"] for row in rows}
+    def counts(self) -> dict[str, int]:
+        return {type_: len(ids) for type_, ids in self.ids_by_type.items()}
 
-    def get_count(t: str) -> int:
-        return counts_by_type.get(t, 0)
+    def sample(self, types: list[str], k: int, rng: random.Random) -> list[int]:
+        """
+        k distinct ids drawn uniformly from the union of `types`.
+        """
+        pools = [self.ids_by_type[t] for t in sorted(types) if t in self.ids_by_type]
+        offsets = []
+        total = 0
+        for pool in pools:
+            offsets.append(total)
+            total += len(pool)
+        picked = []
+        for index in rng.sample(range(total), min(k, total)):
+            pool = bisect.bisect_right(offsets, index) - 1
+            picked.append(pools[pool][index - offsets[pool]])
+        return picked
 
-    groups: list[dict] = []
 
-    # Group 1: creations
-    creations_count = get_count("creations")
-    if creations_count > 0:
-        groups.append(
-            {
-                "name": "creations",
-                "types": ["creations"],
-                "count": creations_count,
-                "quota": 0,
-            }
-        )
+_writing_sampler = WritingSampler()
 
-    # Group 2: lang
-    lang_count = get_count("lang")
-    if lang_count > 0:
-        groups.append(
-            {
-                "name": "lang",
-                "types": ["lang"],
-                "count": lang_count,
-                "quota": 0,
-            }
-        )
 
-    # Other types
-    other_type_names = [
-        t for t in counts_by_type.keys() if t not in ("creations", "lang")
+def _default_sample_groups(counts: dict[str, int]) -> list[dict]:
+    """
+    creations, lang, the largest other type, and all remaining types
+    combined, equally weighted.
+    """
+    groups = [
+        {"name": name, "types": [name], "weight": 1.0}
+        for name in ("creations", "lang")
+        if counts.get(name)
     ]
+    others = [t for t in counts if t not in ("creations", "lang")]
+    if others:
+        largest = max(others, key=lambda t: counts[t])
+        groups.append({"name": largest, "types": [largest], "weight": 1.0})
+        rest = [t for t in others if t != largest]
+        if rest:
+            groups.append({"name": "other-types", "types": rest, "weight": 1.0})
+    return groups
 
-    largest_type: str | None = None
-    largest_count = 0
-    for t in other_type_names:
-        c = counts_by_type[t]
-        if c > largest_count:
-            largest_count = c
-            largest_type = t
-
-    # Group 3: largest other type (Type W)
-    if largest_type is not None and largest_count > 0:
-        groups.append(
-            {
-                "name": largest_type,
-                "types": [largest_type],
-                "count": largest_count,
-                "quota": 0,
-            }
-        )
-
-    # Group 4: all remaining small types combined (X + Y + Z ...)
-    small_types = [t for t in other_type_names if t != largest_type]
-    if small_types:
-        small_total = sum(counts_by_type[t] for t in small_types)
-        if small_total > 0:
-            groups.append(
-                {
-                    "name": "other-types",
-                    "types": small_types,
-                    "count": small_total,
-                    "quota": 0,
-                }
-            )
-
-    if not groups:
-        conn.close()
-        return jsonify([])
-
-    # Cap total by total available
-    total_available = sum(g["count"] for g in groups)
-    if total > total_available:
-        total = total_available
-
-    if total <= 0:
-        conn.close()
-        return jsonify([])
-
-    # Initial fair quotas by group
-    num_groups = len(groups)
-    base = total // num_groups
-    remainder = total % num_groups
-
-    for i, g in enumerate(groups):
-        desired = base + (1 if i < remainder else 0)
-        g["quota"] = min(g["count"], desired)
-
-    assigned = sum(g["quota"] for g in groups)
-    need = total - assigned
 
+def _parse_sample_groups(spec: str, counts: dict[str, int]) -> list[dict]:
+    """
+    Parse groups=creations:2,tool|place,*:0.5 – each item is types joined
+    by "|" with an optional weight (default 1); "*" stands for every type
+    not named by another item.
+    """
+    groups = []
+    named: set[str] = set()
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        types_part, _, weight_part = item.partition(":")
+        try:
+            weight = float(weight_part) if weight_part else 1.0
+        except ValueError:
+            raise ValueError(f"bad weight in group {item!r}") from None
+        if not (weight > 0 and math.isfinite(weight)):
+            raise ValueError(f"weight must be a positive number in group {item!r}")
+        types = [t.strip() for t in types_part.split("|") if t.strip()]
+        if not types:
+            raise ValueError(f"no types in group {item!r}")
+        groups.append({"name": "|".join(types), "types": types, "weight": weight})
+        named.update(t for t in types if t != "*")
+    for group in groups:
+        if group["types"] == ["*"]:
+            group["name"] = "other-types"
+            group["types"] = [t for t in counts if t not in named]
+        elif "*" in group["types"]:
+            raise ValueError("'*' must be a group on its own")
+    return groups
+
+
+def _sample_quotas(groups: list[dict], total: int) -> None:
+    """
+    Split `total` across groups in proportion to weight (largest remainder,
+    earlier groups win ties), capped by each group's count; whatever a
+    small group cannot take is handed round to groups with room left.
+    """
+    # relative to the largest weight, so huge weights cannot overflow the sum
+    top = max(g["weight"] for g in groups)
+    weights = [g["weight"] / top for g in groups]
+    shares = [total * weight / sum(weights) for weight in weights]
+    quotas = [int(share) for share in shares]
+    by_remainder = sorted(range(len(groups)), key=lambda i: quotas[i] - shares[i])
+    for i in by_remainder[: total - sum(quotas)]:
+        quotas[i] += 1
+    for g, quota in zip(groups, quotas):
+        g["quota"] = min(g["count"], quota)
+
+    need = total - sum(g["quota"] for g in groups)
     # Re-distribute remaining quota to groups that still have capacity
     while need > 0:
         made_progress = False
         for g in groups:
             if need <= 0:
                 break
-            capacity = g["count"] - g["quota"]
-            if capacity > 0:
+            if g["count"] - g["quota"] > 0:
                 g["quota"] += 1
                 need -= 1
                 made_progress = True
         if not made_progress:
             break  # no more capacity anywhere
 
-    # Now actually sample from the DB
-    selected_rows: list[dict] = []
-    for g in groups:
-        q = g["quota"]
-        if q <= 0:
-            continue
-        types = g["types"]
-        if len(types) == 1:
-            type_ = types[0]
-            rows = conn.execute(
-                """
-                SELECT id, name, description, type
-                FROM writings
-                WHERE type = ?
-                ORDER BY RANDOM()
-                LIMIT ?
-                """,
-                (type_, q),
-            ).fetchall()
-        else:
-            placeholders = ",".join("?" for _ in types)
-            params = list(types) + [q]
-            rows = conn.execute(
-                f"""
-                SELECT id, name, description, type
-                FROM writings
-                WHERE type IN ({placeholders})
-                ORDER BY RANDOM()
-                LIMIT ?
-                """,
-                params,
-            ).fetchall()
 
-        for row in rows:
-            selected_rows.append(
-                {
-                    "id": row["id"],
-                    "name": row["name"],
-                    "description": row["description"],
-                    "type": row["type"],
-                }
-            )
+@app.get("/api/writings/random-balanced")
+def random_writings_balanced():
+    """
+    Return a balanced random selection of writings across groups. By
+    default the groups are:
+    - creations
+    - lang
+    - largest other type (Type W)
+    - all remaining types combined
 
+    Query params:
+      total: int (required) – total number of writings to return
+      groups: custom groups and weights, e.g. creations:2,tool|place,*
+      seed: int – same seed and same writings give the same picks
+    """
+    total = request.args.get("total", type=int)
+    if total is None or total <= 0:
+        return jsonify({"error": "total must be a positive integer"}), 400
+    seed = request.args.get("seed")
+    if seed is not None and not re.fullmatch(r"-?\d+", seed.strip()):
+        return jsonify({"error": "seed must be an integer"}), 400
+    rng = random.Random(int(seed) if seed is not None else None)
+
+    conn = _get_db()
+    sampler = _writing_sampler
+    with sampler.lock:
+        sampler.refresh(conn)
+        counts = sampler.counts()
+        try:
+            groups = (
+                _parse_sample_groups(request.args["groups"], counts)
+                if request.args.get("groups")
+                else _default_sample_groups(counts)
+            )
+        except ValueError as exc:
+            conn.close()
+            return jsonify({"error": str(exc)}), 400
+        for g in groups:
+            g["count"] = sum(counts.get(t, 0) for t in set(g["types"]))
+        groups = [g for g in groups if g["count"] > 0]
+        if not groups:
+            conn.close()
+            return jsonify([])
+
+        # Cap total by total available
+        total = min(total, sum(g["count"] for g in groups))
+        _sample_quotas(groups, total)
+
+        picked: list[int] = []
+        seen: set[int] = set()
+        for g in groups:
+            # groups may overlap when custom; keep each writing once
+            for writing_id in sampler.sample(g["types"], g["quota"], rng):
+                if writing_id not in seen:
+                    seen.add(writing_id)
+                    picked.append(writing_id)
+
+    rows = {
+        row["id"]: row
+        for row in conn.execute(
+            """
+            SELECT id, name, description, type
+            FROM writings
+            WHERE id IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps(picked),),
+        )
+    }
     conn.close()
-    return jsonify(selected_rows)
+    return jsonify(
+        [
+            {
+                "id": row["id"],
+                "name": row["name"],
+                "description": row["description"],
+                "type": row["type"],
+            }
+            for row in (rows.get(writing_id) for writing_id in picked)
+            if row is not None
+        ]
+    )
+
+
+EXPORT_MAX_DEPTH = 1000
+
+
+def _export_rows(root_ids: list[int] | None, max_depth: int):
+    """
+    Yield writing rows (plus depth and root_id) in depth-first pre-order,
+    read lazily (see _subtree_sql). Roots are the given ids, or every
+    type='lang' writing without a parent.
+    """
+    if root_ids:
+        root_filter = f"id IN ({', '.join('?' for _ in root_ids)})"
+        params: list = list(root_ids)
+    else:
+        root_filter = "type = 'lang' AND parent_writing_id IS NULL"
+        params = []
+    conn = _get_db()
+    try:
+        cursor = conn.execute(
+            f"""
+            {_subtree_sql(root_filter, WRITING_FIELDS)}
+            SELECT * FROM tree
+            """,
+            (*params, max_depth),
+        )
+        for row in cursor:
+            yield row
+    finally:
+        conn.close()
+
+
+def _export_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(row)) + "\n"
+
+
+def _export_nested(rows, exported_at: str):
+    """
+    The {"exported_at", "roots": [...children...]} document, written
+    incrementally from depth-first rows: a node's "children" array stays
+    open until a row at the same or a shallower depth arrives.
+    """
+    yield json.dumps({"exported_at": exported_at})[:-1]
+    yield ', "roots": ['
+    open_depth = -1
+    for row in rows:
+        depth = row["depth"]
+        if depth <= open_depth:
+            yield "]}" * (open_depth - depth + 1) + ", "
+        node = {name: row[name] for name in WRITING_FIELDS}
+        yield json.dumps(node)[:-1] + ', "children": ['
+        open_depth = depth
+    yield "]}" * (open_depth + 1) + "]}"
 
 
 @app.get("/api/export/lang")
@@ -1748,62 +6006,49 @@ def export_lang():
     Export all writings as a tree, with
     type='lang' writings as roots and their
     descendant writings as children.
-    """
-    conn = _get_db()
-    rows = conn.execute(
-        """
-        SELECT id, name, description,
-               parent_run_id, parent_text_a, parent_text_b,
-               parent_writing_id, notes, type,
-               created_at, updated_at
-        FROM writings
-        ORDER BY id
-        """
-    ).fetchall()
-    conn.close()
 
-    # Build a map of id -> node with children list
-    nodes: dict[int, dict] = {}
-    for row in rows:
-        node = {
-            "id": row["id"],
-            "name": row["name"],
-            "description": row["description"],
-            "parent_run_id": row["parent_run_id"],
-            "parent_text_a": row["parent_text_a"],
-            "parent_text_b": row["parent_text_b"],
-            "parent_writing_id": row["parent_writing_id"],
-            "notes": row["notes"],
-            "type": row["type"],
-            "created_at": row["created_at"],
-            "updated_at": row["updated_at"],
-            "children": [],
-        }
-        nodes[row["id"]] = node
+    Streamed as it is read. Optional: root_id (comma-separated, replaces
+    the default roots), max_depth, and format=ndjson for one flat writing
+    per line (with depth and root_id) instead of the nested document.
+    """
+    try:
+        root_ids = [int(value) for value in (request.args.get("root_id") or "").split(",") if value.strip()]
+    except ValueError:
+        return jsonify({"error": "root_id must be a comma-separated list of integers"}), 400
+    max_depth = request.args.get("max_depth", type=int)
+    max_depth = EXPORT_MAX_DEPTH if max_depth is None else max(0, min(max_depth, EXPORT_MAX_DEPTH))
+    export_format = request.args.get("format") or "json"
+    if export_format not in ("json", "ndjson"):
+        return jsonify({"error": "format must be json or ndjson"}), 400
+
+    exported_at = _now_iso()
+    rows = _export_rows(root_ids or None, max_depth)
+    if export_format == "ndjson":
+        body, mimetype = _export_ndjson(rows), "application/x-ndjson"
+    else:
+        body, mimetype = _export_nested(rows, exported_at), "application/json"
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"X-Exported-At": exported_at},
+    )
 
-    # Attach children via parent_writing_id
-    for row in rows:
-        parent_id = row["parent_writing_id"]
-        if parent_id is not None and parent_id in nodes:
-            parent = nodes[parent_id]
-            child = nodes[row["id"]]
-            parent["children"].append(child)
-
-    # Root writings: type='lang' and no parent_writing_id
-    roots = [
-        node
-        for node in nodes.values()
-        if node["type"] == "lang" and node["parent_writing_id"] is None
-    ]
 
-    payload = {
-        "exported_at": _now_iso(),
-        "roots": roots,
-    }
-    return jsonify(payload)
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="lang")
+    commands = parser.add_subparsers(dest="command")
+    worker = commands.add_parser("worker", help="run task workers without the web app")
+    worker.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args(argv)
 
+    if args.command == "worker":
+        run_worker(args.concurrency)
+        return
+    _ensure_schema()
+    if EMBEDDED_WORKERS:
+        _ensure_workers()
+    app.run(debug=True)
 
 
 if __name__ == "__main__":
-    _ensure_workers()
-    app.run(debug=True)
+    main()
@@ -0,0 +1,137 @@
+"""
+A local stand-in for the OpenAI Files and Batches endpoints, enough for
+lang's Batch API mode: upload a JSONL file, create a batch, retrieve and
+list batches, download output files. A batch completes on its first
+retrieve; its output answers every request with one idea, except the
+custom_ids listed in `drop`, which get no output line at all.
+"""
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BatchStub:
+    def __init__(self) -> None:
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.drop: set[str] = set()
+        self.requests: list[dict] = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers["content-length"]))
+                if self.path.endswith("/files"):
+                    self._send(stub.upload(body))
+                elif self.path.endswith("/batches"):
+                    self._send(stub.create(json.loads(body)))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self) -> None:
+                path = self.path.split("?")[0]
+                if path.endswith("/batches"):
+                    batches = [stub.batch(batch_id) for batch_id in reversed(list(stub.batches))]
+                    self._send({"object": "list", "data": batches, "has_more": False})
+                elif match := re.search(r"/batches/([\w-]+)$", path):
+                    self._send(stub.retrieve(match.group(1)))
+                elif match := re.search(r"/files/([\w-]+)/content$", path):
+                    self._send(stub.files[match.group(1)], raw=True)
+                else:
+                    self.send_error(404)
+
+            def _send(self, payload, raw: bool = False) -> None:
+                body = payload if raw else json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("content-type", "application/octet-stream" if raw else "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self) -> "BatchStub":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def upload(self, body: bytes) -> dict:
+        content = re.search(rb"filename=[^\r]*\r\n(?:[^\r]+\r\n)*\r\n(.*?)\r\n--", body, re.S).group(1)
+        file_id = f"file-{len(self.files) + 1}"
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": 0,
+            "filename": "tasks.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        }
+
+    def create(self, request: dict) -> dict:
+        batch_id = f"batch-{len(self.batches) + 1}"
+        self.batches[batch_id] = {
+            "input_file_id": request["input_file_id"],
+            "metadata": request.get("metadata"),
+            "status": "in_progress",
+            "output_file_id": None,
+        }
+        return self.batch(batch_id)
+
+    def retrieve(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        if batch["status"] == "in_progress":
+            lines = []
+            for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines():
+                request = json.loads(line)
+                self.requests.append(request)
+                if request["custom_id"] in self.drop:
+                    continue
+                output = {"ideas": [{"name": "idea", "desciription": "from the stub", "writing_id": None}]}
+                lines.append(
+                    {
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {
+                                "output": [
+                                    {
+                                        "type": "message",
+                                        "content": [{"type": "output_text", "text": json.dumps(output)}],
+                                    }
+                                ],
+                                "usage": {"input_tokens": 3, "output_tokens": 4, "total_tokens": 7},
+                            },
+                        },
+                        "error": None,
+                    }
+                )
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+            batch.update(status="completed", output_file_id=file_id)
+        return self.batch(batch_id)
+
+    def batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": "/v1/responses",
+            "input_file_id": batch["input_file_id"],
+            "completion_window": "24h",
+            "status": batch["status"],
+            "created_at": 0,
+            "output_file_id": batch["output_file_id"],
+            "error_file_id": None,
+            "metadata": batch["metadata"],
+        }
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("LANG_EMBEDDED_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import lang  # noqa: E402
+
+# Tables that predate the migration runner; production databases already have them.
+LANG_BASE_SCHEMA = """
+CREATE TABLE writings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    description TEXT,
+    parent_run_id INTEGER,
+    parent_text_a TEXT,
+    parent_text_b TEXT,
+    parent_writing_id INTEGER,
+    notes TEXT,
+    type TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    instruction TEXT,
+    text_a TEXT,
+    text_b TEXT,
+    parent_writing_id INTEGER,
+    prompt TEXT,
+    response TEXT,
+    prompt_id INTEGER,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE writing_notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    writing_id INTEGER,
+    content TEXT,
+    child_writing_id INTEGER,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE prompts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input_type TEXT,
+    prompt_text TEXT,
+    output_type TEXT
+);
+CREATE TABLE gargantua (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    text TEXT,
+    type TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+USAGE_BASE_SCHEMA = """
+CREATE TABLE usage_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usage_date TEXT,
+    model TEXT,
+    tokens_in INTEGER,
+    tokens_out INTEGER,
+    total_tokens INTEGER,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE usage_daily (
+    usage_date TEXT,
+    model TEXT,
+    tokens_in INTEGER,
+    tokens_out INTEGER,
+    total_tokens INTEGER,
+    PRIMARY KEY (usage_date, model)
+);
+CREATE TABLE usage_all_time (
+    model TEXT PRIMARY KEY,
+    tokens_in INTEGER,
+    tokens_out INTEGER,
+    total_tokens INTEGER
+);
+"""
+
+
+@pytest.fixture(autouse=True)
+def databases(tmp_path, monkeypatch):
+    """
+    Fresh lang.db and llm_usage.db per test, migrated to the current
+    schema, with the module's caches reset to match.
+    """
+    lang_path = tmp_path / "lang.db"
+    usage_path = tmp_path / "llm_usage.db"
+    for path, schema in ((lang_path, LANG_BASE_SCHEMA), (usage_path, USAGE_BASE_SCHEMA)):
+        conn = sqlite3.connect(path)
+        conn.executescript(schema)
+        conn.close()
+
+    monkeypatch.setattr(lang, "DB_PATH", str(lang_path))
+    monkeypatch.setattr(lang, "USAGE_DB_PATH", str(usage_path))
+    monkeypatch.setenv("LANG_EMBEDDINGS_PATH", str(tmp_path / "embeddings.f32"))
+    monkeypatch.setattr(lang, "_schema_ready", False)
+    monkeypatch.setattr(lang, "_workers_started", True)
+    monkeypatch.setattr(lang, "_usage", lang.UsageAggregator())
+    monkeypatch.setattr(lang, "_writing_sampler", lang.WritingSampler())
+    monkeypatch.setattr(lang, "_embedder_instance", None)
+    if lang.np is not None:
+        monkeypatch.setattr(lang, "_embedding_index", lang.EmbeddingIndex())
+    lang._ensure_schema()
+    yield
+    lang._untrack_tasks(list(lang._inflight_tasks))
+
+
+@pytest.fixture
+def client():
+    return lang.app.test_client()
+
+
+@pytest.fixture
+def db():
+    conn = lang._get_db()
+    yield conn
+    conn.close()
@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import lang
+
+needs_numpy = pytest.mark.skipif(lang.np is None, reason="similarity search needs numpy")
+
+
+@pytest.fixture
+def hashing(monkeypatch):
+    monkeypatch.setattr(lang, "EMBEDDER", "hashing")
+
+
+def _add_writing(db, name, description, type_="lang"):
+    cur = db.execute(
+        "INSERT INTO writings (name, description, type) VALUES (?, ?, ?)", (name, description, type_)
+    )
+    db.commit()
+    return cur.lastrowid
+
+
+@needs_numpy
+def test_similar_ranks_lexical_neighbours_first(client, db, hashing):
+    query = _add_writing(db, "Apple orchard", "picking apples in the orchard at harvest")
+    close = _add_writing(db, "Orchard harvest", "apples in the orchard at harvest time")
+    middling = _add_writing(db, "Apple pie", "baking apples into a pie", type_="recipe")
+    far = _add_writing(db, "Submarine", "repairing a diesel engine under water")
+    while lang._embed_pending():
+        pass
+
+    body = client.get(f"/api/writings/{query}/similar?k=3").json
+
+    assert body["embedder"] == f"hashing:{lang.EMBEDDING_DIM}"
+    assert [item["id"] for item in body["items"]] == [close, middling, far]
+    scores = [item["score"] for item in body["items"]]
+    assert scores == sorted(scores, reverse=True)
+
+    recipes = client.get(f"/api/writings/{query}/similar?type=recipe").json
+    assert [item["id"] for item in recipes["items"]] == [middling]
+
+
+@needs_numpy
+def test_similar_embeds_an_unindexed_writing_on_the_fly(client, db, hashing):
+    indexed = _add_writing(db, "Orchard harvest", "apples in the orchard")
+    lang._embed_pending()
+    query = _add_writing(db, "Apple orchard", "apples in the orchard")
+
+    body = client.get(f"/api/writings/{query}/similar").json
+
+    assert [item["id"] for item in body["items"]] == [indexed]
+
+
+def test_similar_needs_numpy(client, db, monkeypatch):
+    monkeypatch.setattr(lang, "np", None)
+    writing = _add_writing(db, "Apple orchard", "apples")
+
+    assert client.get(f"/api/writings/{writing}/similar").status_code == 503
+
+
+def test_unknown_embedder_refuses_to_start():
+    env = {**os.environ, "LANG_EMBEDDER": "hashnig", "OPENAI_API_KEY": "sk-test"}
+    result = subprocess.run(
+        [sys.executable, "-c", "import lang"],
+        cwd=Path(lang.__file__).parent,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode != 0
+    assert "LANG_EMBEDDER must be one of" in result.stderr
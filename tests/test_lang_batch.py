@@ -0,0 +1,51 @@
+import pytest
+
+import lang
+
+
+def test_batch_reports_jobs_and_created_tasks(client, db):
+    existing = lang._enqueue_task("a1", "b", None, priority="bulk")
+
+    response = client.post("/api/lang/batch", json={"text_a": ["a1", "a2", "a3"], "text_b": "b"})
+
+    assert response.status_code == 202
+    body = response.json
+    assert body["task_ids"][0] == existing
+    assert body["jobs"] == 3
+    assert body["created"] == 2
+    size = db.execute("SELECT size FROM task_batches WHERE id = ?", (body["batch_id"],)).fetchone()[0]
+    assert size == body["created"]
+
+
+def test_batch_pairs_and_defaults(client, db):
+    response = client.post(
+        "/api/lang/batch",
+        json={"pairs": [{"text_a": "x"}, {"text_b": "y", "parent_writing_id": 7}], "parent_writing_id": 3},
+    )
+
+    rows = db.execute(
+        "SELECT parent_writing_id, priority FROM tasks WHERE id IN (?, ?) ORDER BY id",
+        response.json["task_ids"],
+    ).fetchall()
+    assert [tuple(row) for row in rows] == [(3, "bulk"), (7, "bulk")]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"text_a": ["a", 1]},
+        {"text_a": "a", "text_b": {"b": 1}},
+        {"text_a": 5},
+        {"pairs": [{"text_a": ["a"]}]},
+        {"pairs": [{"text_a": "a", "text_b": 2}]},
+        {"pairs": ["a"]},
+        {"pairs": [{}]},
+        {"text_a": "a", "mode": "bogus"},
+    ],
+)
+def test_batch_rejects_malformed_jobs(client, db, body):
+    response = client.post("/api/lang/batch", json=body)
+
+    assert response.status_code == 400
+    assert "error" in response.json
+    assert db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] == 0
@@ -0,0 +1,125 @@
+import pytest
+from openai import OpenAI
+
+import lang
+from batch_stub import BatchStub
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    with BatchStub() as stub:
+        monkeypatch.setattr(
+            lang, "batch_client", OpenAI(base_url=stub.url, api_key="sk-test", max_retries=0)
+        )
+        yield stub
+
+
+def _tasks(db):
+    return {row["id"]: row for row in db.execute("SELECT * FROM tasks")}
+
+
+def _batch_status(db, llm_batch_id):
+    return db.execute("SELECT status FROM llm_batches WHERE id = ?", (llm_batch_id,)).fetchone()[0]
+
+
+def test_submit_poll_collect_and_retry_a_missing_line(stub, db):
+    ids = [lang._enqueue_task(f"a{n}", "b", None, mode="batch") for n in range(3)]
+    stub.drop.add(f"task-{ids[1]}")
+
+    llm_batch_id = lang._submit_llm_batch()
+
+    tasks = _tasks(db)
+    assert all(tasks[task_id]["status"] == "submitted" for task_id in ids)
+    assert all(tasks[task_id]["llm_batch_id"] == llm_batch_id for task_id in ids)
+    row = db.execute("SELECT * FROM llm_batches WHERE id = ?", (llm_batch_id,)).fetchone()
+    assert row["provider_batch_id"] == "batch-1"
+    assert stub.batches["batch-1"]["metadata"] == {"llm_batch_id": str(llm_batch_id)}
+    assert lang._submit_llm_batch() is None
+
+    lang._poll_llm_batches()
+
+    tasks = _tasks(db)
+    assert [tasks[task_id]["status"] for task_id in ids] == ["done", "queued", "done"]
+    assert tasks[ids[0]]["run_id"] is not None
+    assert "without a result" in tasks[ids[1]]["error"]
+    assert tasks[ids[1]]["available_at"] > lang._now_iso()
+    assert _batch_status(db, llm_batch_id) == "collected"
+
+    db.execute("UPDATE tasks SET available_at = NULL WHERE id = ?", (ids[1],))
+    db.commit()
+    stub.drop.clear()
+    retry_batch_id = lang._submit_llm_batch()
+    lang._poll_llm_batches()
+
+    tasks = _tasks(db)
+    assert retry_batch_id != llm_batch_id
+    assert tasks[ids[1]]["status"] == "done"
+    assert tasks[ids[1]]["attempts"] == 2
+    assert [request["custom_id"] for request in stub.requests].count(f"task-{ids[1]}") == 2
+
+
+def test_batch_stays_open_while_another_worker_collects(stub, db):
+    ids = [lang._enqueue_task(f"a{n}", "b", None, mode="batch") for n in range(2)]
+    llm_batch_id = lang._submit_llm_batch()
+    db.execute(
+        "UPDATE tasks SET status = 'running', lease_owner = 'elsewhere:1', lease_expires_at = ? WHERE id = ?",
+        (lang._iso_after(60), ids[1]),
+    )
+    db.commit()
+
+    lang._poll_llm_batches()
+
+    tasks = _tasks(db)
+    assert tasks[ids[0]]["status"] == "done"
+    assert tasks[ids[1]]["status"] == "running"
+    assert _batch_status(db, llm_batch_id) == "completed"
+
+    # the other worker died: its lease runs out and the next poll takes over
+    db.execute("UPDATE tasks SET lease_expires_at = ? WHERE id = ?", (lang._iso_after(-1), ids[1]))
+    db.commit()
+    lang._poll_llm_batches()
+
+    tasks = _tasks(db)
+    assert tasks[ids[1]]["status"] == "done"
+    assert tasks[ids[1]]["attempts"] == 2
+    assert _batch_status(db, llm_batch_id) == "collected"
+
+
+def test_expired_collection_without_attempts_left_is_buried(stub, db):
+    task_id = lang._enqueue_task("a", "b", None, mode="batch")
+    llm_batch_id = lang._submit_llm_batch()
+    db.execute(
+        """
+        UPDATE tasks
+        SET status = 'running', lease_owner = 'elsewhere:1', lease_expires_at = ?, attempts = ?
+        WHERE id = ?
+        """,
+        (lang._iso_after(-1), lang.RETRY_POLICIES["lang"].max_attempts, task_id),
+    )
+    # marked collected by a worker from before collection waited for every task
+    db.execute("UPDATE llm_batches SET status = 'collected' WHERE id = ?", (llm_batch_id,))
+    db.commit()
+
+    lang._poll_llm_batches()
+
+    assert _tasks(db)[task_id]["status"] == "dead"
+    assert _batch_status(db, llm_batch_id) == "collected"
+
+
+def test_unfinished_creation_is_adopted_from_provider_metadata(stub, db, monkeypatch):
+    task_id = lang._enqueue_task("a", "b", None, mode="batch")
+    # the provider accepted the batch, but the submitter died before recording it
+    with monkeypatch.context() as patch:
+        patch.setattr(lang, "_record_llm_batch", lambda llm_batch_id, batch: None)
+        llm_batch_id = lang._submit_llm_batch()
+    db.execute(
+        "UPDATE llm_batches SET created_at = ? WHERE id = ?",
+        (lang._iso_after(-2 * lang.BATCH_CREATE_TIMEOUT), llm_batch_id),
+    )
+    db.commit()
+
+    lang._recover_llm_batches()
+    lang._poll_llm_batches()
+
+    assert _tasks(db)[task_id]["status"] == "done"
+    assert len(stub.batches) == 1
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import lang
+
+
+def _call(prompt):
+    return lang.LLMCall(model="m", system="s", prompt=prompt, text_format=lang.IdeaSet, context={})
+
+
+def _store(prompt):
+    output = lang.IdeaSet(ideas=[lang.Idea(name=prompt, desciription="d", writing_id=None)])
+    usage = SimpleNamespace(input_tokens=1, output_tokens=2, total_tokens=3)
+    lang._cache_store(_call(prompt), output, SimpleNamespace(usage=usage))
+
+
+def _wait_for_writer():
+    lang._db_writer.submit(lambda: None).result()
+
+
+def test_lookup_returns_stored_output_and_counts_the_hit(db):
+    _store("p")
+
+    output, response = lang._cache_lookup(_call("p"))
+    _wait_for_writer()
+
+    assert output.ideas[0].name == "p"
+    assert response.usage.total_tokens == 3
+    assert db.execute("SELECT hits FROM llm_cache").fetchone()[0] == 1
+    assert lang._cache_lookup(_call("other")) is None
+
+
+def test_eviction_runs_apart_from_stores(db, monkeypatch):
+    monkeypatch.setattr(lang, "LLM_CACHE_MAX_ENTRIES", 2)
+    for prompt in ("old", "hit", "new"):
+        _store(prompt)
+    db.execute("UPDATE llm_cache SET last_hit_at = '2000-01-01'")
+    db.commit()
+    lang._cache_lookup(_call("hit"))
+    _wait_for_writer()
+    _store("newest")
+    assert db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] == 4
+
+    lang._evict_llm_cache()
+
+    assert db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] == 2
+    assert lang._cache_lookup(_call("hit")) is not None
+    assert lang._cache_lookup(_call("newest")) is not None
+
+
+def test_eviction_drops_expired_entries(db):
+    _store("p")
+    db.execute("UPDATE llm_cache SET created_at = ?", (lang._iso_after(-2 * lang.LLM_CACHE_TTL),))
+    db.commit()
+
+    assert lang._cache_lookup(_call("p")) is None
+    lang._evict_llm_cache()
+
+    assert db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] == 0
@@ -0,0 +1,34 @@
+import pytest
+
+import lang
+
+
+@pytest.fixture
+def writings(db):
+    for n in range(6):
+        db.execute("INSERT INTO writings (name, type) VALUES (?, ?)", (f"w{n}", ("lang", "tool", "place")[n % 3]))
+    db.commit()
+
+
+def test_seeded_sample_is_repeatable_and_follows_weights(client, writings):
+    query = "/api/writings/random-balanced?total=3&seed=7&groups=lang:2,tool"
+
+    first = client.get(query).json
+    second = client.get(query).json
+
+    assert first == second
+    assert sorted(item["type"] for item in first) == ["lang", "lang", "tool"]
+
+
+@pytest.mark.parametrize("weight", ["inf", "-inf", "nan", "0", "-1", "x"])
+def test_bad_group_weights_are_rejected(client, writings, weight):
+    response = client.get(f"/api/writings/random-balanced?total=3&groups=lang:{weight}")
+
+    assert response.status_code == 400
+
+
+def test_huge_weights_split_like_their_ratio(client, writings):
+    response = client.get("/api/writings/random-balanced?total=4&groups=lang:1e308,tool:1e308")
+
+    assert response.status_code == 200
+    assert sorted(item["type"] for item in response.json) == ["lang", "lang", "tool", "tool"]
@@ -0,0 +1,17 @@
+import lang
+
+
+def test_migrations_apply_once(db):
+    versions = [row[0] for row in db.execute("SELECT version FROM schema_migrations ORDER BY version")]
+    assert versions == [version for version, _, _ in lang.LANG_MIGRATIONS]
+
+    lang._run_migrations(db, lang.LANG_MIGRATIONS)
+
+    assert db.execute("SELECT COUNT(*) FROM schema_migrations").fetchone()[0] == len(versions)
+
+
+def test_health_reports_no_missing_indexes(client):
+    body = client.get("/api/health").json
+
+    assert body["ok"] is True
+    assert body["missing_indexes"] == []
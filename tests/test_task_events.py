@@ -0,0 +1,79 @@
+import threading
+
+import lang
+
+
+def test_task_summaries_are_looked_up_in_one_request(client, db):
+    ids = [lang._enqueue_task(f"a{n}", "b" * 500, None) for n in range(3)]
+    db.execute("UPDATE tasks SET status = 'done', finished_at = '2000-01-01' WHERE id = ?", (ids[0],))
+    db.commit()
+    lang._archive_tasks()
+
+    body = client.get(f"/api/tasks?ids={ids[2]},{ids[0]},{ids[1]},999").json
+
+    assert [task["id"] for task in body["tasks"]] == ids
+    assert [task["archived"] for task in body["tasks"]] == [True, False, False]
+    assert len(body["tasks"][1]["text_b"]) == lang.TASK_PREVIEW_CHARS
+    assert "llm_request" not in body["tasks"][1]
+    assert body["missing"] == [999]
+
+
+def test_task_summaries_reject_bad_ids(client):
+    assert client.get("/api/tasks").status_code == 400
+    assert client.get("/api/tasks?ids=1,x").status_code == 400
+    many = ",".join(str(n) for n in range(lang.TASK_LOOKUP_MAX + 1))
+    assert client.get(f"/api/tasks?ids={many}").status_code == 400
+
+
+def test_streams_end_after_max_age(client, monkeypatch):
+    monkeypatch.setattr(lang, "SSE_MAX_AGE", 0.3)
+    monkeypatch.setattr(lang, "TASK_EVENT_POLL", 0.05)
+    task_id = lang._enqueue_task("a", "b", None)
+
+    response = client.get("/api/queue/stream?after=0")
+    body = response.get_data(as_text=True)
+    response.close()
+
+    assert response.status_code == 200
+    assert f'"task_id": {task_id}' in body
+    assert '"status": "queued"' in body
+
+
+def test_open_streams_are_capped(client, monkeypatch):
+    monkeypatch.setattr(lang, "_sse_slots", threading.BoundedSemaphore(1))
+
+    first = client.get("/api/queue/stream")
+    refused = client.get("/api/queue/stream")
+
+    assert first.status_code == 200
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"]
+
+    first.close()
+    second = client.get("/api/queue/stream")
+    assert second.status_code == 200
+    second.close()
+
+
+def test_queue_returns_bounded_summaries_by_default(client, monkeypatch):
+    monkeypatch.setattr(lang, "QUEUE_SUMMARY_MAX", 2)
+    ids = [lang._enqueue_task(f"a{n}", "b" * 500, None) for n in range(3)]
+
+    body = client.get("/api/queue?limit=50").json
+
+    assert body["total"] == 3
+    assert body["counts"] == {"queued": 3}
+    assert [task["id"] for task in body["tasks"]] == ids[:0:-1]
+    assert len(body["tasks"][0]["text_b"]) == lang.TASK_PREVIEW_CHARS
+    assert "llm_request" not in body["tasks"][0]
+
+
+def test_full_queue_rows_are_limited_too(client):
+    ids = [lang._enqueue_task(f"a{n}", "b" * 500, None) for n in range(3)]
+
+    body = client.get("/api/queue?full=1&limit=2").json
+
+    assert [task["id"] for task in body["tasks"]] == ids[:0:-1]
+    assert len(body["tasks"][0]["text_b"]) == 500
+    assert body["tasks"][0]["errors"] == []
+    assert body["total"] == 3
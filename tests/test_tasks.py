@@ -0,0 +1,133 @@
+import threading
+
+import openai
+
+import lang
+
+
+def _expire_lease(db, task_id):
+    db.execute("UPDATE tasks SET lease_expires_at = ? WHERE id = ?", (lang._iso_after(-1), task_id))
+    db.commit()
+
+
+def test_claim_leases_task_to_this_worker(db):
+    task_id = lang._enqueue_task("a", "b", None)
+
+    task = lang._claim_next_task()
+
+    assert task.id == task_id
+    assert task.attempts == 1
+    row = db.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    assert row["status"] == "running"
+    assert row["lease_owner"] == lang.WORKER_ID
+    assert row["lease_expires_at"] > lang._now_iso()
+    assert lang._claim_next_task() is None
+
+
+def test_expired_lease_is_claimed_again(db):
+    task_id = lang._enqueue_task("a", "b", None)
+    lang._claim_next_task()
+    _expire_lease(db, task_id)
+
+    task = lang._claim_next_task()
+
+    assert task.id == task_id
+    assert task.attempts == 2
+
+
+def test_expired_lease_without_attempts_left_is_buried(db):
+    task_id = lang._enqueue_task("a", "b", None)
+    lang._claim_next_task()
+    db.execute(
+        "UPDATE tasks SET attempts = ?, lease_expires_at = ? WHERE id = ?",
+        (lang.RETRY_POLICIES["lang"].max_attempts, lang._iso_after(-1), task_id),
+    )
+    db.commit()
+
+    assert lang._claim_next_task() is None
+    row = db.execute("SELECT status, errors FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    assert row["status"] == "dead"
+    assert "lease expired" in row["errors"]
+
+
+def test_renew_leases_only_extends_tracked_tasks(db):
+    tracked = lang._enqueue_task("a", "b", None)
+    orphaned = lang._enqueue_task("c", "d", None)
+    lang._claim_next_task()
+    lang._claim_next_task()
+    db.execute("UPDATE tasks SET lease_expires_at = ?", (lang._iso_after(5),))
+    db.commit()
+    lang._track_tasks([tracked])
+
+    lang._renew_leases()
+
+    leases = dict(db.execute("SELECT id, lease_expires_at FROM tasks").fetchall())
+    assert leases[tracked] > lang._iso_after(60)
+    assert leases[orphaned] < lang._iso_after(60)
+
+
+def test_interactive_tasks_are_claimed_before_bulk():
+    bulk = lang._enqueue_task("a", "b", None, priority="bulk")
+    interactive = lang._enqueue_task("c", "d", None)
+
+    assert lang._claim_next_task().id == interactive
+    assert lang._claim_next_task(allow_bulk=False) is None
+    assert lang._claim_next_task().id == bulk
+
+
+def test_identical_tasks_coalesce_while_in_flight(db):
+    first = lang._enqueue_task("a", "b", None)
+    assert lang._enqueue_task("a", "b", None) == first
+
+    task = lang._claim_next_task()
+    lang._complete_task(task, "done")
+
+    assert lang._enqueue_task("a", "b", None) != first
+
+
+def test_retryable_failure_is_queued_with_backoff(db):
+    lang._enqueue_task("a", "b", None)
+    task = lang._claim_next_task()
+
+    lang._fail_task(task, openai.APITimeoutError(request=None))
+
+    row = db.execute("SELECT * FROM tasks WHERE id = ?", (task.id,)).fetchone()
+    assert row["status"] == "queued"
+    assert row["available_at"] > lang._now_iso()
+    assert lang._claim_next_task() is None
+
+
+def test_retryable_failure_on_last_attempt_is_dead(db):
+    lang._enqueue_task("a", "b", None)
+    task = lang._claim_next_task()
+    task.attempts = lang.RETRY_POLICIES["lang"].max_attempts
+
+    lang._fail_task(task, openai.APITimeoutError(request=None))
+
+    status = db.execute("SELECT status FROM tasks WHERE id = ?", (task.id,)).fetchone()[0]
+    assert status == "dead"
+
+
+def test_other_failures_are_final(db):
+    lang._enqueue_task("a", "b", None)
+    task = lang._claim_next_task()
+
+    lang._fail_task(task, ValueError("bad input"))
+
+    row = db.execute("SELECT status, error FROM tasks WHERE id = ?", (task.id,)).fetchone()
+    assert row["status"] == "error"
+    assert row["error"] == "ValueError: bad input"
+
+
+def test_stopping_embedded_workers_hands_tasks_back(db, monkeypatch):
+    monkeypatch.setattr(lang, "_stopping", threading.Event())
+    task_id = lang._enqueue_task("a", "b", None)
+    lang._claim_next_task()
+    executor = threading.Thread(target=lang._stopping.wait)
+    executor.start()
+
+    lang._stop_embedded_workers(executor)
+
+    assert not executor.is_alive()
+    row = db.execute("SELECT status, attempts, lease_owner FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    assert tuple(row) == ("queued", 0, None)
@@ -0,0 +1,73 @@
+import sqlite3
+import time
+
+import lang
+
+
+def test_flush_thread_survives_failures(monkeypatch):
+    monkeypatch.setattr(lang, "USAGE_FLUSH_INTERVAL", 0.05)
+    aggregator = lang.UsageAggregator()
+    failures = [sqlite3.OperationalError("database is locked"), RuntimeError("boom")]
+    flush = aggregator.flush
+
+    def failing_flush():
+        if failures:
+            raise failures.pop(0)
+        flush()
+
+    monkeypatch.setattr(aggregator, "flush", failing_flush)
+    aggregator.record("m", "lang", (1, 2, 3), cached=False)
+
+    deadline = time.monotonic() + 5
+    while aggregator.pending() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert failures == []
+    assert aggregator.pending() == {}
+    conn = lang._get_usage_db()
+    row = conn.execute("SELECT tokens_in, tokens_out, total_tokens FROM usage_all_time").fetchone()
+    assert tuple(row) == (1, 2, 3)
+    conn.close()
+
+
+def _record_on(monkeypatch, usage_date, tokens_in):
+    monkeypatch.setattr(lang, "_today_utc", lambda: usage_date)
+    lang._usage.record("m", "lang", (tokens_in, 0, tokens_in), cached=False)
+
+
+def _seed_usage(monkeypatch):
+    for usage_date, tokens_in in (("2024-01-31", 1), ("2024-02-01", 10), ("2024-02-05", 100)):
+        _record_on(monkeypatch, usage_date, tokens_in)
+    lang._usage.flush()
+
+
+def test_bounded_weeks_and_months_only_count_days_in_range(client, monkeypatch):
+    _seed_usage(monkeypatch)
+
+    monthly = client.get("/api/usage?group=month&from=2024-02-01&to=2024-02-03").json
+    weekly = client.get("/api/usage?group=week&from=2024-01-31&to=2024-02-01").json
+
+    assert [(row["month"], row["tokens_in"]) for row in monthly["monthly"]] == [("2024-02-01", 10)]
+    assert monthly["all_time"][0]["tokens_in"] == 10
+    assert monthly["range"] == {"from": "2024-02-01", "to": "2024-02-03"}
+    assert [(row["week_start"], row["tokens_in"]) for row in weekly["weekly"]] == [("2024-01-29", 11)]
+
+
+def test_unbounded_report_uses_whole_periods(client, monkeypatch):
+    _seed_usage(monkeypatch)
+    _record_on(monkeypatch, "2024-02-06", 1000)
+
+    body = client.get("/api/usage?group=month").json
+
+    assert [(row["month"], row["tokens_in"]) for row in body["monthly"]] == [
+        ("2024-02-01", 1110),
+        ("2024-01-01", 1),
+    ]
+    assert body["all_time"][0]["tokens_in"] == 1111
+    assert "range" not in body
+
+
+def test_usage_rejects_impossible_dates(client):
+    for query in ("from=2024-02-30", "to=2024-13-01", "from=20240101", "from=2024-02-02&to=2024-02-01"):
+        response = client.get(f"/api/usage?{query}")
+        assert response.status_code == 400, query
@@ -0,0 +1,139 @@
+import sqlite3
+
+import pytest
+
+import lang
+
+
+def _add_writing(db, name, parent=None, type_="lang", description=""):
+    cur = db.execute(
+        "INSERT INTO writings (name, description, parent_writing_id, type) VALUES (?, ?, ?, ?)",
+        (name, description, parent, type_),
+    )
+    db.commit()
+    return cur.lastrowid
+
+
+def _closure(db):
+    rows = db.execute("SELECT ancestor_id, descendant_id, depth FROM writing_closure")
+    return {tuple(row) for row in rows}
+
+
+def test_closure_follows_inserts(db):
+    root = _add_writing(db, "root")
+    child = _add_writing(db, "child", root)
+    grandchild = _add_writing(db, "grandchild", child)
+
+    assert _closure(db) == {
+        (root, root, 0),
+        (child, child, 0),
+        (grandchild, grandchild, 0),
+        (root, child, 1),
+        (child, grandchild, 1),
+        (root, grandchild, 2),
+    }
+
+
+def test_closure_follows_a_moved_subtree(db, client):
+    a = _add_writing(db, "a")
+    b = _add_writing(db, "b")
+    child = _add_writing(db, "child", a)
+    grandchild = _add_writing(db, "grandchild", child)
+
+    db.execute("UPDATE writings SET parent_writing_id = ? WHERE id = ?", (b, child))
+    db.commit()
+
+    assert _closure(db) == {
+        (a, a, 0),
+        (b, b, 0),
+        (child, child, 0),
+        (grandchild, grandchild, 0),
+        (b, child, 1),
+        (child, grandchild, 1),
+        (b, grandchild, 2),
+    }
+    body = client.get(f"/api/writings/{grandchild}/ancestors").json
+    assert body["root_id"] == b
+    assert [item["id"] for item in body["items"]] == [b, child]
+    assert client.get(f"/api/writings/{a}/ancestors").json["descendant_count"] == 0
+
+
+def test_closure_rejects_cycles(db):
+    root = _add_writing(db, "root")
+    child = _add_writing(db, "child", root)
+    before = _closure(db)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("UPDATE writings SET parent_writing_id = ? WHERE id = ?", (child, root))
+    db.rollback()
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("UPDATE writings SET parent_writing_id = ? WHERE id = ?", (root, root))
+    db.rollback()
+
+    assert _closure(db) == before
+
+
+def test_closure_forgets_deleted_writings(db):
+    root = _add_writing(db, "root")
+    child = _add_writing(db, "child", root)
+
+    db.execute("DELETE FROM writings WHERE id = ?", (child,))
+    db.commit()
+
+    assert _closure(db) == {(root, root, 0)}
+
+
+def test_search_follows_writing_changes(db, client):
+    writing = _add_writing(db, "Orchard", description="apples in autumn")
+
+    items = client.get("/api/search?q=apples&scope=writings").json["items"]
+    assert [item["id"] for item in items] == [writing]
+
+    db.execute("UPDATE writings SET description = 'pears in winter' WHERE id = ?", (writing,))
+    db.commit()
+    assert client.get("/api/search?q=apples&scope=writings").json["items"] == []
+    assert len(client.get("/api/search?q=pea&scope=writings").json["items"]) == 1
+
+    db.execute("DELETE FROM writings WHERE id = ?", (writing,))
+    db.commit()
+    assert client.get("/api/search?q=pears").json["items"] == []
+
+
+def test_search_covers_notes_and_runs(db, client):
+    writing = _add_writing(db, "Orchard")
+    db.execute("INSERT INTO writing_notes (writing_id, content) VALUES (?, 'prune the apples')", (writing,))
+    db.execute("INSERT INTO runs (parent_writing_id, prompt) VALUES (?, 'apples everywhere')", (writing,))
+    db.commit()
+
+    items = client.get("/api/search?q=apples").json["items"]
+
+    assert sorted(item["kind"] for item in items) == ["note", "run"]
+    assert all(item["writing_id"] == writing for item in items)
+
+
+def test_keyset_pagination_walks_every_writing_once(db, client):
+    ids = [_add_writing(db, f"w{n}", type_="lang" if n % 3 else "other") for n in range(10)]
+    lang_ids = [writing_id for n, writing_id in enumerate(ids) if n % 3]
+
+    seen = []
+    after = None
+    while True:
+        query = "type=lang&limit=3&include_total=1&fields=name"
+        if after is not None:
+            query += f"&after_id={after}"
+        body = client.get(f"/api/writings?{query}").json
+        assert body["total"] == len(lang_ids)
+        assert all(set(item) == {"id", "name"} for item in body["items"])
+        seen.extend(item["id"] for item in body["items"])
+        after = body["next_after_id"]
+        if after is None:
+            break
+
+    assert seen == sorted(lang_ids, reverse=True)
+
+
+def test_writings_without_pagination_returns_a_list(db, client):
+    _add_writing(db, "w")
+
+    assert isinstance(client.get("/api/writings").json, list)
+    assert client.get("/api/writings?fields=bogus").status_code == 400